@@ -66,12 +66,15 @@ admin.add_view(view.AdminUserView(model.User, db.session, category='Admin', name
 
 admin.add_view(view.AdminInvoiceView(model.Invoice, db.session, category='Billing', endpoint="admin/invoices"))
 admin.add_view(view.ACLView(model.Payment, db.session, category='Billing', endpoint="admin/payments"))
+admin.add_view(view.ACLView(model.MailOutbox, db.session, category='Billing', name='Mail Outbox', endpoint="admin/outbox"))
 admin.add_view(view.SepaExportView(model.Invoice, db.session, category='Billing', name='SEPA Export', endpoint="admin/sepa-export", menu_icon_type='glyph',  menu_icon_value='glyphicon-open'))
 admin.add_view(view.PaymentImportView(name='Import Payments', category='Billing', endpoint='billing/import_payments', menu_icon_type='glyph',  menu_icon_value='glyphicon-save'))
+admin.add_view(view.paymentimport.SepaReturnsView(name='Import SEPA Returns', category='Billing', endpoint='billing/import_sepa_returns', menu_icon_type='glyph',  menu_icon_value='glyphicon-retweet'))
 
 admin.add_view(view.ACLView(model.Package, db.session, category='System', endpoint="admin/packages"))
 admin.add_view(view.ACLView(model.IP, db.session, category='System', name='IPs', endpoint="admin/ips"))
 admin.add_view(view.ACLView(model.Subnet_rDNS, db.session, category='System', name='Subnet rDNS', endpoint="admin/subnet_rdns"))
+admin.add_view(view.ACLView(model.RDNSChange, db.session, category='System', name='rDNS Changes', endpoint="admin/rdns_changes"))
 admin.add_view(view.PowerOuletAdminView(model.PowerOutlet, db.session, category='System', name='Power Outlets', endpoint="admin/power"))
 admin.add_view(view.ACLView(model.Role, db.session, category='System', name='Roles', endpoint="admin/roles"))
 admin.add_view(view.ACLView(model.ServerType, db.session, category='System', name='Server Types', endpoint="admin/servertypes"))
@@ -79,8 +82,10 @@ admin.add_view(view.ACLView(model.ServerType, db.session, category='System', nam
 from ff_housing.view.whois import WhoisView
 WhoisView.register_view(app, "/api/whois")
 
-from ff_housing.view.rdns import rdnsView
+from ff_housing.view.rdns import rdnsView, rdnsExportView, rdnsChangesView
 rdnsView.register_view(app, "/api/rdns")
+rdnsExportView.register_view(app, "/api/rdns")
+rdnsChangesView.register_view(app, "/api/rdns")
 
 # define a context processor for merging flask-admin's template context into the
 # flask-security views.
@@ -33,6 +33,35 @@ SECURITY_SEND_REGISTER_EMAIL = False
 
 FF_HOUSING_FILES_DIR = "./files/"
 FF_HOUSING_INVOICES_BCC = "root@localhost"
+FF_HOUSING_RENDER_PROCESSES = 4
+FF_HOUSING_PDF_CACHE_DAYS = 90
+FF_HOUSING_PDF_CACHE_SIZE = 256 * 1024 * 1024
+FF_HOUSING_MAIL_BATCH = 100
+FF_HOUSING_MAIL_WORKERS = 2
+FF_HOUSING_MAIL_ATTEMPTS = 8
+FF_HOUSING_MAIL_RETRY = 300
+# keep User.balance in the contact_balance table. the table is only kept current while
+# this is set: run billing_rebuild_balances once after enabling it (or re-enabling it)
+FF_HOUSING_BALANCE_TABLE = False
+# payments imported per commit, the upload is parsed as it is read
+FF_HOUSING_IMPORT_CHUNK = 500
+# bank CSV statements: header names of the columns, date and value are required
+FF_HOUSING_IMPORT_CSV = {
+    'encoding': 'utf-8-sig',
+    'delimiter': ';',
+    'dayfirst': True,
+    'currency': 'EUR',
+    'columns': {
+        'date': 'Date',
+        'partner': 'Partner',
+        'iban': 'IBAN',
+        'value': 'Amount',
+        'currency': 'Currency',
+        'reference': 'Reference',
+        'reference_number': 'Reference Number',
+        'note': 'Note',
+    },
+}
 
 MAIL_SUPPRESS_SEND = True
 MAIL_DEFAULT_SENDER = "FunkFeuer <root@localhost>"
@@ -43,6 +72,24 @@ BILLING_REFERENCE_UID_PREFIX = "Housing-k"
 POWER_API = "https://localhost/"
 POWER_USER = ""
 POWER_PASS = ""
+POWER_TIMEOUT = 5
+POWER_CONNECTIONS = 16
+POWER_CACHE_TTL = 5
+
+WHOIS_INDEX_TTL = 300
+
+RDNS_CACHE_TTL = 300
+RDNS_CACHE_SIZE = 1024
+# reverse zones for the export, the longest zone containing an address gets its record.
+# without zones, every /24 and /48 with records is exported as a zone.
+# zones end on an octet (IPv4) or nibble (IPv6) boundary, IPv4 zones below a /24
+# are named RFC 2317 style, 128/25.0.0.10.in-addr.arpa
+RDNS_ZONES = []
+RDNS_ZONE_PREFIX4 = 24
+RDNS_ZONE_PREFIX6 = 48
+# rDNS change feed, changes per request and days until compaction
+RDNS_CHANGES_LIMIT = 10000
+RDNS_CHANGES_DAYS = 30
 
 # SEPA_DD Export settings
 SEPADD_CREDITOR_NAME  = "Test Name"
@@ -52,4 +99,9 @@ SEPADD_CREDITOR_ID = "AT44ZZZ00000000000"
 SEPADD_CURRENCY = "EUR"  # ISO 4217
 SEPADD_INSTRUMENT = "CORE"  # CORE (B2C) / B2B
 SEPADD_SCHEMA = "pain.008.001.02"
-SEPADD_BATCH = False
+SEPADD_BATCH = False  # BtchBookg, book each payment information block as one
+# transactions per exported file (0 for no limit), FRST and RCUR are separate blocks
+SEPADD_MAX_TRANSACTIONS = 1000
+# return reasons after which the next collection of the contact is a FRST again,
+# returns of FRST collections always reset it
+SEPADD_RETURN_FIRST_REASONS = ('AC01', 'AC04', 'AC06', 'AG01', 'MD01', 'MD02', 'MD07')
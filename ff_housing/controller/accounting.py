@@ -3,12 +3,14 @@ from ff_housing import app, mail, manager, model, db
 from flask_mail import Message
 from datetime import datetime, date
 from dateutil.relativedelta import *
-from dateutil.rrule import *
-from os.path import dirname
-from decimal import Decimal
+from os.path import dirname, basename
+from itertools import groupby
+import os, smtplib
 
-from ff_housing.utils import daysofmonth
-from sqlalchemy.sql.expression import func
+from ff_housing.controller import proration
+from ff_housing.controller.pdf_cache import PdfCache
+from sqlalchemy.sql.expression import func, select, literal, union_all, type_coerce
+from sqlalchemy.orm import contains_eager, joinedload
 
 from flask import flash
 
@@ -19,12 +21,44 @@ def bill_all():
         started = datetime.utcnow() )
 
     db.session.add(job)
-    for contact in db.session.query(model.User):
-        bill_contact(contact, job)
+    packages = due_packages()
+    prorated = proration.prorate_all([proration_row(p) for p in packages])
+    for contact_id, billed in groupby(zip(packages, prorated), key=lambda pp: pp[0].contract.billing_c_id):
+        bill_packages(*zip(*billed), job=job)
 
     job.finished = datetime.utcnow()
     db.session.commit()
 
+def due_packages(billdate=None):
+    ''' all open contract packages to be billed at billdate, selected in one query
+        with contract, billing contact and package already loaded.
+        ordered by billing contact, so they can be grouped into invoices.
+        a range scan of the next_billing_date index, only due packages are read. '''
+    billdate = billdate or date.today()
+    packages = model.ContractPackage.query.\
+        join(model.ContractPackage.contract).\
+        options(contains_eager(model.ContractPackage.contract).joinedload(model.Contract.billing_c),
+                joinedload(model.ContractPackage.package)).\
+        filter(model.ContractPackage.next_billing_date <= billdate,
+               model.Contract.closed == False).\
+        order_by(model.Contract.billing_c_id, model.Contract.id, model.ContractPackage.id)
+    return packages.all()
+
+def bill_packages(packages, prorated, job=None):
+    ''' bill due packages of a single billing contact into one invoice '''
+    invoice = None
+    contract = None
+    for package, span in zip(packages, prorated):
+        if invoice is None:
+            invoice = model.Invoice(contact = package.contract.billing_c,
+                                    payment_type=package.contract.payment_type, job=job)
+            db.session.add(invoice)
+        if package.contract is not contract:
+            contract = package.contract
+            print("\n%s: %s" % (contract.billing_c, contract.payment_type))
+        bill_package(package, invoice, span)
+    return invoice
+
 def bill_contact(contact, job=None):
     invoice = None
     for c in model.Contract.query.filter_by(closed=False, billing_c=contact):
@@ -51,55 +85,29 @@ def bill_contract(c, invoice = None):
             bill_package(package, invoice)
     db.session.commit()
 
-def bill_package(package, invoice):
-    if(package.needs_billing() == False):
-        return False
-    amount = 0
-    # next_billed - the span of this invoice element.
+def proration_row(package):
+    ''' (start, billingmonthday, billing_period, closed_at, amount) of the next span to bill '''
     if package.billed_until is not None:
         billed_until = package.billed_until
         billingmonthday = billed_until.day
-        next_billed = billed_until + relativedelta(months=+package.billing_period)
     else:
         billed_until = package.opened_at.date()
         billingmonthday = app.config.get('FF_HOUSING_BILLING_DAY_DEFAULT', 25)
-        next_billed = billed_until.replace(day=billingmonthday) + relativedelta(months=+package.billing_period)
+    closed_at = package.closed_at.date() if package.closed_at else None
+    return (billed_until, billingmonthday, package.billing_period, closed_at, package.amount)
 
-    if package.closed_at and next_billed > package.closed_at.date():
-        next_billed = package.closed_at.date()
+def bill_package(package, invoice, prorated=None):
+    if(package.needs_billing() == False):
+        return False
+    # next_billed - the span of this invoice element.
+    if prorated is None:
+        prorated = proration.prorate_all([proration_row(package)])[0]
+    amount, billed_until, next_billed = prorated
 
     if (next_billed <= date.today()+relativedelta(days=-30)):
         print ("!! something fishy here: package %s next_billed (%s) is in the past!" % (package, next_billed))
         return False
 
-    # we iterate over a list of montly dates between billed_until and next_billed, including both
-    last_date = billed_until
-    billing_dates = list(rrule(MONTHLY, dtstart=billed_until, until=next_billed, bymonthday=billingmonthday))
-    billing_dates.append(next_billed)
-    for next_date in billing_dates:
-        if type(next_date) is datetime:
-            next_date = next_date.date()
-
-        if last_date == next_date:
-            continue;
-
-        if (last_date.day == next_date.day):
-            # full month
-            amount += package.amount
-        elif (int(next_date.month) != int(last_date.month)):
-            # days between two months
-            fraction_of_month = Decimal(
-                ( daysofmonth(last_date) - (last_date.day-1) ) / daysofmonth(last_date) \
-                + ( (next_date.day-1) / daysofmonth(next_date) )
-            )
-            amount += package.amount * fraction_of_month
-        else:
-            # days in same month
-            fraction_of_month = Decimal((next_date.day - last_date.day) / daysofmonth(next_date))
-            amount += package.amount * fraction_of_month
-        last_date = next_date
-        amount = amount.quantize(Decimal('.01'))
-
     print("\t%d * %s: %s - %s \t%f" % (package.quantity, package, billed_until, next_billed+relativedelta(days=-1), amount*package.quantity))
 
     db.session.add(model.InvoiceItem(
@@ -114,50 +122,276 @@ def bill_package(package, invoice):
     package.billed_until = next_billed
 
 
+latex_templates = '%s/templates/latex/' % dirname(ff_housing.__file__)
+mail_templates = '%s/templates/mail/' % dirname(ff_housing.__file__)
+pdf_cache = PdfCache(latex_templates)
+
+# template environments, created once per process. they keep the compiled templates,
+# the bytecode is stored on disk so a new process does not parse them again.
+_latex_env = None
+_mail_env = None
+
+def _bytecode_cache():
+    from jinja2 import FileSystemBytecodeCache
+    path = '%s/cache/templates' % app.config.get('FF_HOUSING_FILES_DIR', './files/').rstrip('/')
+    os.makedirs(path, exist_ok=True)
+    return FileSystemBytecodeCache(path)
+
+def latex_env():
+    global _latex_env
+    if _latex_env is None:
+        from jinja2.loaders import FileSystemLoader
+        from latex.jinja2 import make_env
+        _latex_env = make_env(loader=FileSystemLoader(latex_templates), bytecode_cache=_bytecode_cache())
+    return _latex_env
+
+def mail_env():
+    global _mail_env
+    if _mail_env is None:
+        from jinja2.loaders import FileSystemLoader
+        from jinja2 import Environment
+        _mail_env = Environment(loader=FileSystemLoader(mail_templates), bytecode_cache=_bytecode_cache())
+    return _mail_env
+
+def render_context(invoices):
+    ''' the invoices with the items and contact the templates use, loaded in one query.
+        items are in the order they were added, the order of invoices is kept. '''
+    ids = [i.id for i in invoices]
+    if not ids:
+        return []
+    loaded = model.Invoice.query.join(model.Invoice.contact).outerjoin(model.Invoice.items).\
+        options(contains_eager(model.Invoice.contact), contains_eager(model.Invoice.items)).\
+        filter(model.Invoice.id.in_(ids)).\
+        order_by(model.Invoice.id, model.InvoiceItem.id)
+    loaded = dict((i.id, i) for i in loaded)
+    return [loaded[id] for id in ids if id in loaded]
+
+def render_invoice(invoice, env=None):
+    ''' LaTeX source of an invoice '''
+    env = env or latex_env()
+    tpl = env.get_template('invoice.tex')
+    return tpl.render(invoice=invoice, templatedir=latex_templates)
+
 def generate_invoice(invoice):
-    from jinja2.loaders import FileSystemLoader
-    from latex.jinja2 import make_env
     from latex import build_pdf
 
     if(len(invoice.items) == 0):
         # skip invoices without items
         return
 
-    latex_templates = '%s/templates/latex/' % dirname(ff_housing.__file__)
-    env = make_env(loader=FileSystemLoader(latex_templates))
-    tpl = env.get_template('invoice.tex')
-
-    pdf = build_pdf(tpl.render(invoice=invoice, templatedir=latex_templates ))
-    pdf.save_to(invoice.path)
+    source = render_invoice(invoice)
+    if not pdf_cache.get(source, invoice.path):
+        pdf = build_pdf(source)
+        pdf.save_to(invoice.path)
+        pdf_cache.put(source, invoice.path)
+        pdf_cache.evict()
     return(invoice.path)
 
-def send_invoice(invoice):
-    from jinja2.loaders import FileSystemLoader
-    from jinja2 import Environment
-
-    if invoice.cancelled or len(invoice.items) == 0:
-        # skip invoices without items
-        return
-
-    msg = Message("FunkFeuer Housing Rechnung %s" % invoice.number,
-                  recipients=[invoice.contact.email],
-                  bcc=[app.config.get('FF_HOUSING_INVOICES_BCC')]
-                  )
-
-    print("sending %s to %s" % (invoice, invoice.contact.email) )
+# LaTeX builder of a pdf worker process, looked up once per worker.
+_pdf_builder = None
+
+def _init_pdf_worker():
+    global _pdf_builder
+    from latex.build import BUILDERS, PREFERRED_BUILDERS
+    for name in PREFERRED_BUILDERS:
+        builder = BUILDERS[name]()
+        if builder.is_available():
+            _pdf_builder = builder
+            return
+
+def _build_pdf(source, path):
+    from latex.exc import LatexBuildError
+
+    if _pdf_builder is None:
+        raise RuntimeError('No available builder could be instantiated. '
+                           'Please make sure LaTeX is installed.')
+    try:
+        pdf = _pdf_builder.build_pdf(source)
+    except LatexBuildError as e:
+        # LatexBuildError can not be passed back to the parent process
+        errors = [err['error'] for err in e.get_errors()] if e.log else []
+        raise RuntimeError('LaTeX build failed: %s' % '; '.join(errors))
+    pdf.save_to(path)
+    return path
+
+def generate_invoices(invoices, job=None):
+    ''' build the pdfs of invoices on a pool of FF_HOUSING_RENDER_PROCESSES processes.
+        returns the invoices that have been generated, failures are logged to the job.
+        the pdf cache hits and misses of the run are logged to app.logger. '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    env = latex_env()
+    generated = []
+    hits, misses = pdf_cache.hits, pdf_cache.misses
+    with ProcessPoolExecutor(max_workers=app.config.get('FF_HOUSING_RENDER_PROCESSES'),
+                             initializer=_init_pdf_worker) as pool:
+        builds = []
+        for invoice in render_context(invoices):
+            if len(invoice.items) == 0:
+                # skip invoices without items
+                continue
+            try:
+                source = render_invoice(invoice, env)
+                if pdf_cache.get(source, invoice.path):
+                    builds.append((invoice, source, None))
+                else:
+                    builds.append((invoice, source, pool.submit(_build_pdf, source, invoice.path)))
+            except Exception as e:
+                _log_error(job, "%s: could not render: %s" % (invoice.number, e))
+
+        for invoice, source, build in builds:
+            try:
+                if build is not None:
+                    build.result()
+                    pdf_cache.put(source, invoice.path)
+                generated.append(invoice)
+            except Exception as e:
+                _log_error(job, "%s: could not generate: %s" % (invoice.number, e))
+    if any(build is not None for invoice, source, build in builds):
+        # once per run, it walks the whole cache
+        pdf_cache.evict()
+    app.logger.info('generated %d invoices, pdf cache: %d hits, %d misses',
+                    len(generated), pdf_cache.hits - hits, pdf_cache.misses - misses)
+    return generated
+
+def _log_error(job, msg):
+    if job is not None:
+        job.log_error(msg)
+    else:
+        print(msg)
 
-    mail_templates = '%s/templates/mail/' % dirname(ff_housing.__file__)
-    env = Environment(loader=FileSystemLoader(mail_templates))
-    tpl = env.get_template('invoice.txt')
-    msg.body = tpl.render(invoice=invoice)
+def invoice_mail(invoice):
+    ''' subject and body of the mail of an invoice '''
+    tpl = mail_env().get_template('invoice.txt')
+    return ("FunkFeuer Housing Rechnung %s" % invoice.number, tpl.render(invoice=invoice))
 
-    generate_invoice(invoice)
-    with open(invoice.path, mode='rb') as fp:
-        msg.attach("%s.pdf" % invoice.number, "application/pdf", fp.read())
+def send_invoice(invoice):
+    return send_invoices([invoice])
+
+def send_invoices(invoices, job=None):
+    ''' queue unsent invoices and deliver them right away.
+        returns the number of sent invoices. '''
+    queue_invoices(invoices, job)
+    return deliver_outbox(job, invoices)
+
+def queue_invoices(invoices, job=None):
+    ''' generate unsent invoices and queue their mails in the outbox.
+        invoices already waiting in the outbox are not generated again. '''
+    queued = set(id for (id, ) in db.session.query(model.MailOutbox.invoice_id).filter(
+                model.MailOutbox.sent_on == None,
+                model.MailOutbox.attempts < app.config.get('FF_HOUSING_MAIL_ATTEMPTS', 8)))
+    invoices = [i for i in invoices if not i.cancelled and not i.sent and i.id not in queued]
+
+    # all pdfs are built before the first mail is queued, invoices without items are skipped
+    for invoice in generate_invoices(invoices, job):
+        subject, body = invoice_mail(invoice)
+        db.session.add(model.MailOutbox(
+            invoice = invoice,
+            job = job,
+            recipient = invoice.contact.email,
+            subject = subject,
+            body = body,
+            attachment = invoice.path
+        ))
+    db.session.commit()
 
-    mail.send(msg)
-    invoice.sent_on = datetime.utcnow()
-    model.db.session.commit()
+def deliver_outbox(job=None, invoices=None):
+    ''' deliver due outbox mails, FF_HOUSING_MAIL_BATCH mails per SMTP connection
+        on FF_HOUSING_MAIL_WORKERS connections at a time. failed mails are retried
+        with exponential backoff, invoices are marked as sent on delivery only.
+        if invoices are given, their mails are delivered whether due or not.
+        returns the number of delivered mails. '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    entries = model.MailOutbox.query.join(model.MailOutbox.invoice).\
+        options(contains_eager(model.MailOutbox.invoice)).\
+        filter(model.MailOutbox.sent_on == None,
+               model.MailOutbox.attempts < app.config.get('FF_HOUSING_MAIL_ATTEMPTS', 8),
+               model.Invoice.sent_on == None,
+               model.Invoice.cancelled == False)
+    if invoices is None:
+        entries = entries.filter(model.MailOutbox.next_attempt <= datetime.utcnow())
+    else:
+        entries = entries.filter(model.MailOutbox.invoice_id.in_([i.id for i in invoices]))
+    entries = entries.order_by(model.MailOutbox.id).all()
+
+    batch = app.config.get('FF_HOUSING_MAIL_BATCH', 100)
+    sent = 0
+    with ThreadPoolExecutor(max_workers=app.config.get('FF_HOUSING_MAIL_WORKERS', 2)) as pool:
+        deliveries = []
+        for chunk in [entries[n:n+batch] for n in range(0, len(entries), batch)]:
+            mails = [(e.recipient, e.subject, e.body, e.attachment) for e in chunk]
+            deliveries.append((chunk, pool.submit(_deliver, mails)))
+
+        for chunk, delivery in deliveries:
+            for entry, error in zip(chunk, delivery.result()):
+                now = datetime.utcnow()
+                entry.attempts += 1
+                if error is None:
+                    print("sent %s to %s" % (entry.invoice, entry.recipient))
+                    entry.sent_on = now
+                    entry.invoice.sent_on = now
+                    entry.error = None
+                    sent += 1
+                else:
+                    entry.error = error[:255]
+                    entry.next_attempt = now + relativedelta(seconds=+app.config.get('FF_HOUSING_MAIL_RETRY', 300) * 2 ** (entry.attempts - 1))
+                    _log_error(job, "%s: could not send: %s" % (entry.invoice.number, error))
+            db.session.commit()
+    return sent
+
+class _ConnectionLost(Exception):
+    pass
+
+def _deliver(mails):
+    ''' send (recipient, subject, body, attachment) mails over one SMTP connection.
+        runs in a worker thread, returns None or an error message per mail.
+        if the connection is lost for good, the remaining mails fail. '''
+    errors = []
+    with app.app_context():
+        try:
+            with mail.connect() as conn:
+                for recipient, subject, body, attachment in mails:
+                    try:
+                        msg = Message(subject, recipients=[recipient], body=body,
+                                      bcc=[app.config.get('FF_HOUSING_INVOICES_BCC')])
+                        with open(attachment, mode='rb') as fp:
+                            msg.attach(basename(attachment), "application/pdf", fp.read())
+                        _send(conn, msg)
+                        errors.append(None)
+                    except _ConnectionLost:
+                        raise
+                    except Exception as e:
+                        errors.append(str(e) or type(e).__name__)
+        except (_ConnectionLost, smtplib.SMTPException, OSError) as e:
+            # connection failed, or was already gone when closing it
+            errors += [str(e) or type(e).__name__] * (len(mails) - len(errors))
+    return errors
+
+def _send(conn, msg):
+    ''' send msg, reconnecting once if the server hung up.
+        flask_mail drops mails silently without a host, so that is never a delivery. '''
+    if conn.host is None and not conn.mail.suppress:
+        raise _ConnectionLost('not connected')
+    try:
+        conn.send(msg)
+    except (smtplib.SMTPServerDisconnected, ConnectionError):
+        if conn.host is None:
+            raise
+        _reconnect(conn)
+        conn.send(msg)
+
+def _reconnect(conn):
+    ''' replace the host of conn by a new connection, conn keeps the old one if that fails '''
+    try:
+        host = conn.configure_host()
+    except (smtplib.SMTPException, OSError) as e:
+        raise _ConnectionLost('reconnect failed: %s' % (str(e) or type(e).__name__))
+    try:
+        conn.host.quit()
+    except (smtplib.SMTPException, OSError):
+        pass
+    conn.host = host
 
 def send_unsent_invoices():
     job = model.Job(
@@ -166,8 +400,8 @@ def send_unsent_invoices():
         started = datetime.utcnow() )
     db.session.add(job)
 
-    for i in model.Invoice.query.filter_by(sent_on=None):
-        send_invoice(i)
+    queue_invoices(model.Invoice.query.filter_by(sent_on=None, cancelled=False).all(), job)
+    deliver_outbox(job)
 
     job.finished = datetime.utcnow()
     db.session.commit()
@@ -203,3 +437,61 @@ def cancel_invoice(invoice):
         flash('Marked invoice as cancelled.', 'info')
     model.db.session.commit()
     return True
+
+
+def ledger(contact, start=None, end=None, offset=0, limit=None):
+    ''' sent invoices and payments of contact with the running balance, newest first.
+        one query: the balance runs over the whole history, start/end (dates) and
+        offset/limit only select the rows shown.
+        returns (rows, count of rows in the date range, balance) '''
+    invoices = select([
+            literal(0).label('kind'),
+            model.Invoice.id.label('id'),
+            model.Invoice.created_at.label('date'),
+            (-model.Invoice.total).label('amount'),
+            model.Invoice.cancelled.label('cancelled')]) \
+        .where(model.Invoice.contact_id == contact.id) \
+        .where(model.Invoice.sent_on != None)
+    payments = select([
+            literal(1).label('kind'),
+            model.Payment.id.label('id'),
+            model.Payment.date.label('date'),
+            func.coalesce(model.Payment.amount, 0).label('amount'),
+            literal(False).label('cancelled')]) \
+        .where(model.Payment.contact_id == contact.id)
+    entries = union_all(invoices, payments).alias('entries')
+
+    # invoices before payments of the same date, like the old sort of invoices + payments
+    order = (entries.c.date, entries.c.kind, entries.c.id)
+    balance = select([entries,
+            func.sum(entries.c.amount).over(order_by=order).label('balance'),
+            func.sum(entries.c.amount).over().label('total')]).alias('ledger')
+
+    money = db.Numeric(precision=10, scale=2, decimal_return_scale=2)
+    query = select([balance.c.kind, balance.c.id, balance.c.date, balance.c.cancelled,
+            type_coerce(balance.c.amount, money).label('amount'),
+            type_coerce(balance.c.balance, money).label('balance'),
+            type_coerce(balance.c.total, money).label('total'),
+            func.count().over().label('count')]) \
+        .order_by(balance.c.date.desc(), balance.c.kind.desc(), balance.c.id.desc())
+    if start:
+        query = query.where(balance.c.date >= datetime.combine(start, datetime.min.time()))
+    if end:
+        query = query.where(balance.c.date < datetime.combine(end + relativedelta(days=1), datetime.min.time()))
+    query = query.offset(offset).limit(limit)
+
+    rows = db.session.execute(query).fetchall()
+    if rows:
+        return rows, rows[0].count, rows[0].total
+    # nothing in this range, total balance of all rows
+    total = db.session.execute(select([type_coerce(func.sum(entries.c.amount), money)])).scalar()
+    return rows, 0, total or 0
+
+def rebuild_balances():
+    ''' recompute the contact_balance table from payments and sent invoices '''
+    t = model.ContactBalance.__table__
+    db.session.execute(t.delete())
+    db.session.execute(t.insert().from_select(['contact_id', 'balance'],
+        select([model.User.id, model.User.balance_sum()])))
+    db.session.expire_all()
+    return db.session.query(func.count(model.ContactBalance.contact_id)).scalar()
@@ -0,0 +1,292 @@
+from ff_housing import app
+
+from xml.etree import ElementTree
+from dateutil.parser import parse
+from decimal import Decimal, InvalidOperation
+import codecs, csv, hashlib, json, re
+
+
+class Transaction():
+    ''' one booked transaction of a bank statement, the same for every format.
+        value is negative for debits, error is set if the statement entry is unusable.
+        end_to_end_id, return_reason and sequence_type are set for failed SEPA-DD collections. '''
+    __slots__ = ('date', 'partner', 'iban', 'value', 'currency', 'reference', 'reference_number', 'note', 'error',
+                 'end_to_end_id', 'return_reason', 'sequence_type')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+
+class StatementError(Exception):
+    pass
+
+# everything a broken upload can raise while it is parsed
+parse_errors = (StatementError, json.JSONDecodeError, ElementTree.ParseError, csv.Error, UnicodeDecodeError)
+
+parsers = {}
+
+def statement_parser(name, label):
+    ''' register function(stream) yielding Transactions for the binary stream of a statement '''
+    def register(function):
+        parsers[name] = (label, function)
+        return function
+    return register
+
+def detect(stream):
+    head = stream.read(512).lstrip(codecs.BOM_UTF8 + b' \t\r\n')
+    stream.seek(0)
+    if head.startswith(b'['):
+        return 'erste'
+    if head.startswith(b'<'):
+        return 'camt'
+    return 'csv'
+
+def read_statement(stream, format='auto'):
+    ''' Transactions of the statement, parsed while they are read '''
+    if format == 'auto':
+        format = detect(stream)
+    if format not in parsers:
+        raise StatementError("unknown statement format %s" % format)
+    return parsers[format][1](stream)
+
+
+_number_tail = re.compile(r'[0-9.eE+-]*$')
+
+def iter_json_array(stream, size=65536):
+    ''' elements of the JSON array in the binary stream, parsed one by one
+        while reading it in blocks of size bytes '''
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def more():
+        nonlocal buf, pos, eof
+        data = stream.read(size)
+        eof = not data
+        buf = buf[pos:] + utf8.decode(data, final=eof)
+        pos = 0
+        return not eof
+
+    def skip():
+        # position of the next non-whitespace character, None at the end
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not more():
+                return None
+
+    if skip() != '[':
+        raise json.JSONDecodeError("Expecting '['", buf, pos)
+    pos += 1
+    if skip() == ']':
+        return
+    while True:
+        if skip() is None:
+            raise json.JSONDecodeError("Expecting value", buf, pos)
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more()
+                continue
+            # a number may go on in the next block, 1.5e10 parses as 1 from "1."
+            if not eof and _number_tail.match(buf, end):
+                more()
+                continue
+            break
+        pos = end
+        yield value
+        c = skip()
+        if c == ']':
+            return
+        if c != ',':
+            raise json.JSONDecodeError("Expecting ',' delimiter", buf, pos)
+        pos += 1
+
+
+@statement_parser('erste', 'Erste Bank JSON')
+def parse_erste(stream):
+    for data in iter_json_array(stream):
+        fields = {}
+        try:
+            fields['date'] = parse(data['booking'])
+            fields['partner'] = data['partnerName']
+            fields['iban'] = data['partnerAccount']['iban']
+            fields['currency'] = data['amount']['currency']
+            fields['value'] = (data['amount']['value'] / 10 ** int(data['amount']['precision']))
+            fields['reference'] = data['reference']
+            fields['reference_number'] = data['referenceNumber']
+            fields['note'] = data['note']
+        except KeyError as e:
+            fields['error'] = "ERROR: missing JSON data: %s" % e
+        yield Transaction(**fields)
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def _find(elem, path):
+    ''' first element along path of names, any namespace '''
+    for name in path.split('/'):
+        if elem is None:
+            return None
+        elem = next((c for c in elem if _local(c.tag) == name), None)
+    return elem
+
+def _findall(elem, path):
+    parent, name = path.rsplit('/', 1)
+    parent = _find(elem, parent)
+    return [c for c in parent if _local(c.tag) == name] if parent is not None else []
+
+def _text(elem, *paths):
+    for path in paths:
+        found = _find(elem, path)
+        if found is not None and found.text and found.text.strip():
+            return found.text.strip()
+    return None
+
+def _camt_transactions(entry):
+    status = _text(entry, 'Sts/Cd', 'Sts')
+    if status and status != 'BOOK':
+        return
+    debit = _text(entry, 'CdtDbtInd') == 'DBIT'
+    party = 'Cdtr' if debit else 'Dbtr'
+    date = _text(entry, 'BookgDt/DtTm', 'BookgDt/Dt', 'ValDt/DtTm', 'ValDt/Dt')
+    details = [tx for d in entry if _local(d.tag) == 'NtryDtls' for tx in d if _local(tx.tag) == 'TxDtls']
+
+    # batch entries have one TxDtls per transaction, with its own amount
+    for i, tx in enumerate(details or [entry]):
+        fields = {}
+        amount = _find(tx, 'AmtDtls/TxAmt/Amt') if tx is not entry else None
+        if amount is None and len(details) <= 1:
+            amount = _find(entry, 'Amt')
+        reference_number = _text(tx, 'Refs/AcctSvcrRef') if tx is not entry else None
+        if reference_number is None and _text(entry, 'AcctSvcrRef'):
+            reference_number = _text(entry, 'AcctSvcrRef') + ('/%d' % i if len(details) > 1 else '')
+
+        fields['partner'] = _text(tx, 'RltdPties/%s/Nm' % party, 'RltdPties/%s/Pty/Nm' % party)
+        fields['iban'] = _text(tx, 'RltdPties/%sAcct/Id/IBAN' % party)
+        fields['reference'] = ' '.join(e.text.strip() for e in _findall(tx, 'RmtInf/Ustrd') if e.text) or \
+            _text(tx, 'RmtInf/Strd/CdtrRefInf/Ref', 'AddtlTxInf') or _text(entry, 'AddtlNtryInf')
+        fields['reference_number'] = reference_number or _text(tx, 'Refs/TxId', 'Refs/EndToEndId')
+        if tx is not entry:
+            fields['end_to_end_id'] = _text(tx, 'Refs/EndToEndId')
+            fields['return_reason'] = _text(tx, 'RtrInf/Rsn/Cd', 'RtrInf/Rsn/Prtry')
+        try:
+            fields['date'] = parse(date)
+            fields['currency'] = amount.get('Ccy')
+            fields['value'] = Decimal(amount.text.strip()) * (-1 if debit else 1)
+        except (TypeError, AttributeError, ValueError, InvalidOperation, OverflowError):
+            fields['error'] = "ERROR: no booking date or amount"
+        yield Transaction(**fields)
+
+@statement_parser('camt', 'ISO 20022 CAMT.053/054 XML')
+def parse_camt(stream):
+    ''' Ntry elements of bank to customer statements (camt.053) and notifications (camt.054) '''
+    for event, elem in ElementTree.iterparse(stream, events=('end',)):
+        if _local(elem.tag) == 'Ntry':
+            yield from _camt_transactions(elem)
+            elem.clear()
+
+
+def parse_pain002(stream):
+    ''' rejected transactions of payment status reports (pain.002), the status is
+        taken from the payment information block if the transaction has none '''
+    block_status = None
+    for event, elem in ElementTree.iterparse(stream, events=('end',)):
+        tag = _local(elem.tag)
+        if tag == 'PmtInfSts':
+            block_status = (elem.text or '').strip()
+        elif tag == 'OrgnlPmtInfAndSts':
+            block_status = None
+            elem.clear()
+        elif tag == 'TxInfAndSts':
+            if (_text(elem, 'TxSts') or block_status) == 'RJCT':
+                fields = {}
+                fields['end_to_end_id'] = _text(elem, 'OrgnlEndToEndId')
+                fields['return_reason'] = _text(elem, 'StsRsnInf/Rsn/Cd', 'StsRsnInf/Rsn/Prtry')
+                fields['sequence_type'] = _text(elem, 'OrgnlTxRef/PmtTpInf/SeqTp')
+                fields['partner'] = _text(elem, 'OrgnlTxRef/Dbtr/Nm', 'OrgnlTxRef/Dbtr/Pty/Nm')
+                fields['iban'] = _text(elem, 'OrgnlTxRef/DbtrAcct/Id/IBAN')
+                fields['reference'] = _text(elem, 'OrgnlTxRef/RmtInf/Ustrd')
+                date = _text(elem, 'OrgnlTxRef/ReqdColltnDt')
+                amount = _find(elem, 'OrgnlTxRef/Amt/InstdAmt')
+                try:
+                    fields['date'] = parse(date) if date else None
+                    if amount is not None:
+                        fields['currency'] = amount.get('Ccy')
+                        fields['value'] = -Decimal(amount.text.strip())
+                except (AttributeError, ValueError, InvalidOperation, OverflowError):
+                    fields['error'] = "ERROR: invalid collection date or amount"
+                if not fields['end_to_end_id']:
+                    fields['error'] = "ERROR: no end-to-end ID"
+                yield Transaction(**fields)
+            elem.clear()
+
+def read_returns(stream):
+    ''' failed SEPA-DD collections: rejects of a pain.002 status report or
+        debits with an end-to-end ID of a camt.053/054 statement '''
+    head = stream.read(4096)
+    stream.seek(0)
+    if b'CstmrPmtStsRpt' in head:
+        return parse_pain002(stream)
+    return (tx for tx in parse_camt(stream)
+            if tx.end_to_end_id and (tx.error or tx.value < 0))
+
+
+def _csv_amount(text):
+    ''' 1.234,56 or 1,234.56, the last separator is the decimal one '''
+    text = text.replace(' ', '').replace('\xa0', '')
+    if ',' in text and '.' in text:
+        if text.rfind(',') > text.rfind('.'):
+            text = text.replace('.', '').replace(',', '.')
+        else:
+            text = text.replace(',', '')
+    elif ',' in text:
+        text = text.replace(',', '.')
+    return Decimal(text)
+
+@statement_parser('csv', 'Bank CSV')
+def parse_csv(stream):
+    ''' one transaction per line, the columns are configured in FF_HOUSING_IMPORT_CSV.
+        without a reference number column a hash of the line and its line number is used,
+        identical lines of one statement are different payments. '''
+    config = app.config.get('FF_HOUSING_IMPORT_CSV', {})
+    lines = codecs.iterdecode(stream, config.get('encoding', 'utf-8-sig'))
+    reader = csv.reader(lines, delimiter=config.get('delimiter', ';'))
+    header = next(reader, None)
+    if header is None:
+        return
+    header = [h.strip() for h in header]
+    columns = {}
+    for field, name in config.get('columns', {}).items():
+        if name in header:
+            columns[field] = header.index(name)
+    if 'value' not in columns or 'date' not in columns:
+        raise StatementError("CSV header needs the columns %s and %s" % (
+            config.get('columns', {}).get('date'), config.get('columns', {}).get('value')))
+
+    for row in reader:
+        if not any(row):
+            continue
+        fields = dict((field, row[i].strip() or None) for field, i in columns.items() if i < len(row))
+        if not fields.get('currency'):
+            fields['currency'] = config.get('currency', 'EUR')
+        if 'reference_number' not in columns:
+            line = '\x1f'.join([str(reader.line_num)] + row)
+            fields['reference_number'] = 'csv-' + hashlib.sha1(line.encode('utf-8')).hexdigest()[:20]
+        try:
+            fields['date'] = parse(fields['date'], dayfirst=config.get('dayfirst', True))
+            fields['value'] = _csv_amount(fields['value'])
+        except (TypeError, KeyError, ValueError, InvalidOperation, OverflowError):
+            fields['error'] = "ERROR: no valid date or amount in line %d" % reader.line_num
+            fields['date'] = fields['value'] = None
+        yield Transaction(**fields)
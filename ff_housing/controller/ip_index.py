@@ -0,0 +1,176 @@
+import ipaddress, threading, time
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from ff_housing import app, model, db
+
+
+class PrefixIndex:
+    ''' longest prefix match over networks of both ip versions.
+        one hash table per prefix length, a lookup masks the address
+        with every used prefix length, longest first. '''
+
+    def __init__(self):
+        self.tables = {4: {}, 6: {}}
+        self.lengths = {4: [], 6: []}
+
+    def add(self, network, value):
+        table = self.tables[network.version].setdefault(network.prefixlen, {})
+        table[int(network.network_address)] = value
+        self.lengths[network.version] = sorted(self.tables[network.version], reverse=True)
+
+    def remove(self, network):
+        table = self.tables[network.version].get(network.prefixlen, {})
+        table.pop(int(network.network_address), None)
+        if not table:
+            self.tables[network.version].pop(network.prefixlen, None)
+            self.lengths[network.version] = sorted(self.tables[network.version], reverse=True)
+
+    def get(self, network):
+        return self.tables[network.version].get(network.prefixlen, {}).get(int(network.network_address))
+
+    def lookup(self, address):
+        bits = address.max_prefixlen
+        addr = int(address)
+        tables = self.tables[address.version]
+        for prefixlen in self.lengths[address.version]:
+            key = (addr >> (bits - prefixlen)) << (bits - prefixlen)
+            value = tables.get(prefixlen, {}).get(key)
+            if value is not None:
+                return value
+        return None
+
+    def __len__(self):
+        return sum(len(t) for v in self.tables.values() for t in v.values())
+
+
+class IPIndex:
+    ''' IP ids by host address and by routed subnet.
+        kept current by the IP mapper events of committed transactions within
+        this process. rebuilt from the database in the background after
+        WHOIS_INDEX_TTL seconds to pick up changes made by other processes,
+        lookups use the old index meanwhile. '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = None
+        self.subnets = None
+        self.built = 0
+        self.rebuilding = False
+        # changes made while a build reads the database, replayed on its result
+        self.journals = []
+
+    def build(self):
+        journal = []
+        with self.lock:
+            self.journals.append(journal)
+        try:
+            hosts = {}
+            subnets = PrefixIndex()
+            for id, ip_address, routed_subnet in db.session.query(
+                    model.IP.id, model.IP.ip_address, model.IP.routed_subnet).order_by(model.IP.id.desc()):
+                hosts[ipaddress.ip_interface(ip_address).ip] = id
+                if routed_subnet:
+                    subnets.add(ipaddress.ip_network(routed_subnet), id)
+            with self.lock:
+                for change, args in journal:
+                    change(hosts, subnets, *args)
+                self.hosts = hosts
+                self.subnets = subnets
+                self.built = time.monotonic()
+        finally:
+            with self.lock:
+                self.journals.remove(journal)
+
+    def _rebuild(self):
+        try:
+            with app.app_context():
+                self.build()
+        finally:
+            self.rebuilding = False
+
+    def _current(self):
+        if self.hosts is None:
+            self.build()
+        elif time.monotonic() - self.built > app.config.get('WHOIS_INDEX_TTL', 300):
+            with self.lock:
+                if self.rebuilding:
+                    return
+                self.rebuilding = True
+            threading.Thread(target=self._rebuild, daemon=True).start()
+
+    def find_host(self, ip):
+        self._current()
+        return self.hosts.get(ipaddress.ip_address(ip))
+
+    def find_subnet(self, ip):
+        self._current()
+        return self.subnets.lookup(ipaddress.ip_address(ip))
+
+    @staticmethod
+    def _add(hosts, subnets, id, ip_address, routed_subnet):
+        if ip_address:
+            hosts[ipaddress.ip_interface(ip_address).ip] = id
+        if routed_subnet:
+            subnets.add(ipaddress.ip_network(routed_subnet), id)
+
+    @staticmethod
+    def _remove(hosts, subnets, id, ip_address, routed_subnet):
+        if ip_address and hosts.get(ipaddress.ip_interface(ip_address).ip) == id:
+            del hosts[ipaddress.ip_interface(ip_address).ip]
+        if routed_subnet:
+            network = ipaddress.ip_network(routed_subnet)
+            if subnets.get(network) == id:
+                subnets.remove(network)
+
+    def _change(self, change, *args):
+        with self.lock:
+            for journal in self.journals:
+                journal.append((change, args))
+            if self.hosts is not None:
+                change(self.hosts, self.subnets, *args)
+
+    def add(self, id, ip_address, routed_subnet):
+        self._change(self._add, id, ip_address, routed_subnet)
+
+    def remove(self, id, ip_address, routed_subnet):
+        self._change(self._remove, id, ip_address, routed_subnet)
+
+ip_index = IPIndex()
+
+
+# flushed changes wait in the session until they are committed
+def _pending(target, change, *args):
+    session = inspect(target).session
+    if session is None:
+        change(*args)
+    else:
+        session.info.setdefault('ip_index', []).append((change, args))
+
+@event.listens_for(model.IP, 'after_insert')
+def _ip_after_insert(mapper, connection, target):
+    _pending(target, ip_index.add, target.id, target.ip_address, target.routed_subnet)
+
+@event.listens_for(model.IP, 'after_update')
+def _ip_after_update(mapper, connection, target):
+    state = inspect(target)
+    for attr in ('ip_address', 'routed_subnet'):
+        for old in state.attrs[attr].history.deleted or ():
+            if attr == 'ip_address':
+                _pending(target, ip_index.remove, target.id, old, None)
+            else:
+                _pending(target, ip_index.remove, target.id, None, old)
+    _pending(target, ip_index.add, target.id, target.ip_address, target.routed_subnet)
+
+@event.listens_for(model.IP, 'after_delete')
+def _ip_after_delete(mapper, connection, target):
+    _pending(target, ip_index.remove, target.id, target.ip_address, target.routed_subnet)
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for change, args in session.info.pop('ip_index', ()):
+        change(*args)
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('ip_index', None)
@@ -1,15 +1,84 @@
 from ff_housing import app, mail, manager, model, db
 
 from flask import Response
-import json, re
-from dateutil.parser import parse
+from sqlalchemy import select
+import ipaddress, re
 from datetime import datetime
 
+from ff_housing.controller.bankstatement import read_statement, parse_errors
+
+class PaymentIndex():
+    ''' everything payments are matched against, loaded once per import '''
+
+    class Contact():
+        def __init__(self, user, billing):
+            self.id = user.id
+            self.name = str(user)
+            self.billing = billing
+
+        def __str__(self):
+            return self.name
+
+    def __init__(self):
+        billing = set(c for c, in db.session.query(model.Contract.billing_c_id).distinct())
+        self.users = {}
+        self.ibans = {}
+        for user in model.User.query:
+            contact = self.users[user.id] = self.Contact(user, user.id in billing)
+            if user.sepa_iban:
+                self.ibans[user.sepa_iban] = contact
+
+        # billing contact by IPv4 host address, the first IP of an address wins
+        self.ipv4 = {}
+        for address, contact in db.session.query(model.IP.ip_address, model.Server.billing_c_id) \
+                .join(model.IP.server).order_by(model.IP.id):
+            address = ipaddress.ip_interface(address).ip
+            if address.version == 4:
+                self.ipv4.setdefault(str(address), self.users.get(contact))
+
+        self.references = set(r for r, in db.session.query(model.Payment.reference).filter(
+            model.Payment.reference != None))
+
+    def ip(self, address):
+        try:
+            return self.ipv4.get(str(ipaddress.IPv4Address(address)))
+        except ValueError:
+            return None
+
+
+def insert_payments(rows):
+    ''' insert payment rows in one statement, skipping references that exist already.
+        returns the references of the inserted rows, None if rows without one were inserted. '''
+    t = model.Payment.__table__
+    connection = db.session.connection()
+    if not rows:
+        return set()
+    insert = model.dialect_insert(connection, t).values(rows).on_conflict_do_nothing(
+        index_elements=[t.c.reference])
+    references = set(row['reference'] for row in rows)
+    if connection.dialect.name == 'postgresql':
+        inserted = set(reference for reference, in connection.execute(insert.returning(t.c.reference)))
+    else:
+        # no RETURNING, the references existing before the insert are the skipped ones
+        existing = set(reference for reference, in connection.execute(
+            select([t.c.reference]).where(t.c.reference.in_(references - {None}))))
+        connection.execute(insert)
+        inserted = references - existing
+    # the first row of a reference repeated within rows is the inserted one
+    balance_rows, seen = [], set()
+    for row in rows:
+        if row['reference'] in inserted and (row['reference'] is None or row['reference'] not in seen):
+            seen.add(row['reference'])
+            balance_rows.append(row)
+    model.payments_inserted(connection, balance_rows)
+    return inserted
+
+
 class PaymentsImporter():
-    class ErstePaymentImport():
+    class PaymentImport():
         class InconsistentUser(Exception):
             pass
-        def __init__(self, payment_data, dryrun, job):
+        def __init__(self, transaction, dryrun, job, index):
             self.payment_date = None
             self.payment_partner = None
             self.payment_iban = None
@@ -30,34 +99,37 @@ class PaymentsImporter():
             self.ignored = False
             self.dryrun = dryrun
             self.job = job
+            self.index = index
 
             self.error = False
             self.error_msg = ''
 
-            if self.parse(payment_data):
+            if self.parse(transaction):
                 self.findIBAN()
                 self.findIP()
                 self.findUserID()
                 self.parseNoteOverride()
                 self.process()
 
-        def parse(self, data):
-            try:
-                self.payment_date = parse(data['booking'])
-                self.payment_date_str = self.payment_date.strftime("%d.%m.%Y %H:%M")
-                self.payment_partner = data['partnerName']
-                self.payment_iban = data['partnerAccount']['iban']
-                self.payment_currency = data['amount']['currency']
-                self.payment_value = (data['amount']['value'] / 10 ** int(data['amount']['precision']))
+        def parse(self, tx):
+            self.payment_date = tx.date
+            self.payment_date_str = tx.date.strftime("%d.%m.%Y %H:%M") if tx.date else None
+            self.payment_partner = tx.partner
+            self.payment_iban = tx.iban
+            self.payment_currency = tx.currency
+            self.payment_value = tx.value
+            if tx.value is not None:
                 self.payment_value_str = "%.2f %s" % (self.payment_value, self.payment_currency)
-                self.payment_reference = data['reference']
-                self.payment_referenceNum = data['referenceNumber']
-                self.payment_note = data['note']
+            self.payment_reference = tx.reference
+            self.payment_referenceNum = tx.reference_number
+            self.payment_note = tx.note
 
-            except KeyError as e:
+            if tx.error:
                 self.error = True
-                self.error_msg = "ERROR: missing JSON data: %s" % e
+                self.error_msg = tx.error
                 return False
+            if self.payment_reference is None:
+                self.payment_reference = ''
             if self.payment_currency != "EUR":
                 self.error = True
                 self.error_msg = "ERROR: Currency not EUR (%s)" % self.payment_currency
@@ -97,19 +169,19 @@ class PaymentsImporter():
                 raise self.InconsistentUser("not matching: %s " % src)
 
         def findIBAN(self):
-            user = model.User.query.filter_by(sepa_iban=self.payment_iban).first()
+            user = self.index.ibans.get(self.payment_iban)
             if user:
                 self.found_weak = False
                 self.found['iban'] = user
 
         def findIP(self):
             for ip in re.findall('(?:[\d]{1,3})\.(?:[\d]{1,3})\.(?:[\d]{1,3})\.(?:[\d]{1,3})', self.payment_reference):
-                ip = model.IP.query.filter(model.IP.ip_address.like(ip+"/_%")).first()
-                if ip and ip.server:
+                user = self.index.ip(ip)
+                if user:
                     if 'ip' not in self.found:
-                        self.found['ip'] = ip.server.billing_c
+                        self.found['ip'] = user
                     else:
-                        if self.found['ip'] != ip.server.billing_c:
+                        if self.found['ip'] != user:
                             self.error = True
                             self.error_msg += "found multiple IPs with different User!"
                             return False
@@ -118,7 +190,7 @@ class PaymentsImporter():
             m = re.search(r"(?i)Housing-k(\d+)", self.payment_reference)
             if m:
                 self.found_weak = False
-                self.found['uid'] = model.User.byID(int(m.group(1)))
+                self.found['uid'] = self.index.users.get(int(m.group(1)))
 
         def parseNoteOverride(self):
             if self.payment_note == "ignore":
@@ -129,17 +201,17 @@ class PaymentsImporter():
                 if m:
                     self.found_weak = False
                     self.forced = True
-                    self.user = model.User.byID(int(m.group(1)))
+                    self.user = self.index.users.get(int(m.group(1)))
                     self.error_msg += "forced by Note. "
 
         def checkImported(self):
-            if model.Payment.query.filter_by(reference=self.payment_referenceNum).first():
+            if self.payment_referenceNum in self.index.references:
                 self.ignored = True
                 self.user = None
 
         def checkUser(self):
             # check if user is billing_c of any servers
-            if len(self.user.contracts) <= 0 :
+            if not self.user.billing:
                 self.error = True
                 self.error_msg = "User is not a billing contact of any server."
                 return False
@@ -151,15 +223,19 @@ class PaymentsImporter():
             self.imported = True
 
             if not self.dryrun:
-                payment = model.Payment(
-                                        contact = self.user,
-                                        amount = self.payment_value,
-                                        date    = self.payment_date,
-                                        reference = self.payment_referenceNum,
-                                        job     = self.job,
-                                        detail  = self.payment_reference,
-                                        payment_type = self.payment_type)
-                db.session.add(payment)
+                # inserted with the chunk by insert_payments
+                self.index.references.add(self.payment_referenceNum)
+
+        def payment_row(self):
+            return {
+                'contact_id': self.user.id,
+                'amount': self.payment_value,
+                'date': self.payment_date,
+                'reference': model.Payment.validate_reference(None, 'reference', self.payment_referenceNum),
+                'job_id': self.job.id if self.job else None,
+                'detail': self.payment_reference,
+                'payment_type': self.payment_type,
+                'created_at': datetime.utcnow() }
 
         def formatList(self):
             # ['Partner', 'Date', 'Value', 'Reference', 'Note', 'Imported']
@@ -172,115 +248,144 @@ class PaymentsImporter():
                 self.error_msg
                 ]
 
-    # /class ErstePaymentImport
+    # /class PaymentImport
 
-    def __init__(self, file, job=None):
+    def __init__(self, file, job=None, format='auto'):
         self.file = file
-        self.payments = []
         self.job = job
+        self.format = format
+        self.count = 0
+        self.index = None
+        self.p_imported = []
+        self.p_error = []
+        self.p_ignored = []
+        self.p_unknown = []
 
 
     def readfile(self):
-        return json.loads(self.file.stream.read().decode('utf-8'))
+        return read_statement(self.file.stream, self.format)
 
     def importResponse(self, view, dryrun=True):
         try:
             data = self.readfile()
             self.processPayments(data, dryrun)
-        except json.JSONDecodeError as e:
+        except parse_errors as e:
             return view.render(template='admin/error.html',
-                               header='Error Parsing JSON',
-                               msg=str(e))
+                               header='Error Parsing Statement',
+                               msg="%s (after %d payments)" % (e, self.count))
         tables = []
         return view.render(template='admin/payment_import_list.html',
                         tables=self.gen_view_tables())
 
     def processPayments(self, payments, dryrun):
+        # chunk by chunk, only the result rows are kept
+        size = int(app.config.get('FF_HOUSING_IMPORT_CHUNK', 500))
+        chunk = []
         for p in payments:
-            self.payments.append(self.ErstePaymentImport(p, dryrun=dryrun, job=self.job))
+            chunk.append(p)
+            if len(chunk) >= size:
+                self.processChunk(chunk, dryrun)
+                chunk = []
+        self.processChunk(chunk, dryrun)
+
+    def processChunk(self, payments, dryrun):
+        if self.index is None:
+            self.index = PaymentIndex()
+        results = [self.PaymentImport(p, dryrun=dryrun, job=self.job, index=self.index) for p in payments]
+        self.count += len(results)
         if not dryrun:
+            if self.job:
+                db.session.flush()
+            imported = [(p, p.payment_row()) for p in results if p.imported]
+            inserted = insert_payments([row for p, row in imported])
+            for p, row in imported:
+                if row['reference'] not in inserted:
+                    # imported by someone else meanwhile
+                    p.imported = False
+                    p.ignored = True
             db.session.commit()
+        for p in results:
+            self.add_result(p)
 
-
-    def gen_view_tables(self):
-        p_imported = []
-        p_error = []
-        p_ignored = []
-        p_unknown = []
-
-        for p in self.payments:
-            if p.imported:
-                if p.bounce:
-                    p_imported.append({
-                    'columns': [
-                            p.user,
-                            p.payment_partner,
-                            p.payment_date_str,
-                            p.payment_value_str,
-                            p.payment_reference,
-                            p.error_msg
-                            ],
-                    'class': 'danger'
-                        })
-                elif p.found_weak:
-                    p_imported.append({
-                    'columns': [
-                            p.user,
-                            p.payment_partner,
-                            p.payment_date_str,
-                            p.payment_value_str,
-                            p.payment_reference,
-                            p.error_msg
-                            ],
-                    'class': 'warning small'
-                        })
-                else:
-                    p_imported.append({
-                    'columns': [
-                            p.user,
-                            p.payment_partner,
-                            p.payment_date_str,
-                            p.payment_value_str,
-                            p.payment_reference,
-                            p.error_msg
-                            ],
-                    'class': 'success small'
-                        })
-            elif p.error:
-                p_error.append({
+    def add_result(self, p):
+        if p.imported:
+            if p.bounce:
+                self.p_imported.append({
                 'columns': [
-                            p.user,
-                            p.payment_partner,
-                            p.payment_date_str,
-                            p.payment_value_str,
-                            p.payment_reference,
-                            p.error_msg
-                            ],
-                'class': 'danger small'
+                        str(p.user),
+                        p.payment_partner,
+                        p.payment_date_str,
+                        p.payment_value_str,
+                        p.payment_reference,
+                        p.error_msg
+                        ],
+                'class': 'danger'
+                    })
+            elif p.found_weak:
+                self.p_imported.append({
+                'columns': [
+                        str(p.user),
+                        p.payment_partner,
+                        p.payment_date_str,
+                        p.payment_value_str,
+                        p.payment_reference,
+                        p.error_msg
+                        ],
+                'class': 'warning small'
                     })
-            elif p.ignored:
-                p_ignored.append({
-                    'columns': [
-                            p.user,
-                            p.payment_partner,
-                            p.payment_date_str,
-                            p.payment_value_str,
-                            p.payment_reference
-                            ],
-                    'class': 'info small'
-                        })
             else:
-                p_unknown.append({
-                    'columns': [
-                            p.payment_partner,
-                            p.payment_date_str,
-                            p.payment_value_str,
-                            p.payment_reference,
-                            p.payment_iban,
-                            p.error_msg
-                            ],
-                    'class': 'warning small'
-                        })
+                self.p_imported.append({
+                'columns': [
+                        str(p.user),
+                        p.payment_partner,
+                        p.payment_date_str,
+                        p.payment_value_str,
+                        p.payment_reference,
+                        p.error_msg
+                        ],
+                'class': 'success small'
+                    })
+        elif p.error:
+            self.p_error.append({
+            'columns': [
+                        str(p.user),
+                        p.payment_partner,
+                        p.payment_date_str,
+                        p.payment_value_str,
+                        p.payment_reference,
+                        p.error_msg
+                        ],
+            'class': 'danger small'
+                })
+        elif p.ignored:
+            self.p_ignored.append({
+                'columns': [
+                        str(p.user),
+                        p.payment_partner,
+                        p.payment_date_str,
+                        p.payment_value_str,
+                        p.payment_reference
+                        ],
+                'class': 'info small'
+                    })
+        else:
+            self.p_unknown.append({
+                'columns': [
+                        p.payment_partner,
+                        p.payment_date_str,
+                        p.payment_value_str,
+                        p.payment_reference,
+                        p.payment_iban,
+                        p.error_msg
+                        ],
+                'class': 'warning small'
+                    })
+
+    def gen_view_tables(self):
+        p_imported = self.p_imported
+        p_error = self.p_error
+        p_ignored = self.p_ignored
+        p_unknown = self.p_unknown
 
         return (
                 {
@@ -0,0 +1,87 @@
+import hashlib, os, time
+from shutil import copyfile
+
+from ff_housing import app
+
+
+class PdfCache:
+    ''' PDFs built from LaTeX sources, stored by a hash of the rendered source
+        and the template assets (logos, ...) used to build it. '''
+
+    def __init__(self, templatedir):
+        self.templatedir = templatedir
+        self.hits = 0
+        self.misses = 0
+        self._assets = None
+
+    @property
+    def path(self):
+        return '%s/cache/pdf' % app.config.get('FF_HOUSING_FILES_DIR', './files/').rstrip('/')
+
+    @property
+    def assets(self):
+        # hashed once per process, assets only change with a new release
+        if self._assets is None:
+            h = hashlib.sha256()
+            for root, dirs, files in sorted(os.walk(self.templatedir)):
+                for name in sorted(files):
+                    with open(os.path.join(root, name), mode='rb') as fp:
+                        h.update(name.encode('utf-8'))
+                        h.update(fp.read())
+            self._assets = h.hexdigest()
+        return self._assets
+
+    def entry(self, source):
+        key = hashlib.sha256(("%s\n%s" % (self.assets, source)).encode('utf-8')).hexdigest()
+        return '%s/%s/%s.pdf' % (self.path, key[:2], key)
+
+    def get(self, source, path):
+        ''' copy the cached PDF of source to path, returns False if it has not been built yet '''
+        entry = self.entry(source)
+        if not os.path.isfile(entry):
+            self.misses += 1
+            return False
+        os.utime(entry)
+        if os.path.abspath(path) != os.path.abspath(entry):
+            copyfile(entry, path)
+        self.hits += 1
+        return True
+
+    def put(self, source, path):
+        ''' store the PDF built from source at path, evict() once after a run of puts '''
+        entry = self.entry(source)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        copyfile(path, entry + '.tmp')
+        os.replace(entry + '.tmp', entry)
+
+    def evict(self):
+        ''' remove entries older than FF_HOUSING_PDF_CACHE_DAYS,
+            then the least recently used beyond FF_HOUSING_PDF_CACHE_SIZE bytes.
+            walks the whole cache, call it once per run and not per entry. '''
+        max_age = app.config.get('FF_HOUSING_PDF_CACHE_DAYS', 90) * 86400
+        max_size = app.config.get('FF_HOUSING_PDF_CACHE_SIZE', 256 * 1024 * 1024)
+
+        entries = []
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+
+        size = sum(e[1] for e in entries)
+        now = time.time()
+        for mtime, fsize, name in sorted(entries):
+            if mtime > now - max_age and size <= max_size:
+                break
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+            size -= fsize
+
+    def __str__(self):
+        return 'pdf cache: %d hits, %d misses' % (self.hits, self.misses)
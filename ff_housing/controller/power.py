@@ -1,26 +1,91 @@
-import requests
+import requests, threading, time
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from ff_housing import app
 
 from flask_security import current_user
 
+_session = None
 
-def get_status(poweroutlet):
+def session():
+    ''' shared http session to the POWER_API, keeps connections to the PDUs open '''
+    global _session
+    if _session is None:
+        s = requests.Session()
+        s.auth = (app.config.get('POWER_USER'), app.config.get('POWER_PASS'))
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=app.config.get('POWER_CONNECTIONS', 16))
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        _session = s
+    return _session
+
+def _fetch_status(endpoint):
     try:
-        response = requests.get('%s%s' % (app.config.get('POWER_API'), poweroutlet.endpoint),
-                            auth=(
-                                app.config.get('POWER_USER'),
-                                app.config.get('POWER_PASS')
-                                )
-                            )
+        response = session().get('%s%s' % (app.config.get('POWER_API'), endpoint),
+                                 timeout=app.config.get('POWER_TIMEOUT', 5))
+        response.raise_for_status()
         status = response.json()
-    except:
+        status['powered'] = (status['state'] == 'ON')
+    except (requests.RequestException, ValueError, KeyError, TypeError):
         return None
-    if status['state'] == 'ON':
-        status['powered'] = True
-    else:
-        status['powered'] = False
     return status
 
+# outlet states by endpoint, kept for POWER_CACHE_TTL seconds.
+# concurrent requests for the same outlet wait for a single upstream call.
+_states = {}
+_pending = {}
+_lock = threading.Lock()
+
+class _PendingStatus:
+    def __init__(self):
+        self.done = threading.Event()
+        self.status = None
+
+def _cached_status(endpoint):
+    with _lock:
+        cached = _states.get(endpoint)
+        if cached and cached[0] > time.monotonic():
+            return dict(cached[1])
+        pending = _pending.get(endpoint)
+        fetching = pending is None
+        if fetching:
+            pending = _pending[endpoint] = _PendingStatus()
+
+    if fetching:
+        try:
+            pending.status = _fetch_status(endpoint)
+        finally:
+            with _lock:
+                if pending.status is not None:
+                    _states[endpoint] = (time.monotonic() + app.config.get('POWER_CACHE_TTL', 5), pending.status)
+                del _pending[endpoint]
+            pending.done.set()
+    else:
+        pending.done.wait()
+
+    return dict(pending.status) if pending.status is not None else None
+
+def _update_cached_status(endpoint, state):
+    with _lock:
+        cached = _states.get(endpoint)
+        if cached is None:
+            return
+        status = dict(cached[1], state=state, powered=(state == 'ON'))
+        _states[endpoint] = (time.monotonic() + app.config.get('POWER_CACHE_TTL', 5), status)
+
+def get_status(poweroutlet):
+    return _cached_status(poweroutlet.endpoint)
+
+def get_statuses(poweroutlets):
+    ''' status of many outlets, fetched concurrently. returns a dict by outlet id. '''
+    endpoints = [(o.id, o.endpoint) for o in poweroutlets]
+    if not endpoints:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(len(endpoints), app.config.get('POWER_CONNECTIONS', 16))) as pool:
+        statuses = pool.map(_cached_status, [e for id, e in endpoints])
+        return dict(zip([id for id, e in endpoints], statuses))
+
 def set_power(poweroutlet, powered):
     if not poweroutlet.switchable:
         return False
@@ -36,18 +101,16 @@ def set_power(poweroutlet, powered):
         data =  'ON'
     print('turning %s %s' % (poweroutlet, data))
     try:
-        response = requests.post('%s%s' % (app.config.get('POWER_API'), poweroutlet.endpoint),
+        response = session().post('%s%s' % (app.config.get('POWER_API'), poweroutlet.endpoint),
                             data = str(data),
                             headers = {'Content-Type': 'text/plain'},
-                            auth = (
-                                app.config.get('POWER_USER'),
-                                app.config.get('POWER_PASS')
-                                ),
+                            timeout = app.config.get('POWER_TIMEOUT', 5)
                             )
         if response.status_code != 200:
             print('http %d error %s' % (response.status_code, response.text) )
             return False
         status = response.text
-    except:
+    except requests.RequestException:
         return False
+    _update_cached_status(poweroutlet.endpoint, data)
     return status
@@ -0,0 +1,81 @@
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from dateutil.rrule import rrule, MONTHLY
+from decimal import Decimal
+
+from ff_housing.utils import daysofmonth
+
+# pure billing date math, does not touch the session.
+#
+# a span starts at billed_until (or the opening date of a package) and
+# ends billing_period months later on the billing day, or at closed_at.
+# amounts are prorated per month by days and rounded to cents after
+# every month, like invoices have always been calculated.
+
+def billing_span(start, billingmonthday, billing_period, closed_at=None):
+    ''' end date of the span starting at start '''
+    end = start.replace(day=billingmonthday) + relativedelta(months=+billing_period)
+    if closed_at and end > closed_at:
+        end = closed_at
+    return end
+
+def month_fractions(start, end, billingmonthday):
+    ''' fraction for each month between start and end, None for a full month '''
+    fractions = []
+    last_date = start
+    # we iterate over a list of montly dates between start and end, including both
+    billing_dates = list(rrule(MONTHLY, dtstart=start, until=end, bymonthday=billingmonthday))
+    billing_dates.append(end)
+    for next_date in billing_dates:
+        if type(next_date) is datetime:
+            next_date = next_date.date()
+
+        if last_date == next_date:
+            continue
+
+        if (last_date.day == next_date.day):
+            # full month
+            fractions.append(None)
+        elif (int(next_date.month) != int(last_date.month)):
+            # days between two months
+            fractions.append(Decimal(
+                ( daysofmonth(last_date) - (last_date.day-1) ) / daysofmonth(last_date) \
+                + ( (next_date.day-1) / daysofmonth(next_date) )
+            ))
+        else:
+            # days in same month
+            fractions.append(Decimal((next_date.day - last_date.day) / daysofmonth(next_date)))
+        last_date = next_date
+    return tuple(fractions)
+
+def prorate(amount, fractions):
+    ''' monthly amount over the given month fractions '''
+    total = 0
+    for fraction in fractions:
+        if fraction is None:
+            total += amount
+        else:
+            total += amount * fraction
+        total = total.quantize(Decimal('.01'))
+    return total
+
+def prorate_all(rows):
+    ''' prorate a batch of (start, billingmonthday, billing_period, closed_at, amount) rows.
+        returns a list of (amount, start, end) in the same order.
+
+        spans and amounts are shared between rows, a billing run mostly
+        consists of a few distinct spans and packages. '''
+    spans = {}
+    amounts = {}
+    result = []
+    for start, billingmonthday, billing_period, closed_at, amount in rows:
+        key = (start, billingmonthday, billing_period, closed_at)
+        if key not in spans:
+            end = billing_span(start, billingmonthday, billing_period, closed_at)
+            spans[key] = (end, month_fractions(start, end, billingmonthday))
+        end, fractions = spans[key]
+
+        if (fractions, amount) not in amounts:
+            amounts[(fractions, amount)] = prorate(amount, fractions)
+        result.append((amounts[(fractions, amount)], start, end))
+    return result
@@ -0,0 +1,283 @@
+import hashlib, ipaddress, json, os, threading, time
+from sqlalchemy import event, inspect, func
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+
+from ff_housing import app, model, db
+from ff_housing.controller.ip_index import PrefixIndex
+
+
+def splitlen(subnet):
+    ''' number of reverse pointer labels below the zone of subnet '''
+    if subnet.version == 4:
+        return int((subnet.max_prefixlen-(subnet.prefixlen - (subnet.prefixlen%8)) )/8)
+    return int((subnet.max_prefixlen-subnet.prefixlen)/4)
+
+def ptr_line(ip, rdns, splitlen):
+    return "%s\tPTR\t%s." % ('.'.join(ip.reverse_pointer.split('.')[:splitlen]), rdns)
+
+def zone_records(subnet):
+    ''' PTR records of all active server IPs and subnet rDNS entries within subnet '''
+    records = []
+    n = splitlen(subnet)
+
+    # get IPs
+    for ip_address, rdns in db.session.query(model.IP.ip_address, model.IP.rdns).filter(
+            model.IP.active == True,
+            model.IP.server_id != None,
+            model.IP.rdns != None,
+            model.IP.ip_address.contained_by(subnet)
+        ).order_by(model.IP.id):
+        records.append(ptr_line(ipaddress.ip_interface(ip_address).ip, rdns, n))
+
+    # get routed subnet rDNS entries
+    for ip_address, rdns in db.session.query(model.Subnet_rDNS.ip_address, model.Subnet_rDNS.rdns).join(model.IP).filter(
+            model.IP.active == True,
+            model.IP.server_id != None,
+            model.Subnet_rDNS.rdns != None,
+            model.Subnet_rDNS.ip_address.contained_by(subnet)
+        ).order_by(model.IP.id, model.Subnet_rDNS.id):
+        records.append(ptr_line(ipaddress.ip_address(ip_address), rdns, n))
+
+    return records
+
+def zone_name(subnet):
+    ''' reverse zone of subnet, 0.0.10.in-addr.arpa.
+        zones below a /24 are named RFC 2317 style, 128/25.0.0.10.in-addr.arpa '''
+    labels = subnet.network_address.reverse_pointer.split('.')
+    n = splitlen(subnet)
+    if subnet.version == 4 and subnet.prefixlen > 24:
+        return '%s/%d.%s' % (labels[0], subnet.prefixlen, '.'.join(labels[n:]))
+    return '.'.join(labels[n:])
+
+def check_zone(subnet):
+    ''' raises ValueError if subnet has no reverse zone of its own, it has to end on an
+        octet (IPv4) or nibble (IPv6) boundary or be an IPv4 zone below a /24 '''
+    if subnet.version == 4 and (subnet.prefixlen % 8 == 0 or subnet.prefixlen > 24):
+        return
+    if subnet.version == 6 and subnet.prefixlen % 4 == 0:
+        return
+    raise ValueError('reverse zone %s does not end on an %s boundary' %
+            (subnet, 'octet' if subnet.version == 4 else 'nibble'))
+
+def all_zone_records():
+    ''' PTR records of all zones, one pass over all active IPs and subnet rDNS entries.
+        the zones are RDNS_ZONES, an address belongs to the longest one containing it.
+        without RDNS_ZONES every /RDNS_ZONE_PREFIX4 and /RDNS_ZONE_PREFIX6 with records is a zone.
+        returns (zone, records) tuples sorted by address. '''
+    zones = PrefixIndex()
+    records = {}
+    for zone in app.config.get('RDNS_ZONES', []):
+        zone = ipaddress.ip_network(zone)
+        zones.add(zone, zone)
+        records[zone] = []
+    prefixlen = {4: app.config.get('RDNS_ZONE_PREFIX4', 24),
+                 6: app.config.get('RDNS_ZONE_PREFIX6', 48)}
+
+    entries = []
+    for ip_address, rdns in db.session.query(model.IP.ip_address, model.IP.rdns).filter(
+            model.IP.active == True,
+            model.IP.server_id != None,
+            model.IP.rdns != None):
+        entries.append((ipaddress.ip_interface(ip_address).ip, rdns))
+    for ip_address, rdns in db.session.query(model.Subnet_rDNS.ip_address, model.Subnet_rDNS.rdns).join(model.IP).filter(
+            model.IP.active == True,
+            model.IP.server_id != None,
+            model.Subnet_rDNS.rdns != None):
+        entries.append((ipaddress.ip_address(ip_address), rdns))
+    entries.sort(key=lambda e: (e[0].version, int(e[0])))
+
+    for ip, rdns in entries:
+        if len(zones):
+            zone = zones.lookup(ip)
+            if zone is None:
+                continue
+        else:
+            zone = ipaddress.ip_network((ip, prefixlen[ip.version]), strict=False)
+        records.setdefault(zone, []).append(ptr_line(ip, rdns, splitlen(zone)))
+
+    return sorted(records.items(), key=lambda z: (z[0].version, int(z[0].network_address), z[0].prefixlen))
+
+# reject zones which would share an include file when the config is loaded
+for zone in app.config.get('RDNS_ZONES', []):
+    check_zone(ipaddress.ip_network(zone))
+check_zone(ipaddress.ip_network(('0.0.0.0', app.config.get('RDNS_ZONE_PREFIX4', 24))))
+check_zone(ipaddress.ip_network(('::', app.config.get('RDNS_ZONE_PREFIX6', 48))))
+
+
+class Zone:
+    def __init__(self, records):
+        self.records = records
+        self.etag = hashlib.sha256('\n'.join(records).encode('utf-8')).hexdigest()[:32]
+        self.expires = time.monotonic() + app.config.get('RDNS_CACHE_TTL', 300)
+
+
+class Export:
+    def __init__(self, serial, zones):
+        self.serial = serial
+        self.zones = [(zone, Zone(records)) for zone, records in zones]
+        self.etag = hashlib.sha256(' '.join(z.etag for s, z in self.zones).encode('utf-8')).hexdigest()[:32]
+        self.expires = time.monotonic() + app.config.get('RDNS_CACHE_TTL', 300)
+
+
+class ZoneCache:
+    ''' zone fragments by requested subnet, and the export of all zones.
+        dropped by IP and Subnet_rDNS mapper events within this process,
+        rebuilt after RDNS_CACHE_TTL seconds to pick up changes made by
+        other processes. the etag is a hash of the records, so it is the
+        same in every process as long as the data is. '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.zones = {}
+        self.export = None
+
+    def get(self, subnet):
+        with self.lock:
+            zone = self.zones.get(subnet)
+        if zone is None or zone.expires < time.monotonic():
+            zone = Zone(zone_records(subnet))
+            with self.lock:
+                self.zones.pop(subnet, None)
+                while len(self.zones) >= app.config.get('RDNS_CACHE_SIZE', 1024):
+                    del self.zones[next(iter(self.zones))]
+                self.zones[subnet] = zone
+        return zone
+
+    def get_all(self):
+        export = self.export
+        if export is None or export.expires < time.monotonic():
+            # serial before the records, changes after it may be included already
+            serial = changes_serial()
+            export = self.export = Export(serial, all_zone_records())
+        return export
+
+    def invalidate(self, network):
+        with self.lock:
+            self.export = None
+            for subnet in [s for s in self.zones
+                           if s.version == network.version and s.overlaps(network)]:
+                del self.zones[subnet]
+
+zone_cache = ZoneCache()
+
+
+def zone_file(zone):
+    return '\n'.join(["; version %s" % zone.etag] + zone.records) + '\n'
+
+def export_json(export):
+    ''' all zones as one JSON document, generated zone by zone '''
+    yield '{"version": %s, "serial": %d, "zones": [' % (json.dumps(export.etag), export.serial)
+    for i, (subnet, zone) in enumerate(export.zones):
+        yield (',\n' if i else '\n') + json.dumps({
+            'zone': str(subnet),
+            'name': zone_name(subnet),
+            'version': zone.etag,
+            'records': zone.records })
+    yield '\n]}\n'
+
+def export_bind(export, directory):
+    ''' one BIND include file per zone, <zone name>.inc in directory, / in RFC 2317 names becomes -.
+        only changed files are written, include files of zones no longer exported are removed.
+        returns the number of written and removed files. '''
+    os.makedirs(directory, exist_ok=True)
+    written = 0
+    files = set()
+    for subnet, zone in export.zones:
+        name = os.path.join(directory, '%s.inc' % zone_name(subnet).replace('/', '-'))
+        files.add(name)
+        content = zone_file(zone)
+        try:
+            with open(name) as fp:
+                if fp.read() == content:
+                    continue
+        except FileNotFoundError:
+            pass
+        with open(name + '.tmp', 'w') as fp:
+            fp.write(content)
+        os.replace(name + '.tmp', name)
+        written += 1
+
+    removed = 0
+    for name in os.listdir(directory):
+        name = os.path.join(directory, name)
+        if name.endswith('.arpa.inc') and name not in files:
+            os.remove(name)
+            removed += 1
+    return written, removed
+
+
+def changes_serial():
+    ''' serial of the latest change, 0 without changes '''
+    return db.session.query(func.max(model.RDNSChange.id)).scalar() or 0
+
+def changes(since):
+    ''' PTR records added and deleted after serial since, at most RDNS_CHANGES_LIMIT.
+        returns (serial, changes, more), or None if since is unknown or the changes
+        after it were compacted away, a full export is needed then. '''
+    first, last = db.session.query(func.min(model.RDNSChange.id), func.max(model.RDNSChange.id)).first()
+    if since > (last or 0) or (first is not None and since < first - 1):
+        return None
+    limit = app.config.get('RDNS_CHANGES_LIMIT', 10000)
+    rows = model.RDNSChange.query.filter(model.RDNSChange.id > since) \
+            .order_by(model.RDNSChange.id).limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return (rows[-1].id if rows else since,
+            [{  'serial': c.id,
+                'action': c.action,
+                'address': c.ip_address,
+                'name': ipaddress.ip_address(c.ip_address).reverse_pointer,
+                'rdns': c.rdns } for c in rows],
+            more)
+
+def compact_changes(days=None):
+    ''' remove changes older than RDNS_CHANGES_DAYS, the latest change is kept for its serial '''
+    if days is None:
+        days = app.config.get('RDNS_CHANGES_DAYS', 30)
+    last = changes_serial()
+    removed = model.RDNSChange.query.filter(
+        model.RDNSChange.created_at < datetime.utcnow() - timedelta(days=int(days)),
+        model.RDNSChange.id < last).delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
+
+def _changed(target, attrs):
+    networks = set()
+    state = inspect(target)
+    for attr in attrs:
+        for value in [getattr(target, attr)] + list(state.attrs[attr].history.deleted or ()):
+            if not value:
+                continue
+            if attr == 'routed_subnet':
+                networks.add(ipaddress.ip_network(value))
+            else:
+                networks.add(ipaddress.ip_network(ipaddress.ip_interface(value).ip))
+    for network in networks:
+        zone_cache.invalidate(network)
+    # once more after commit, zones built from the old data meanwhile are stale
+    if state.session is not None:
+        state.session.info.setdefault('rdns_changed', set()).update(networks)
+
+@event.listens_for(model.IP, 'after_insert')
+@event.listens_for(model.IP, 'after_update')
+@event.listens_for(model.IP, 'after_delete')
+def _ip_changed(mapper, connection, target):
+    # routed_subnet: active and server_id of the IP show or hide its Subnet_rDNS entries
+    _changed(target, ('ip_address', 'routed_subnet'))
+
+@event.listens_for(model.Subnet_rDNS, 'after_insert')
+@event.listens_for(model.Subnet_rDNS, 'after_update')
+@event.listens_for(model.Subnet_rDNS, 'after_delete')
+def _subnet_rdns_changed(mapper, connection, target):
+    _changed(target, ('ip_address',))
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for network in session.info.pop('rdns_changed', ()):
+        zone_cache.invalidate(network)
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('rdns_changed', None)
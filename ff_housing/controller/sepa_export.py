@@ -1,10 +1,11 @@
 from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
-import re
-from sepaxml.utils import get_rand_string
-from sepaxml import SepaDD
-
-from flask_security import current_user
+from xml.sax.saxutils import XMLGenerator
+import os, re, tempfile
+from sepaxml.utils import get_rand_string, int_to_decimal_str, make_msg_id
+from sepaxml.validation import try_valid_xml
+from text_unidecode import unidecode
+from sqlalchemy.orm import contains_eager
 
 from ff_housing import app, model, db
 
@@ -17,25 +18,146 @@ def make_id(number, name):
     return name + "-" + r
 
 
+def export_queue(mandate=None):
+    ''' sent, not cancelled and not yet exported SEPA-DD invoices with their contacts,
+        mandate True or False for only those whose contact has or lacks a SEPA mandate '''
+    query = model.Invoice.query.join(model.Invoice.contact) \
+        .options(contains_eager(model.Invoice.contact)) \
+        .filter(model.Invoice.sepa_queued)
+    if mandate is not None:
+        query = query.filter(model.User.has_sepa_mandate if mandate else ~model.User.has_sepa_mandate)
+    return query.order_by(model.Invoice.id)
+
+
+def _write(xml, name, content, attrs={}):
+    ''' element name with text or a list of (name, content) children '''
+    xml.startElement(name, attrs)
+    if isinstance(content, str):
+        xml.characters(content)
+    else:
+        for child in content:
+            _write(xml, *child)
+    xml.endElement(name)
+
+
+class SepaFile:
+    ''' one pain.008 document, a payment information block per sequence type and collection date '''
+    def __init__(self, config, schema):
+        self.config = config
+        self.schema = schema
+        self.msg_id = make_msg_id()
+        self.created = datetime.now()
+        self.blocks = {}
+        self.block_ids = {}
+        self.path = None
+
+    def __len__(self):
+        return sum(len(payments) for payments in self.blocks.values())
+
+    def add_payment(self, payment):
+        key = (payment['type'], payment['collection_date'])
+        if key not in self.blocks:
+            self.blocks[key] = []
+            self.block_ids[key] = make_id(len(self.blocks), self.config['name'])
+        self.blocks[key].append(payment)
+
+    def _agent(self, bic):
+        if bic:
+            return [('FinInstnId', [('BIC' if self.schema == 'pain.008.001.02' else 'BICFI', bic)])]
+        return [('FinInstnId', [('Othr', [('Id', 'NOTPROVIDED')])])]
+
+    def _transaction(self, payment):
+        return [
+            ('PmtId', [('EndToEndId', payment['endtoend_id'])]),
+            ('InstdAmt', int_to_decimal_str(payment['amount']), {'Ccy': self.config['currency']}),
+            ('DrctDbtTx', [('MndtRltdInf', [('MndtId', payment['mandate_id']),
+                                            ('DtOfSgntr', str(payment['mandate_date']))])]),
+            ('DbtrAgt', self._agent(None)),
+            ('Dbtr', [('Nm', payment['name'])]),
+            ('DbtrAcct', [('Id', [('IBAN', payment['IBAN'])])]),
+            ('RmtInf', [('Ustrd', payment['description'])]),
+        ]
+
+    def write(self, stream):
+        ''' write the document to the binary stream, one transaction at a time.
+            the same document is written every time '''
+        config = self.config
+        xml = XMLGenerator(stream, 'UTF-8', short_empty_elements=True)
+        xml.startDocument()
+        xml.startElement('Document', {'xmlns': 'urn:iso:std:iso:20022:tech:xsd:' + self.schema,
+                                      'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance'})
+        xml.startElement('CstmrDrctDbtInitn', {})
+        _write(xml, 'GrpHdr', [
+            ('MsgId', self.msg_id),
+            ('CreDtTm', self.created.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('NbOfTxs', str(len(self))),
+            ('CtrlSum', int_to_decimal_str(sum(p['amount'] for b in self.blocks.values() for p in b))),
+            ('InitgPty', [('Nm', config['name']),
+                          ('Id', [('OrgId', [('Othr', [('Id', config['creditor_id'])])])])]),
+        ])
+        for (payment_type, collection_date), payments in self.blocks.items():
+            xml.startElement('PmtInf', {})
+            for child in [
+                    ('PmtInfId', self.block_ids[(payment_type, collection_date)]),
+                    ('PmtMtd', 'DD'),
+                    ('BtchBookg', 'true' if config['batch'] else 'false'),
+                    ('NbOfTxs', str(len(payments))),
+                    ('CtrlSum', int_to_decimal_str(sum(p['amount'] for p in payments))),
+                    ('PmtTpInf', [('SvcLvl', [('Cd', 'SEPA')]),
+                                  ('LclInstrm', [('Cd', config['instrument'])]),
+                                  ('SeqTp', payment_type)]),
+                    ('ReqdColltnDt', str(collection_date)),
+                    ('Cdtr', [('Nm', config['name'])]),
+                    ('CdtrAcct', [('Id', [('IBAN', config['IBAN'])])]),
+                    ('CdtrAgt', self._agent(config['BIC'])),
+                    ('ChrgBr', 'SLEV'),
+                    ('CdtrSchmeId', [('Id', [('PrvtId', [('Othr', [('Id', config['creditor_id']),
+                                                                   ('SchmeNm', [('Prtry', 'SEPA')])])])])])]:
+                _write(xml, *child)
+            for payment in payments:
+                _write(xml, 'DrctDbtTxInf', self._transaction(payment))
+            xml.endElement('PmtInf')
+        xml.endElement('CstmrDrctDbtInitn')
+        xml.endElement('Document')
+        xml.endDocument()
+
+    def save(self, path):
+        ''' write the document to a temporary file next to path, validate it and
+            rename it to path. the document is serialized once, straight to the file '''
+        fd, tmp = tempfile.mkstemp(prefix='.sepa_export_', suffix='.tmp', dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                self.write(fp)
+            with open(tmp, 'rb') as fp:
+                try_valid_xml(fp.read(), self.schema)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.path = path
+
+
 class SepaExport:
-    def __init__(self):
+    def __init__(self, max_transactions=None):
         self.invoices = []
+        self.files = []
         self.config = {
-            "name": app.config.get('SEPADD_CREDITOR_NAME'),
+            "name": unidecode(app.config.get('SEPADD_CREDITOR_NAME'))[:70],
             "IBAN": app.config.get('SEPADD_CREDITOR_IBAN'),
             "BIC": app.config.get('SEPADD_CREDITOR_BIC'),
             "batch": app.config.get('SEPADD_BATCH'),
             "creditor_id": app.config.get('SEPADD_CREDITOR_ID'),
             "currency": app.config.get('SEPADD_CURRENCY'),
-            "instrument": app.config.get('SEPADD_INSTRUMENT')
+            "instrument": app.config.get('SEPADD_INSTRUMENT') or 'CORE'
         }
-        self.sepa = SepaDD(self.config, schema=app.config.get('SEPADD_SCHEMA'))
+        self.schema = app.config.get('SEPADD_SCHEMA')
+        self.max_transactions = int(max_transactions or app.config.get('SEPADD_MAX_TRANSACTIONS') or 0)
 
     def __len__(self):
         return len(self.invoices)
 
     def add_invoice(self, invoice):
-        if(len(invoice.items) == 0):
+        if not invoice.total:
         # skip invoices without items
             return
 
@@ -47,9 +169,10 @@ class SepaExport:
             raise Exception( "Invoice %s: No sepa mandate for %s" % (invoice.number, invoice.contact))
         if invoice.payment_type != 'SEPA-DD':
             raise Exception( "Invoice %s: Payment Type is not SEPA-DD" % invoice.number )
+        if invoice.total < 0:
+            raise Exception( "Invoice %s: Amount is negative" % invoice.number )
 
-        if self.sepa.check_payment(self._gen_payment(invoice)):
-            self.invoices.append(invoice)
+        self.invoices.append(invoice)
 
     def _gen_payment(self, invoice):
         if  invoice.contact.sepa_mandate_first:
@@ -60,16 +183,16 @@ class SepaExport:
             collection_date = date.today() + timedelta(days=+3)
 
         payment = {
-            "name": invoice.contact.name,
+            "name": unidecode(invoice.contact.name)[:70],
             "IBAN": invoice.contact.sepa_iban,
             "mandate_id": invoice.contact.sepa_mandate_id,
             "mandate_date": invoice.contact.sepa_mandate_date,
-            "amount": int(invoice.amount * 100),
+            "amount": int(invoice.total * 100),
             "type": payment_type,  # FRST,RCUR,OOFF,FNAL
             "collection_date": collection_date,
             "endtoend_id": invoice.exported_id,
-            "description": "Funkfeuer %s%d %s" % (app.config.get('BILLING_REFERENCE_UID_PREFIX'),
-                                                                            invoice.contact.id, invoice.number)
+            "description": unidecode("Funkfeuer %s%d %s" % (app.config.get('BILLING_REFERENCE_UID_PREFIX'),
+                                                            invoice.contact.id, invoice.number))[:140]
         }
         return payment
 
@@ -79,30 +202,46 @@ class SepaExport:
 
     @property
     def msg_id(self):
-        return self.sepa.msg_id
+        return self.files[0].msg_id if self.files else None
 
-    def export(self):
+    def export(self, output, user=None):
+        ''' mark the invoices exported and write their payments to pain.008 files of at most
+            max_transactions in the directory output. the invoices are committed only after
+            every file is validated and in place, else the files are removed again and the
+            invoices stay queued. returns the SepaFiles, with the path they are saved to '''
         if len(self.invoices) < 1:
             raise Exception("no invoices to export")
 
+        self.files = []
         for invoice in self.invoices:
             if invoice.exported_id is None:
                 invoice.exported_id = make_id(invoice.number, app.config.get('SEPADD_CREDITOR_NAME'))
                 invoice.exported = True
 
-            self.sepa.add_payment(self._gen_payment(invoice))
+            if not self.files or (self.max_transactions and len(self.files[-1]) >= self.max_transactions):
+                self.files.append(SepaFile(self.config, self.schema))
+            self.files[-1].add_payment(self._gen_payment(invoice))
             if invoice.contact.sepa_mandate_first:
                invoice.contact.sepa_mandate_first = False
 
-        export = self.sepa.export()
-
-        db.session.add(model.Job(
-            type = 'sepa_export',
-            note = self.msg_id,
-            user = current_user,
-            started = datetime.utcnow(),
-            finished = datetime.utcnow()
-        ))
-        db.session.commit()
-
-        return export
+        try:
+            for f in self.files:
+                f.save(os.path.join(output, 'sepa_export_%s.xml' % f.msg_id))
+
+            db.session.add(model.Job(
+                type = 'sepa_export',
+                note = ' '.join(f.msg_id for f in self.files)[:255],
+                user = user,
+                started = datetime.utcnow(),
+                finished = datetime.utcnow()
+            ))
+            db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            for f in self.files:
+                if f.path:
+                    os.remove(f.path)
+                    f.path = None
+            raise
+
+        return self.files
@@ -0,0 +1,182 @@
+from ff_housing import app, model, db
+
+from sqlalchemy.orm import joinedload
+from datetime import datetime
+
+from ff_housing.controller.bankstatement import read_returns, parse_errors
+from ff_housing.controller.paymentimport import insert_payments
+
+
+class SepaReturnsImporter():
+    ''' failed SEPA-DD collections of pain.002 status reports and camt statements,
+        matched to the exported invoices by their end-to-end ID.
+
+        returns booked on the statement get a reversal payment with the reference
+        the payment import uses for the same entry, so neither books it twice.
+        rejects of a status report were never booked and only mark the invoice. '''
+
+    class Return():
+        def __init__(self, transaction, invoice):
+            self.tx = transaction
+            self.invoice = invoice
+            self.contact = invoice.contact if invoice else None
+            self.reason = transaction.return_reason or 'NARR'
+            self.reversal = None
+            self.first = False
+            self.reconciled = False
+            self.ignored = False
+            self.error = transaction.error
+            self.note = ''
+
+        def process(self, references, dryrun, job):
+            if self.error or self.invoice is None:
+                return
+            booked = self.tx.value is not None and self.tx.reference_number is not None
+            if self.invoice.sepa_return and (not booked or self.tx.reference_number in references):
+                self.ignored = True
+                return
+
+            self.reconciled = True
+            if booked:
+                if self.tx.reference_number in references:
+                    self.note = 'reversal already imported. '
+                else:
+                    self.reversal = self.payment_row(job)
+                    references.add(self.tx.reference_number)
+            else:
+                self.note = 'not booked. '
+            # the next collection has to be a first one again
+            if self.tx.sequence_type == 'FRST' or \
+                    self.reason in app.config.get('SEPADD_RETURN_FIRST_REASONS', ()):
+                self.first = True
+                self.note += 'next collection FRST. '
+
+            if not dryrun:
+                self.invoice.sepa_return = self.reason
+                if self.first:
+                    self.contact.sepa_mandate_first = True
+
+        def payment_row(self, job):
+            return {
+                'contact_id': self.invoice.contact_id,
+                'amount': self.tx.value,
+                'date': self.tx.date or datetime.utcnow(),
+                'reference': self.tx.reference_number,
+                'job_id': job.id if job else None,
+                'detail': 'SEPA-DD return %s of %s' % (self.reason, self.invoice.number),
+                'payment_type': 'SEPA-DD',
+                'created_at': datetime.utcnow() }
+
+        def formatList(self):
+            return [
+                self.invoice.number if self.invoice else self.tx.end_to_end_id,
+                str(self.contact) if self.contact else self.tx.partner,
+                self.tx.date.strftime("%d.%m.%Y") if self.tx.date else None,
+                "%.2f %s" % (self.tx.value, self.tx.currency) if self.tx.value is not None else None,
+                self.reason,
+                self.error or self.note
+                ]
+
+    # /class Return
+
+    def __init__(self, stream, job=None):
+        self.stream = stream
+        self.job = job
+        self.count = 0
+        self.r_reconciled = []
+        self.r_error = []
+        self.r_ignored = []
+        self.r_unknown = []
+
+    def importResponse(self, view, dryrun=True):
+        try:
+            self.processReturns(read_returns(self.stream), dryrun)
+        except parse_errors as e:
+            return view.render(template='admin/error.html',
+                               header='Error Parsing Returns',
+                               msg="%s (after %d returns)" % (e, self.count))
+        return view.render(template='admin/payment_import_list.html',
+                        tables=self.gen_view_tables())
+
+    def processReturns(self, returns, dryrun):
+        size = int(app.config.get('FF_HOUSING_IMPORT_CHUNK', 500))
+        chunk = []
+        for r in returns:
+            chunk.append(r)
+            if len(chunk) >= size:
+                self.processChunk(chunk, dryrun)
+                chunk = []
+        self.processChunk(chunk, dryrun)
+
+    def processChunk(self, transactions, dryrun):
+        # one query for the invoices and one for the reversals of the chunk
+        ids = set(tx.end_to_end_id for tx in transactions if tx.end_to_end_id)
+        invoices = {}
+        if ids:
+            for invoice in model.Invoice.query.filter(model.Invoice.exported_id.in_(ids)) \
+                    .options(joinedload(model.Invoice.contact)):
+                invoices[invoice.exported_id] = invoice
+        numbers = set(tx.reference_number for tx in transactions if tx.reference_number)
+        references = set()
+        if numbers:
+            references = set(r for r, in db.session.query(model.Payment.reference).filter(
+                model.Payment.reference.in_(numbers)))
+
+        results = [self.Return(tx, invoices.get(tx.end_to_end_id)) for tx in transactions]
+        for r in results:
+            r.process(references, dryrun, self.job)
+        self.count += len(results)
+
+        if not dryrun:
+            if self.job:
+                db.session.flush()
+            rows = [r.reversal for r in results if r.reversal]
+            inserted = insert_payments(rows)
+            for r in results:
+                if r.reversal and r.reversal['reference'] not in inserted:
+                    r.note = 'reversal already imported. ' + r.note
+        # before the commit expires the invoices and contacts
+        for r in results:
+            self.add_result(r)
+        if not dryrun:
+            db.session.commit()
+
+    def add_result(self, r):
+        row = {'columns': r.formatList()}
+        if r.error:
+            row['class'] = 'danger small'
+            self.r_error.append(row)
+        elif r.invoice is None:
+            row['class'] = 'warning small'
+            self.r_unknown.append(row)
+        elif r.ignored:
+            row['class'] = 'info small'
+            self.r_ignored.append(row)
+        else:
+            row['class'] = 'danger' if r.first else 'success small'
+            self.r_reconciled.append(row)
+
+    def gen_view_tables(self):
+        table_header = ['Invoice', 'Contact', 'Date', 'Value', 'Reason', 'Note']
+        return (
+                {
+                'header': 'Returns with errors:',
+                'table_header': table_header,
+                'rows': self.r_error
+                }, {
+                'header': 'Unknown Returns:',
+                'lead': 'No exported invoice has this end-to-end ID.',
+                'table_header': ['End-to-End ID', 'Partner', 'Date', 'Value', 'Reason', 'Note'],
+                'rows': self.r_unknown
+                }, {
+                'header': 'Reconciled Returns:',
+                'lead': 'Contacts whose next collection is a first one again are marked red.',
+                'table_header': table_header,
+                'rows': self.r_reconciled
+                }, {
+                'header': 'Ignored Returns:',
+                'lead': 'The following returns have already been reconciled.',
+                'table_header': table_header,
+                'rows': self.r_ignored
+                }
+            )
@@ -0,0 +1,44 @@
+"""add indexed next billing date of contract packages
+
+Revision ID: 1b35cc71e5cf
+Revises: 1fd8b5a4647d
+Create Date: 2026-10-18 19:12:40.826315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1b35cc71e5cf'
+down_revision = '1fd8b5a4647d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('contract_package', sa.Column('next_billing_date', sa.Date(), nullable=True))
+    op.create_index(op.f('ix_contract_package_next_billing_date'), 'contract_package', ['next_billing_date'], unique=False)
+
+    # same as ContractPackage.billing_date, computed here as date arithmetic differs between databases
+    package = sa.table('contract_package', sa.column('id', sa.Integer()), sa.column('active', sa.Boolean()),
+                       sa.column('opened_at', sa.DateTime()), sa.column('closed_at', sa.DateTime()),
+                       sa.column('billed_until', sa.Date()), sa.column('next_billing_date', sa.Date()))
+    conn = op.get_bind()
+    rows = []
+    for p in conn.execute(sa.select([package]).where(package.c.active == True)):
+        if p.billed_until is None:
+            next_billing = p.opened_at.date()
+        elif p.closed_at and p.closed_at.date() <= p.billed_until:
+            continue
+        else:
+            next_billing = max(p.opened_at.date(), p.billed_until)
+        rows.append({'package_id': p.id, 'next_billing': next_billing})
+    if rows:
+        conn.execute(package.update().where(package.c.id == sa.bindparam('package_id'))
+                     .values(next_billing_date=sa.bindparam('next_billing')), rows)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_contract_package_next_billing_date'), table_name='contract_package')
+    op.drop_column('contract_package', 'next_billing_date')
@@ -0,0 +1,26 @@
+"""add sepa return reason and index invoice.exported_id
+
+Revision ID: 1fd8b5a4647d
+Revises: 7d33a30add97
+Create Date: 2026-10-18 18:05:13.527093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1fd8b5a4647d'
+down_revision = '7d33a30add97'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('invoice', sa.Column('sepa_return', sa.Unicode(length=35), nullable=True))
+    op.create_index(op.f('ix_invoice_exported_id'), 'invoice', ['exported_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_invoice_exported_id'), table_name='invoice')
+    op.drop_column('invoice', 'sepa_return')
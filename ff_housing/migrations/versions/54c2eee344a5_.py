@@ -0,0 +1,42 @@
+"""add mail outbox
+
+Revision ID: 54c2eee344a5
+Revises: 9b3a0c054067
+Create Date: 2026-10-18 11:40:07.215360
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '54c2eee344a5'
+down_revision = '9b3a0c054067'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('mail_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('invoice_id', sa.Integer(), nullable=False),
+        sa.Column('job_id', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('recipient', sa.Unicode(length=64), nullable=False),
+        sa.Column('subject', sa.Unicode(length=255), nullable=False),
+        sa.Column('body', sa.UnicodeText(), nullable=True),
+        sa.Column('attachment', sa.Unicode(length=255), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt', sa.DateTime(), nullable=False),
+        sa.Column('sent_on', sa.DateTime(), nullable=True),
+        sa.Column('error', sa.Unicode(length=255), nullable=True),
+        sa.ForeignKeyConstraint(['invoice_id'], ['invoice.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['job_id'], ['job.id'], ondelete='SET NULL'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_mail_outbox_next_attempt'), 'mail_outbox', ['next_attempt'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_mail_outbox_next_attempt'), table_name='mail_outbox')
+    op.drop_table('mail_outbox')
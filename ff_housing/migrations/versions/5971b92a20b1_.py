@@ -0,0 +1,84 @@
+"""store ip addresses as inet/cidr
+
+Revision ID: 5971b92a20b1
+Revises: 54c2eee344a5
+Create Date: 2026-10-18 13:02:44.518270
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+import ipaddress
+
+
+# revision identifiers, used by Alembic.
+revision = '5971b92a20b1'
+down_revision = '54c2eee344a5'
+branch_labels = None
+depends_on = None
+
+
+# (table, column, kind) as in ff_housing.model.types.Inet
+columns = (
+    ('IP', 'ip_address', 'interface'),
+    ('IP', 'routed_subnet', 'network'),
+    ('subnet_rDNS', 'ip_address', 'address'),
+)
+
+def pack(value, kind):
+    if kind == 'network':
+        value = ipaddress.ip_network(value)
+        address, prefixlen = value.network_address, value.prefixlen
+    else:
+        value = ipaddress.ip_interface(value)
+        address, prefixlen = value.ip, value.network.prefixlen
+        if kind == 'address':
+            prefixlen = address.max_prefixlen
+    return bytes((address.version,)) + address.packed + bytes((prefixlen,))
+
+def unpack(value, kind):
+    address = ipaddress.ip_address(bytes(value[1:-1]))
+    if kind == 'address':
+        return str(address)
+    if kind == 'network':
+        return str(ipaddress.ip_network((address, value[-1])))
+    return str(ipaddress.ip_interface((address, value[-1])))
+
+def convert(convert_value):
+    # sqlite stores blobs in the existing varchar columns as they are,
+    # so the values are converted in place without recreating the tables
+    bind = op.get_bind()
+    for table, name, kind in columns:
+        t = sa.table(table, sa.column('id', sa.Integer()), sa.column(name))
+        for id, value in bind.execute(sa.select([t.c.id, t.c[name]]).where(t.c[name] != None)).fetchall():
+            bind.execute(t.update().where(t.c.id == id).values({name: convert_value(value, kind)}))
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.alter_column('IP', 'ip_address', type_=postgresql.INET(),
+                        existing_type=sa.String(length=48), postgresql_using='ip_address::inet')
+        op.alter_column('IP', 'routed_subnet', type_=postgresql.CIDR(),
+                        existing_type=sa.String(length=48), postgresql_using='routed_subnet::cidr')
+        op.alter_column('subnet_rDNS', 'ip_address', type_=postgresql.INET(),
+                        existing_type=sa.String(length=48), postgresql_using='ip_address::inet')
+        op.execute('CREATE INDEX ix_ip_ip_address_host_gist ON "IP" USING gist ((CAST(host(ip_address) AS inet)) inet_ops)')
+        op.execute('CREATE INDEX ix_ip_routed_subnet_gist ON "IP" USING gist (routed_subnet inet_ops)')
+        op.execute('CREATE INDEX "ix_subnet_rDNS_ip_address_gist" ON "subnet_rDNS" USING gist (ip_address inet_ops)')
+    else:
+        convert(pack)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP INDEX "ix_subnet_rDNS_ip_address_gist"')
+        op.execute('DROP INDEX ix_ip_routed_subnet_gist')
+        op.execute('DROP INDEX ix_ip_ip_address_host_gist')
+        op.alter_column('subnet_rDNS', 'ip_address', type_=sa.String(length=48),
+                        existing_type=postgresql.INET(), postgresql_using='host(ip_address)')
+        op.alter_column('IP', 'routed_subnet', type_=sa.String(length=48),
+                        existing_type=postgresql.CIDR(), postgresql_using='text(routed_subnet)')
+        op.alter_column('IP', 'ip_address', type_=sa.String(length=48),
+                        existing_type=postgresql.INET(), postgresql_using='text(ip_address)')
+    else:
+        convert(unpack)
@@ -0,0 +1,40 @@
+"""add rdns change log
+
+Revision ID: 5b4b50c8d42c
+Revises: 5971b92a20b1
+Create Date: 2026-10-18 14:21:09.663104
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5b4b50c8d42c'
+down_revision = '5971b92a20b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        ip_address = postgresql.INET()
+    else:
+        ip_address = sa.LargeBinary()
+    op.create_table('rdns_change',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('action', sa.Enum('add', 'delete', name='rdns_change_actions'), nullable=False),
+        sa.Column('ip_address', ip_address, nullable=False),
+        sa.Column('rdns', sa.String(length=255), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_rdns_change_created_at'), 'rdns_change', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_rdns_change_created_at'), table_name='rdns_change')
+    op.drop_table('rdns_change')
+    if op.get_bind().dialect.name == 'postgresql':
+        sa.Enum(name='rdns_change_actions').drop(op.get_bind(), checkfirst=False)
@@ -0,0 +1,48 @@
+"""add contact balance table
+
+Revision ID: 7c1f2e9a4d36
+Revises: 5b4b50c8d42c
+Create Date: 2026-10-18 15:08:37.214580
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1f2e9a4d36'
+down_revision = '5b4b50c8d42c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('contact_balance',
+        sa.Column('contact_id', sa.Integer(), nullable=False),
+        sa.Column('balance', sa.Numeric(precision=10, scale=2), nullable=False),
+        sa.ForeignKeyConstraint(['contact_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('contact_id')
+    )
+    op.create_index(op.f('ix_contact_balance_balance'), 'contact_balance', ['balance'], unique=False)
+
+    # payments minus sent invoices of every user
+    user = sa.table('user', sa.column('id', sa.Integer()))
+    payment = sa.table('payment', sa.column('contact_id', sa.Integer()), sa.column('amount', sa.Numeric()))
+    invoice = sa.table('invoice', sa.column('id', sa.Integer()), sa.column('contact_id', sa.Integer()),
+                       sa.column('sent_on', sa.DateTime()))
+    item = sa.table('invoice_item', sa.column('invoice_id', sa.Integer()),
+                    sa.column('unit_price', sa.Numeric()), sa.column('quantity', sa.Integer()))
+    payments = sa.select([sa.func.coalesce(sa.func.sum(payment.c.amount), 0)]) \
+        .where(payment.c.contact_id == user.c.id).as_scalar()
+    invoices = sa.select([sa.func.coalesce(sa.func.sum(item.c.unit_price * item.c.quantity), 0)]) \
+        .where(item.c.invoice_id == invoice.c.id) \
+        .where(invoice.c.contact_id == user.c.id) \
+        .where(invoice.c.sent_on != None).as_scalar()
+    balance = sa.table('contact_balance', sa.column('contact_id', sa.Integer()), sa.column('balance', sa.Numeric()))
+    op.execute(balance.insert().from_select(['contact_id', 'balance'],
+        sa.select([user.c.id, payments - invoices])))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_contact_balance_balance'), table_name='contact_balance')
+    op.drop_table('contact_balance')
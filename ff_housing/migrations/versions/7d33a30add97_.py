@@ -0,0 +1,30 @@
+"""add partial index of the sepa export queue
+
+Revision ID: 7d33a30add97
+Revises: d5e1b7a90c42
+Create Date: 2026-10-18 17:22:51.390216
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d33a30add97'
+down_revision = 'd5e1b7a90c42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # same predicate as Invoice.sepa_queued
+    invoice = sa.table('invoice', sa.column('sent_on', sa.DateTime()), sa.column('exported', sa.Boolean()),
+                       sa.column('cancelled', sa.Boolean()), sa.column('payment_type', sa.Unicode()))
+    queued = sa.and_(invoice.c.sent_on != None, invoice.c.exported == False, invoice.c.cancelled == False,
+                     invoice.c.payment_type == 'SEPA-DD')
+    op.create_index('ix_invoice_sepa_queue', 'invoice', ['id'], unique=False,
+                    postgresql_where=queued, sqlite_where=queued)
+
+
+def downgrade():
+    op.drop_index('ix_invoice_sepa_queue', table_name='invoice')
@@ -0,0 +1,24 @@
+"""add job errors
+
+Revision ID: 9b3a0c054067
+Revises: 4ceec83f3a61
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b3a0c054067'
+down_revision = '4ceec83f3a61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('job', sa.Column('errors', sa.UnicodeText(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('job', 'errors')
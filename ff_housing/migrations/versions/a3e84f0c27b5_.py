@@ -0,0 +1,30 @@
+"""add stored invoice total
+
+Revision ID: a3e84f0c27b5
+Revises: 7c1f2e9a4d36
+Create Date: 2026-10-18 15:52:11.483906
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3e84f0c27b5'
+down_revision = '7c1f2e9a4d36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('invoice', sa.Column('total', sa.Numeric(precision=10, scale=2), nullable=False, server_default='0'))
+
+    invoice = sa.table('invoice', sa.column('id', sa.Integer()), sa.column('total', sa.Numeric()))
+    item = sa.table('invoice_item', sa.column('invoice_id', sa.Integer()),
+                    sa.column('unit_price', sa.Numeric()), sa.column('quantity', sa.Integer()))
+    op.execute(invoice.update().values(total=sa.select([sa.func.coalesce(sa.func.sum(item.c.unit_price * item.c.quantity), 0)])
+        .where(item.c.invoice_id == invoice.c.id).as_scalar()))
+
+
+def downgrade():
+    op.drop_column('invoice', 'total')
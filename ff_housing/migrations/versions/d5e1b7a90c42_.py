@@ -0,0 +1,36 @@
+"""unique payment reference
+
+Revision ID: d5e1b7a90c42
+Revises: a3e84f0c27b5
+Create Date: 2026-10-18 16:40:27.905113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e1b7a90c42'
+down_revision = 'a3e84f0c27b5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    payment = sa.table('payment', sa.column('id', sa.Integer()), sa.column('reference', sa.String()))
+    op.execute(payment.update().where(payment.c.reference == '').values(reference=None))
+
+    # payments are not merged or renamed here, duplicates have to be resolved by hand
+    duplicates = op.get_bind().execute(sa.select([payment.c.reference, sa.func.count()])
+        .where(payment.c.reference != None)
+        .group_by(payment.c.reference)
+        .having(sa.func.count() > 1)).fetchall()
+    if duplicates:
+        raise Exception("duplicate payment references: %s" %
+                        ', '.join('%s (%d)' % (reference, n) for reference, n in duplicates))
+
+    op.create_index(op.f('ix_payment_reference'), 'payment', ['reference'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_payment_reference'), table_name='payment')
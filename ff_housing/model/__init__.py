@@ -1,6 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import event
+from sqlalchemy import event, inspect
 from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlite3 import Connection as SQLite3Connection
 from flask_security import current_user
 
@@ -19,6 +20,23 @@ def insert_set_created_c(mapper, connection, target):
     if(current_user.is_authenticated):
         target.created_c_id = current_user.id
 
+def _keep_old_value(target, value, oldvalue, initiator):
+    pass
+
+def keep_old_values(*attrs):
+    ''' load the replaced values of expired attributes on set, for old_value '''
+    for attr in attrs:
+        event.listen(attr, 'set', _keep_old_value, active_history=True)
+
+def old_value(target, attr):
+    ''' value of attr before the changes being flushed '''
+    history = inspect(target).attrs[attr].history
+    return history.deleted[0] if history.deleted else getattr(target, attr)
+
+def dialect_insert(connection, table):
+    ''' insert of the connection's dialect, for on_conflict_do_nothing/_do_update '''
+    return (postgresql if connection.dialect.name == 'postgresql' else sqlite).insert(table)
+
 from .user import *
 from .accounting import *
 from .server import *
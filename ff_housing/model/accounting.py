@@ -1,7 +1,8 @@
-from ..model import db, User, insert_set_created_c
+from ..model import db, User, insert_set_created_c, keep_old_values, old_value, dialect_insert
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import select, func, event, inspect
-from sqlalchemy.orm import validates
+from sqlalchemy import select, event, inspect, and_
+from sqlalchemy.orm import validates, Session
+from sqlalchemy.orm.util import identity_key
 from datetime import datetime, date
 import werkzeug.exceptions as exceptions
 from wtforms.fields import TextAreaField
@@ -16,6 +17,7 @@ class Job(db.Model):
     note = db.Column(db.Unicode(255))
     started = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
     finished = db.Column(db.DateTime())
+    errors = db.Column(db.UnicodeText())
     user_id = db.Column(db.Integer(), db.ForeignKey(User.id, ondelete='SET NULL'))
     user = db.relationship(User, foreign_keys=[user_id])
 
@@ -25,6 +27,10 @@ class Job(db.Model):
     def __str__(self):
         return str(self.id)
 
+    def log_error(self, msg):
+        print(msg)
+        self.errors = "%s%s\n" % (self.errors or '', msg)
+
 
 class Invoice(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
@@ -36,15 +42,24 @@ class Invoice(db.Model):
     created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
     cancelled = db.Column(db.Boolean(), nullable=False, default=False)
     exported = db.Column(db.Boolean(), nullable=False, default=False)
-    exported_id = db.Column(db.Unicode(35), nullable=True, default=None)
+    # end-to-end ID of the SEPA-DD collection, returns are matched by it
+    exported_id = db.Column(db.Unicode(35), nullable=True, default=None, index=True)
+    # reason code of a rejected or returned SEPA-DD collection
+    sepa_return = db.Column(db.Unicode(35), nullable=True, default=None)
     payment_type = db.Column(_payment_types)
     sent_on = db.Column(db.DateTime(), default=None)
     job_id = db.Column(db.Integer(), db.ForeignKey(Job.id, ondelete='RESTRICT'), nullable=True)
     job = db.relationship(Job, foreign_keys=[job_id], backref='invoices')
+    # sum of the items, kept by the InvoiceItem events
+    total = db.Column(db.Numeric(precision=10, scale=2, decimal_return_scale=2), nullable=False, default=0)
+
+    @staticmethod
+    def format_number(created_at, id):
+        return "AR%02d%05d" % (created_at.year % 100, id)
 
     @property
     def number(self):
-        return "AR%02d%05d" % (self.created_at.year % 100, self.id)
+        return self.format_number(self.created_at, self.id)
 
     def __str__(self):
         if self.cancelled:
@@ -65,13 +80,25 @@ class Invoice(db.Model):
 
     @hybrid_property
     def amount(self):
-        return sum([item.amount for item in self.items])
+        # items as loaded in this session, else the stored total
+        if 'items' in self.__dict__:
+            return sum([item.amount for item in self.items])
+        return self.total or 0
 
     @amount.expression
     def amount(cls):
-        return select([func.sum(InvoiceItem.amount)]).\
-                where(InvoiceItem.invoice_id==cls.id).\
-                label('total_amount')
+        return cls.total
+
+    @hybrid_property
+    def sepa_queued(self):
+        # sent SEPA-DD invoice waiting for the export
+        return self.sent_on is not None and not self.exported and not self.cancelled and \
+            self.payment_type == 'SEPA-DD'
+
+    @sepa_queued.expression
+    def sepa_queued(cls):
+        return and_(cls.sent_on != None, cls.exported == False, cls.cancelled == False,
+                    cls.payment_type == 'SEPA-DD')
 
     @validates('exported_id')
     def validate_exported_id(self, key, value):
@@ -82,13 +109,17 @@ class Invoice(db.Model):
     form_columns = ('contact','address', 'payment_type', 'sent_on')
     column_list = ('number', 'contact', 'amount', 'payment_type', 'created_at', 'sent', 'cancelled')
     column_searchable_list = ( 'id', 'contact.first_name', 'contact.last_name', 'contact.company_name')
-    column_filters = ('id', 'payment_type', 'contact_id', 'amount', 'created_at', 'job_id')
+    column_filters = ('id', 'payment_type', 'contact_id', 'amount', 'created_at', 'job_id', 'sepa_return')
     groups_view = ['billing']
     groups_create = ['billing']
     groups_edit = ['billing']
     groups_details = ['billing']
     inline_models = ('InvoiceItem',)
 
+# partial index of the SEPA export queue, queries filtering on Invoice.sepa_queued only read the pending invoices
+db.Index('ix_invoice_sepa_queue', Invoice.id,
+         postgresql_where=Invoice.sepa_queued, sqlite_where=Invoice.sepa_queued)
+
 event.listen(Invoice, 'before_insert', insert_set_created_c)
 
 @event.listens_for(Invoice, 'before_insert')
@@ -125,6 +156,50 @@ class InvoiceItem(db.Model):
     groups_create = ['billing']
     groups_details = ['billing']
 
+# Invoice.total follows every flushed change of the items
+keep_old_values(InvoiceItem.invoice_id, InvoiceItem.unit_price, InvoiceItem.quantity)
+
+def _item_amount(unit_price, quantity):
+    if unit_price is None or quantity is None:
+        return 0
+    return unit_price * quantity
+
+def expire_after_flush(target, cls, id, attr):
+    ''' expire attr of the loaded cls instance id after the flush, for columns updated by events '''
+    session = inspect(target).session
+    if session is not None:
+        session.info.setdefault('expire_after_flush', set()).add((cls, id, attr))
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _expire_after_flush(session, flush_context):
+    for cls, id, attr in session.info.pop('expire_after_flush', ()):
+        obj = session.identity_map.get(identity_key(cls, id))
+        if obj is not None:
+            session.expire(obj, [attr])
+
+def _add_invoice_total(connection, target, invoice_id, amount):
+    if invoice_id is None or not amount:
+        return
+    t = Invoice.__table__
+    connection.execute(t.update().where(t.c.id == invoice_id).values(total=t.c.total + amount))
+    expire_after_flush(target, Invoice, invoice_id, 'total')
+
+@event.listens_for(InvoiceItem, 'after_insert')
+def _item_total_inserted(mapper, connection, target):
+    _add_invoice_total(connection, target, target.invoice_id, _item_amount(target.unit_price, target.quantity))
+
+@event.listens_for(InvoiceItem, 'after_update')
+def _item_total_updated(mapper, connection, target):
+    old = (old_value(target, 'invoice_id'), _item_amount(old_value(target, 'unit_price'), old_value(target, 'quantity')))
+    if old != (target.invoice_id, _item_amount(target.unit_price, target.quantity)):
+        _add_invoice_total(connection, target, old[0], -old[1])
+        _add_invoice_total(connection, target, target.invoice_id, _item_amount(target.unit_price, target.quantity))
+
+@event.listens_for(InvoiceItem, 'after_delete')
+def _item_total_deleted(mapper, connection, target):
+    _add_invoice_total(connection, target, old_value(target, 'invoice_id'),
+                       -_item_amount(old_value(target, 'unit_price'), old_value(target, 'quantity')))
+
 #@event.listens_for(InvoiceItem, 'before_update')
 def InvoiceItem_before_update(mapper, connection, target):
     # prevent update if invoice has already been generated.
@@ -132,6 +207,33 @@ def InvoiceItem_before_update(mapper, connection, target):
         inspect(target.invoice).attrs['sent_on'].history.deleted != [None]):
         raise exceptions.Forbidden()
 
+class MailOutbox(db.Model):
+    id = db.Column(db.Integer(), primary_key=True)
+    invoice_id = db.Column(db.Integer(), db.ForeignKey(Invoice.id, ondelete="CASCADE"), nullable=False)
+    invoice = db.relationship(Invoice, backref='outbox')
+    job_id = db.Column(db.Integer(), db.ForeignKey(Job.id, ondelete='SET NULL'), nullable=True)
+    job = db.relationship(Job, foreign_keys=[job_id], backref='outbox')
+    created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+    recipient = db.Column(db.Unicode(64), nullable=False)
+    subject = db.Column(db.Unicode(255), nullable=False)
+    body = db.Column(db.UnicodeText())
+    attachment = db.Column(db.Unicode(255))
+    attempts = db.Column(db.Integer(), nullable=False, default=0)
+    next_attempt = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow, index=True)
+    sent_on = db.Column(db.DateTime(), default=None)
+    error = db.Column(db.Unicode(255))
+
+    column_list = ('invoice', 'recipient', 'created_at', 'attempts', 'next_attempt', 'sent_on', 'error')
+    column_default_sort = ('id', True)
+    column_filters = ('invoice_id', 'job_id', 'attempts', 'sent_on')
+    groups_view = ['billing']
+    groups_edit = ['billing']
+    groups_details = ['billing']
+
+    def __str__(self):
+        return "Mail %s to %s" % (self.invoice.number, self.recipient)
+
+
 class Payment(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
     created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
@@ -142,10 +244,16 @@ class Payment(db.Model):
     payment_type = db.Column(_payment_types)
     amount = db.Column(db.Numeric(precision=10, scale=2, decimal_return_scale=2))
     detail = db.Column(db.Unicode(255))
-    reference = db.Column(db.String(128))
+    reference = db.Column(db.String(128), unique=True, index=True)
     job_id = db.Column(db.Integer(), db.ForeignKey(Job.id, ondelete='RESTRICT'), nullable=True)
     job = db.relationship(Job, foreign_keys=[job_id], backref='payments')
 
+    @validates('reference')
+    def validate_reference(self, key, value):
+        if value == '':
+            return None
+        return value
+
     groups_view = ['billing']
     groups_create = ['billing']
     groups_edit = ['billing']
@@ -165,6 +273,117 @@ class Payment(db.Model):
             return 'Payment %s from %s (failed) ' % (self.id, self.date.date())
         return 'Payment %s from %s ' % (self.id, self.date.date())
 
+class ContactBalance(db.Model):
+    ''' User.balance per contact, payments minus sent invoices.
+        kept current by the events below while FF_HOUSING_BALANCE_TABLE is set,
+        after running without it rebuild with billing_rebuild_balances. '''
+    contact_id = db.Column(db.Integer(), db.ForeignKey(User.id, ondelete='CASCADE'), primary_key=True)
+    contact = db.relationship(User, backref=db.backref('contact_balance', uselist=False, passive_deletes=True))
+    balance = db.Column(db.Numeric(precision=10, scale=2, decimal_return_scale=2), nullable=False, default=0, index=True)
+
+    def __str__(self):
+        return str(self.balance)
+
+
+# ContactBalance follows every flushed change of payments, sent invoices and their items.
+# the invoice events read the total as it is in the database at that point of the flush,
+# item changes flushed later in the same flush add their own difference.
+
+keep_old_values(Payment.contact_id, Payment.amount, Invoice.contact_id, Invoice.sent_on)
+
+def _balance_enabled():
+    return app.config.get('FF_HOUSING_BALANCE_TABLE', False)
+
+def _add_balance(connection, target, contact_id, amount):
+    if contact_id is None or not amount:
+        return
+    t = ContactBalance.__table__
+    insert = dialect_insert(connection, t).values(contact_id=contact_id, balance=amount)
+    connection.execute(insert.on_conflict_do_update(index_elements=[t.c.contact_id],
+            set_={'balance': t.c.balance + insert.excluded.balance}))
+    if target is not None:
+        expire_after_flush(target, ContactBalance, contact_id, 'balance')
+        expire_after_flush(target, User, contact_id, 'contact_balance')
+
+def payments_inserted(connection, rows):
+    ''' balances for payment rows inserted without the ORM '''
+    if not _balance_enabled():
+        return
+    amounts = {}
+    for row in rows:
+        amounts[row['contact_id']] = amounts.get(row['contact_id'], 0) + (row['amount'] or 0)
+    for contact_id, amount in amounts.items():
+        _add_balance(connection, None, contact_id, amount)
+
+def _sent_invoice_contact(connection, invoice_id):
+    ''' contact of the invoice if it is sent, else None '''
+    t = Invoice.__table__
+    row = connection.execute(select([t.c.contact_id, t.c.sent_on]).where(t.c.id == invoice_id)).first()
+    return row.contact_id if row is not None and row.sent_on is not None else None
+
+def _invoice_total(connection, invoice_id):
+    t = Invoice.__table__
+    return connection.execute(select([t.c.total]).where(t.c.id == invoice_id)).scalar() or 0
+
+@event.listens_for(Payment, 'after_insert')
+def _payment_inserted(mapper, connection, target):
+    if _balance_enabled():
+        _add_balance(connection, target, target.contact_id, target.amount)
+
+@event.listens_for(Payment, 'after_update')
+def _payment_updated(mapper, connection, target):
+    if not _balance_enabled():
+        return
+    old = (old_value(target, 'contact_id'), old_value(target, 'amount') or 0)
+    if old != (target.contact_id, target.amount or 0):
+        _add_balance(connection, target, old[0], -old[1])
+        _add_balance(connection, target, target.contact_id, target.amount)
+
+@event.listens_for(Payment, 'after_delete')
+def _payment_deleted(mapper, connection, target):
+    if _balance_enabled():
+        _add_balance(connection, target, old_value(target, 'contact_id'), -(old_value(target, 'amount') or 0))
+
+@event.listens_for(Invoice, 'after_update')
+def _invoice_updated(mapper, connection, target):
+    if not _balance_enabled():
+        return
+    old_contact = old_value(target, 'contact_id') if old_value(target, 'sent_on') else None
+    contact = target.contact_id if target.sent_on else None
+    if old_contact != contact:
+        amount = _invoice_total(connection, target.id)
+        _add_balance(connection, target, old_contact, amount)
+        _add_balance(connection, target, contact, -amount)
+
+@event.listens_for(Invoice, 'before_delete')
+def _invoice_deleted(mapper, connection, target):
+    # remaining items are removed with the invoice by the foreign key
+    if _balance_enabled():
+        _add_balance(connection, target, _sent_invoice_contact(connection, target.id),
+                     _invoice_total(connection, target.id))
+
+@event.listens_for(InvoiceItem, 'after_insert')
+def _invoice_item_inserted(mapper, connection, target):
+    if _balance_enabled():
+        _add_balance(connection, target, _sent_invoice_contact(connection, target.invoice_id),
+                     -_item_amount(target.unit_price, target.quantity))
+
+@event.listens_for(InvoiceItem, 'after_update')
+def _invoice_item_updated(mapper, connection, target):
+    if not _balance_enabled():
+        return
+    old = (old_value(target, 'invoice_id'), _item_amount(old_value(target, 'unit_price'), old_value(target, 'quantity')))
+    new = (target.invoice_id, _item_amount(target.unit_price, target.quantity))
+    if old != new:
+        _add_balance(connection, target, _sent_invoice_contact(connection, old[0]), old[1])
+        _add_balance(connection, target, _sent_invoice_contact(connection, new[0]), -new[1])
+
+@event.listens_for(InvoiceItem, 'after_delete')
+def _invoice_item_deleted(mapper, connection, target):
+    if _balance_enabled():
+        _add_balance(connection, target, _sent_invoice_contact(connection, old_value(target, 'invoice_id')),
+                     _item_amount(old_value(target, 'unit_price'), old_value(target, 'quantity')))
+
 class Contract(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
     created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
@@ -186,10 +405,12 @@ class Contract(db.Model):
     def needs_billing(self, billdate=date.today()):
         if(self.closed):
             return False
-        for p in self.packages:
-            if p.needs_billing(billdate):
-                return True
-        return False
+        # packages as loaded in this session, else their stored next billing dates
+        if 'packages' in self.__dict__:
+            return any(p.needs_billing(billdate) for p in self.packages)
+        return db.session.query(ContractPackage.query.filter(
+            ContractPackage.contract_id == self.id,
+            ContractPackage.next_billing_date <= billdate).exists()).scalar()
 
     @property
     def billing_active(self):
@@ -262,16 +483,23 @@ class ContractPackage(db.Model):
     last_billed = db.Column(db.Date())
     billed_until = db.Column(db.Date())
     billing_period = db.Column(db.Integer(), default=None)
+    # billing_date() as of the last flush, kept by the insert and update events.
+    # due packages are selected by it, None if there is nothing left to bill
+    next_billing_date = db.Column(db.Date(), index=True)
+
+    def billing_date(self):
+        ''' first day the package needs billing, None if it is inactive or billed until it closed '''
+        if not self.active:
+            return None
+        if self.billed_until is None:
+            return self.opened_at.date()
+        if self.closed_at and self.closed_at.date() <= self.billed_until:
+            return None
+        return max(self.opened_at.date(), self.billed_until)
 
     def needs_billing(self, billdate=date.today()):
-        if self.active and self.opened_at.date() <= billdate:
-            if self.billed_until and self.billed_until > billdate:
-                return False
-            if self.closed_at and self.billed_until and self.closed_at.date() <= self.billed_until:
-                return False
-            else:
-                return True
-        return False
+        next_billing = self.billing_date()
+        return next_billing is not None and next_billing <= billdate
 
     @property
     def billing_active(self):
@@ -302,3 +530,16 @@ class ContractPackage(db.Model):
 
     def __str__(self):
         return "%s (%s)" % (self.package.name, self.contract)
+
+@event.listens_for(ContractPackage, 'before_insert')
+def _contract_package_inserted(mapper, connection, target):
+    # the column defaults are only applied after this
+    if target.active is None:
+        target.active = True
+    if target.opened_at is None:
+        target.opened_at = datetime.utcnow()
+    target.next_billing_date = target.billing_date()
+
+@event.listens_for(ContractPackage, 'before_update')
+def _contract_package_updated(mapper, connection, target):
+    target.next_billing_date = target.billing_date()
@@ -1,7 +1,9 @@
 from sqlalchemy.orm import validates
-from sqlalchemy import event
+from sqlalchemy import event, select, func, DDL
 
-from ..model import db, User, Contract, insert_set_created_c
+from ..model import db, User, Contract, insert_set_created_c, keep_old_values, old_value
+from .types import Inet, inet_text
+from datetime import datetime
 import ipaddress, re
 
 
@@ -38,7 +40,7 @@ class Server(Contract):
     groups_delete = ['admin']
     column_list = ('id','active', 'billing_active', 'admin_c', 'ips', 'location', 'servertype', 'created_at')
     column_searchable_list = ('id', 'admin_c.first_name', 'admin_c.last_name', 'admin_c.company_name', 
-                              'name', 'location', 'billing_c.first_name', 'billing_c.last_name', 'billing_c.company_name', 'ips.ip_address')
+                              'name', 'location', 'billing_c.first_name', 'billing_c.last_name', 'billing_c.company_name', 'ips.ip_address_text')
     column_filters = ('active', 'created_at', 'admin_c', 'servertype')
 
     __mapper_args__ = {
@@ -106,8 +108,9 @@ class IP(db.Model):
     switchport_id = db.Column(db.Integer(), db.ForeignKey(SwitchPort.id, ondelete="SET NULL"))
     switchport = db.relationship(SwitchPort, backref='ips')
     active = db.Column(db.Boolean(), default=True, nullable=False)
-    ip_address = db.Column(db.String(48), unique=True, nullable = False)
-    routed_subnet = db.Column(db.String(48), default=None, unique=True, nullable = True)
+    ip_address = db.Column(Inet('interface'), unique=True, nullable = False)
+    routed_subnet = db.Column(Inet('network'), default=None, unique=True, nullable = True)
+    ip_address_text = inet_text('ip_address')
     gateway = db.Column(db.String(45))
     rdns = db.Column(db.String(255))
     server_id = db.Column(db.Integer(), db.ForeignKey(Server.id, ondelete="SET NULL"))
@@ -116,7 +119,7 @@ class IP(db.Model):
     monitoring = db.Column(db.Boolean(), default=False, nullable=False)
 
     form_columns = ('type','ip_address', 'gateway', 'rdns', 'routed_subnet', 'monitoring')
-    column_searchable_list = ( 'ip_address', 'rdns')
+    column_searchable_list = ( 'ip_address_text', 'rdns')
     column_filters = ('type', 'active', 'ip_address', 'server_id')
 
     @property
@@ -172,19 +175,28 @@ class IP(db.Model):
     def form_header(self):
         return "IP %s" % self.ip
 
+# GiST indexes for the containment operators, postgresql only
+event.listen(IP.__table__, 'after_create', DDL(
+    'CREATE INDEX ix_ip_ip_address_host_gist ON "IP" USING gist ((CAST(host(ip_address) AS inet)) inet_ops)'
+    ).execute_if(dialect='postgresql'))
+event.listen(IP.__table__, 'after_create', DDL(
+    'CREATE INDEX ix_ip_routed_subnet_gist ON "IP" USING gist (routed_subnet inet_ops)'
+    ).execute_if(dialect='postgresql'))
+
 from flask_security import current_user
 
 class Subnet_rDNS(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
     subnet_id = db.Column(db.Integer(), db.ForeignKey(IP.id, ondelete="CASCADE"))
     subnet = db.relationship(IP, backref='subnet_rdns')
-    ip_address = db.Column(db.String(48), unique=True, nullable = False)
+    ip_address = db.Column(Inet('address'), unique=True, nullable = False)
+    ip_address_text = inet_text('ip_address')
     rdns = db.Column(db.String(255))
 
     monitoring = db.Column(db.Boolean(), default=False, nullable=False)
 
     form_columns = ('subnet','ip_address', 'rdns', 'monitoring')
-    column_searchable_list = ( 'ip_address', 'rdns')
+    column_searchable_list = ( 'ip_address_text', 'rdns')
     column_filters = ('rdns', 'ip_address', 'subnet')
 
     @property
@@ -233,3 +245,116 @@ class Subnet_rDNS(db.Model):
 
     def __str__(self):
         return str(self.ip_address)
+
+event.listen(Subnet_rDNS.__table__, 'after_create', DDL(
+    'CREATE INDEX "ix_subnet_rDNS_ip_address_gist" ON "subnet_rDNS" USING gist (ip_address inet_ops)'
+    ).execute_if(dialect='postgresql'))
+
+
+_rdns_change_actions = db.Enum('add', 'delete', name='rdns_change_actions')
+
+class RDNSChange(db.Model):
+    ''' PTR records added or deleted, the id is the serial of the change '''
+    id = db.Column(db.Integer(), primary_key=True)
+    created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow, index=True)
+    action = db.Column(_rdns_change_actions, nullable=False)
+    ip_address = db.Column(Inet('address'), nullable=False)
+    rdns = db.Column(db.String(255), nullable=False)
+
+    column_default_sort = ('id', True)
+    column_filters = ('action', 'ip_address', 'rdns', 'created_at')
+    groups_details = ['admin']
+    groups_view = ['admin']
+
+    def __str__(self):
+        return "%s %s %s" % (self.action, self.ip_address, self.rdns)
+
+
+# PTR records are visible for active IPs with a server and their subnet rDNS entries.
+# every change of a visible record is logged as delete of the old and add of the new one.
+
+# the change log needs the replaced values of expired attributes
+keep_old_values(IP.ip_address, IP.routed_subnet, IP.active, IP.server_id, IP.rdns,
+                Subnet_rDNS.subnet_id, Subnet_rDNS.ip_address, Subnet_rDNS.rdns)
+
+def _ip_visible(connection, id):
+    row = connection.execute(select([IP.__table__.c.active, IP.__table__.c.server_id]).where(
+        IP.__table__.c.id == id)).first()
+    return row is not None and row.active and row.server_id is not None
+
+def _subnet_records(connection, id):
+    t = Subnet_rDNS.__table__
+    return dict(connection.execute(select([t.c.ip_address, t.c.rdns]).where(
+        (t.c.subnet_id == id) & (t.c.rdns != None))).fetchall())
+
+# the serial of a change is its id, clients ask for the changes after the last one they got.
+# on postgresql ids are taken when inserting, in-flight transactions may commit a lower id later,
+# so writers of the change log take this lock until their commit. sqlite serializes writers anyway.
+RDNS_CHANGES_LOCK = 0x72646e73
+
+def _log_rdns_changes(connection, old, new):
+    ''' old and new are dicts of visible records, address: rdns '''
+    now = datetime.utcnow()
+    rows = []
+    for address, rdns in old.items():
+        if new.get(address) != rdns:
+            rows.append({'created_at': now, 'action': 'delete', 'ip_address': address, 'rdns': rdns})
+    for address, rdns in new.items():
+        if old.get(address) != rdns:
+            rows.append({'created_at': now, 'action': 'add', 'ip_address': address, 'rdns': rdns})
+    if rows:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(select([func.pg_advisory_xact_lock(RDNS_CHANGES_LOCK)]))
+        connection.execute(RDNSChange.__table__.insert(), rows)
+
+def _ip_record(ip_address, active, server_id, rdns):
+    if ip_address and active and server_id is not None and rdns is not None:
+        return {str(ipaddress.ip_interface(ip_address).ip): rdns}
+    return {}
+
+@event.listens_for(IP, 'after_insert')
+def _ip_rdns_insert(mapper, connection, target):
+    _log_rdns_changes(connection, {},
+        _ip_record(target.ip_address, target.active, target.server_id, target.rdns))
+
+@event.listens_for(IP, 'after_update')
+def _ip_rdns_update(mapper, connection, target):
+    old = _ip_record(old_value(target, 'ip_address'), old_value(target, 'active'), old_value(target, 'server_id'), old_value(target, 'rdns'))
+    new = _ip_record(target.ip_address, target.active, target.server_id, target.rdns)
+    old_visible = old_value(target, 'active') and old_value(target, 'server_id') is not None
+    new_visible = target.active and target.server_id is not None
+    if old_visible != new_visible:
+        subnet_records = _subnet_records(connection, target.id)
+        if old_visible:
+            old.update(subnet_records)
+        else:
+            new.update(subnet_records)
+    _log_rdns_changes(connection, old, new)
+
+@event.listens_for(IP, 'before_delete')
+def _ip_rdns_delete(mapper, connection, target):
+    old = _ip_record(old_value(target, 'ip_address'), old_value(target, 'active'), old_value(target, 'server_id'), old_value(target, 'rdns'))
+    if old_value(target, 'active') and old_value(target, 'server_id') is not None:
+        old.update(_subnet_records(connection, target.id))
+    _log_rdns_changes(connection, old, {})
+
+def _subnet_rdns_record(connection, subnet_id, ip_address, rdns):
+    if ip_address and rdns is not None and _ip_visible(connection, subnet_id):
+        return {str(ipaddress.ip_address(ip_address)): rdns}
+    return {}
+
+@event.listens_for(Subnet_rDNS, 'after_insert')
+def _subnet_rdns_insert(mapper, connection, target):
+    _log_rdns_changes(connection, {},
+        _subnet_rdns_record(connection, target.subnet_id, target.ip_address, target.rdns))
+
+@event.listens_for(Subnet_rDNS, 'after_update')
+def _subnet_rdns_update(mapper, connection, target):
+    _log_rdns_changes(connection,
+        _subnet_rdns_record(connection, old_value(target, 'subnet_id'), old_value(target, 'ip_address'), old_value(target, 'rdns')),
+        _subnet_rdns_record(connection, target.subnet_id, target.ip_address, target.rdns))
+
+@event.listens_for(Subnet_rDNS, 'after_delete')
+def _subnet_rdns_delete(mapper, connection, target):
+    _log_rdns_changes(connection,
+        _subnet_rdns_record(connection, old_value(target, 'subnet_id'), old_value(target, 'ip_address'), old_value(target, 'rdns')), {})
@@ -0,0 +1,187 @@
+from sqlalchemy import event, types, cast, func, literal
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.sql.functions import FunctionElement
+from sqlite3 import Connection as SQLite3Connection
+import ipaddress
+
+
+def pack(address, prefixlen):
+    ''' sortable binary form: ip version, address bytes, prefix length.
+        all addresses of a network sort between its network and broadcast address. '''
+    return bytes((address.version,)) + address.packed + bytes((prefixlen,))
+
+def unpack(value):
+    return ipaddress.ip_address(bytes(value[1:-1])), value[-1]
+
+
+class Inet(types.TypeDecorator):
+    ''' IP address or network, inet/cidr on postgresql, packed binary elsewhere.
+        values are strings on the python side.
+
+        kind 'address':   1.2.3.4
+        kind 'interface': 1.2.3.4/24, host address with prefix length
+        kind 'network':   1.2.3.0/24
+
+        contained_by and contains_address use the gist indexes on postgresql.
+        on sqlite contained_by is a range scan of the packed values, contains_address
+        calls a python function for every row and can not use an index. '''
+
+    impl = types.LargeBinary
+    cache_ok = True
+
+    def __init__(self, kind='address'):
+        super(Inet, self).__init__()
+        self.kind = kind
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            if self.kind == 'network':
+                return dialect.type_descriptor(postgresql.CIDR())
+            return dialect.type_descriptor(postgresql.INET())
+        return dialect.type_descriptor(types.LargeBinary())
+
+    def parse(self, value):
+        if self.kind == 'network':
+            return ipaddress.ip_network(value)
+        if self.kind == 'interface':
+            return ipaddress.ip_interface(value)
+        return ipaddress.ip_interface(value).ip
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        value = self.parse(value)
+        if dialect.name == 'postgresql':
+            return str(value)
+        if self.kind == 'network':
+            return pack(value.network_address, value.prefixlen)
+        if self.kind == 'interface':
+            return pack(value.ip, value.network.prefixlen)
+        return pack(value, value.max_prefixlen)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if dialect.name != 'postgresql':
+            value = '%s/%d' % unpack(value)
+        return str(self.parse(value))
+
+    class comparator_factory(types.TypeDecorator.Comparator):
+        def contained_by(self, network):
+            ''' the (host) address is within network, <<= '''
+            return ContainedBy(self.expr, ipaddress.ip_network(network))
+
+        def contains_address(self, address):
+            ''' the network contains address, >>= '''
+            return Contains(self.expr, ipaddress.ip_address(address))
+
+        # text search (admin lists, ajax loaders) on the address as string
+        def like(self, other, escape=None):
+            return InetText(self.expr).like(other, escape=escape)
+
+        def ilike(self, other, escape=None):
+            return InetText(self.expr).ilike(other, escape=escape)
+
+        def notlike(self, other, escape=None):
+            return InetText(self.expr).notlike(other, escape=escape)
+
+        def notilike(self, other, escape=None):
+            return InetText(self.expr).notilike(other, escape=escape)
+
+
+class ContainedBy(FunctionElement):
+    ''' column <<= network, arguments: column, network, its first and last packed address '''
+    type = types.Boolean()
+    name = 'inet_contained_by'
+    inherit_cache = True
+
+    def __init__(self, column, network):
+        super(ContainedBy, self).__init__(column, literal(str(network)),
+            literal(pack(network.network_address, 0), types.LargeBinary),
+            literal(pack(network.broadcast_address, 255), types.LargeBinary))
+
+class Contains(FunctionElement):
+    ''' column >>= address, arguments: column, address, packed address '''
+    type = types.Boolean()
+    name = 'inet_contains'
+    inherit_cache = True
+
+    def __init__(self, column, address):
+        super(Contains, self).__init__(column, literal(str(address)),
+            literal(pack(address, address.max_prefixlen), types.LargeBinary))
+
+class InetText(FunctionElement):
+    ''' the address of column as string, 1.2.3.4/24 '''
+    type = types.Unicode()
+    name = 'inet_text'
+    inherit_cache = True
+
+
+@compiles(ContainedBy, 'postgresql')
+def _pg_contained_by(element, compiler, **kw):
+    column, network, first, last = element.clauses
+    if column.type.kind == 'interface':
+        # compare the host address only, matches the ix_*_host_gist index
+        column = cast(func.host(column), postgresql.INET)
+    return '%s <<= %s' % (compiler.process(column, **kw),
+                          compiler.process(cast(network, postgresql.CIDR), **kw))
+
+@compiles(ContainedBy)
+def _contained_by(element, compiler, **kw):
+    # the packed form sorts all addresses of a network between its first and last one
+    column, network, first, last = element.clauses
+    return compiler.process(column.between(first, last), **kw)
+
+@compiles(Contains, 'postgresql')
+def _pg_contains(element, compiler, **kw):
+    column, address, packed = element.clauses
+    return '%s >>= %s' % (compiler.process(column, **kw),
+                          compiler.process(cast(address, postgresql.INET), **kw))
+
+@compiles(Contains)
+def _contains(element, compiler, **kw):
+    # python function, no index is used for this on sqlite
+    column, address, packed = element.clauses
+    return compiler.process(func.inet_contains(column, packed), **kw)
+
+@compiles(InetText, 'postgresql')
+def _pg_inet_text(element, compiler, **kw):
+    column, = element.clauses
+    return compiler.process(cast(column, types.Unicode), **kw)
+
+@compiles(InetText)
+def _inet_text(element, compiler, **kw):
+    column, = element.clauses
+    return compiler.process(func.inet_text(column), **kw)
+
+
+def inet_text(name):
+    ''' hybrid property of the Inet column name as string.
+        searched by flask-admin instead of the column, as it compares cast(column as text). '''
+    def getter(self):
+        return getattr(self, name)
+    def expression(cls):
+        return InetText(getattr(cls, name))
+    return hybrid_property(getter, expr=expression)
+
+
+def _sqlite_inet_text(value):
+    if value is None:
+        return None
+    return '%s/%d' % unpack(value)
+
+def _sqlite_inet_contains(network, address):
+    if network is None or address is None:
+        return None
+    address = unpack(address)[0]
+    network = ipaddress.ip_network(unpack(network), strict=False)
+    return network.version == address.version and address in network
+
+@event.listens_for(Engine, "connect")
+def _set_sqlite_functions(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, SQLite3Connection):
+        dbapi_connection.create_function('inet_text', 1, _sqlite_inet_text, deterministic=True)
+        dbapi_connection.create_function('inet_contains', 2, _sqlite_inet_contains, deterministic=True)
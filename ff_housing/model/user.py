@@ -4,8 +4,9 @@ from sqlalchemy.orm import validates
 from stdnum import iban
 
 from ..model import db
+from ff_housing import app
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import select, func
+from sqlalchemy import select, func, and_
 
 class ClassProperty(object):
     def __init__(self, func):
@@ -106,26 +107,45 @@ class User(db.Model, UserMixin):
                 raise Exception( "SEPA Mandate Date must not be in the future." )
         return value
 
-    @property
+    @hybrid_property
     def has_sepa_mandate(self):
         if self.sepa_iban and self.sepa_mandate_id and self.sepa_mandate_date:
             return True
         return False
 
+    @has_sepa_mandate.expression
+    def has_sepa_mandate(cls):
+        # the validator stores empty values as NULL
+        return and_(cls.sepa_iban != None, cls.sepa_mandate_id != None, cls.sepa_mandate_date != None)
+
     @hybrid_property
     def balance(self):
-        from .accounting import Invoice, Payment
-        return sum([payment.amount for payment in self.payments]) - \
-                    sum([invoice.amount for invoice in self.invoices])
+        ''' payments minus sent invoices, like the payments list of the contact.
+            unsent invoices are not owed yet and do not count. '''
+        if app.config.get('FF_HOUSING_BALANCE_TABLE'):
+            return self.contact_balance.balance if self.contact_balance else 0
+        return sum([payment.amount or 0 for payment in self.payments]) - \
+                    sum([invoice.amount for invoice in self.invoices if invoice.sent_on])
 
     @balance.expression
     def balance(cls):
+        if app.config.get('FF_HOUSING_BALANCE_TABLE'):
+            from .accounting import ContactBalance
+            return func.coalesce(select([ContactBalance.balance]).
+                    where(ContactBalance.contact_id==cls.id).
+                    as_scalar(), 0).label('balance')
+        return cls.balance_sum().label('balance')
+
+    @classmethod
+    def balance_sum(cls):
+        ''' payments minus sent invoices, correlated to cls.id '''
         from .accounting import Invoice, Payment
-        return select([func.sum(Payment.amount - Invoice.amount)]).\
-                where(Payment.contact_id==cls.id ).\
-                where(Invoice.contact_id==cls.id ).\
-                where(Invoice.sent_on is not None ).\
-                label('total_amount'),
+        payments = select([func.coalesce(func.sum(Payment.amount), 0)]).\
+                where(Payment.contact_id==cls.id)
+        invoices = select([func.coalesce(func.sum(Invoice.total), 0)]).\
+                where(Invoice.contact_id==cls.id).\
+                where(Invoice.sent_on != None)
+        return payments.as_scalar() - invoices.as_scalar()
 
     form_columns = ('first_name', 'last_name', 'company_name', 'active', 'mailinglist', 'street', 'zip', 'town', 'country', 'email', 'phone', 'keycard')
 
@@ -1,10 +1,15 @@
 from . import model
 from calendar import monthrange
+import ipaddress
 
 def daysofmonth(date):
     return(monthrange(date.year, date.month)[1]) 
 
 def ip_find_server(ip):
     ''' find server to IP (without subnet)'''
-    ip = model.IP.query.filter(model.IP.ip_address.like(ip+"/_%")).first()
+    try:
+        ip = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    ip = model.IP.query.filter(model.IP.ip_address.contained_by(ip)).first()
     return ip.server if ip else None
@@ -7,7 +7,10 @@ from flask_security import current_user
 from flask_admin.model.template import LinkRowAction
 from flask_admin.model.helpers import get_mdict_item_or_list
 from flask_admin.actions import action
+from flask_admin.model.form import converts
+from flask_admin.model.filters import convert
 from os.path import isfile
+from datetime import datetime
 
 from flask import (current_app, request, redirect, flash, abort, json,
                    Response, get_flashed_messages, stream_with_context)
@@ -16,11 +19,27 @@ from flask_admin.helpers import (get_form_data, validate_form_on_submit,
 
 import ff_housing.model as model
 from ff_housing.model import db
+from ff_housing import app
 from flask_admin.babel import gettext
+from sqlalchemy.orm import joinedload
+
+# Inet columns are edited and searched as strings
+class InetModelConverter(sqla.form.AdminModelConverter):
+    @converts('Inet')
+    def conv_Inet(self, column, field_args, **extra):
+        return self.conv_String(column, field_args, **extra)
+
+class InetFilterConverter(sqla.filters.FilterConverter):
+    @convert('inet')
+    def conv_inet(self, column, name, **kwargs):
+        return [f(column, name, **kwargs) for f in
+                (sqla.filters.FilterLike, sqla.filters.FilterNotLike, sqla.filters.FilterEmpty)]
 
 # Create customized model view class
 class AdminView(sqla.ModelView):
     form_base_class = SecureForm
+    model_form_converter = InetModelConverter
+    filter_converter = InetFilterConverter()
 
     def is_accessible(self):
         if not current_user.is_active or not current_user.is_authenticated:
@@ -48,6 +67,10 @@ class AdminView(sqla.ModelView):
 
 class ACLView(sqla.ModelView):
     form_base_class = SecureForm
+    model_form_converter = InetModelConverter
+    filter_converter = InetFilterConverter()
+    # Inet columns are searched by their text hybrids
+    column_labels = {'ip_address_text': 'ip_address', 'ips.ip_address_text': 'ips.ip_address'}
 
     def is_accessible(self):
         if not current_user.is_active or not current_user.is_authenticated:
@@ -242,22 +265,23 @@ class AdminInvoiceView(ACLView):
         except Exception as ex:
             flash(str(ex), 'error')
 
-    @action('send', 'Send Invoices', 'Send selected invoices? (max 25) Already sent invoices will not be sent again.')
+    @action('send', 'Send Invoices', 'Send selected invoices? Already sent invoices will not be sent again.')
     def send_invoices(self, ids):
-        from ff_housing.controller.accounting import send_invoice
-        if len(ids) > 25:
-            raise Exception('A maximum of 25 invoices can be sent at a time..')
+        from ff_housing.controller.accounting import send_invoices
         try:
-            invoices = self.model.query.filter(self.model.id.in_(ids))
-            for invoice in invoices:
-                send_invoice(invoice)
-                flash('Invoices sent.', 'info')
+            # queued in the mail outbox and delivered in batches of FF_HOUSING_MAIL_BATCH
+            invoices = self.model.query.filter(self.model.id.in_(ids)).order_by(self.model.id).all()
+            flash('%d invoices sent.' % send_invoices(invoices), 'info')
+            unsent = model.MailOutbox.query.filter(model.MailOutbox.invoice_id.in_(ids),
+                                                   model.MailOutbox.sent_on == None).count()
+            if unsent:
+                flash('%d invoices could not be sent yet, they are retried from the mail outbox.' % unsent, 'warning')
 
         except Exception as ex:
             flash(str(ex), 'error')
 
 class AdminContractView(ACLView):
-    inline_models = (model.ContractPackage,)
+    inline_models = ((model.ContractPackage, dict(form_excluded_columns=('next_billing_date',))),)
 
 class AdminUserView(ACLView):
     column_default_sort = ('id', True)
@@ -289,6 +313,32 @@ class AdminUserView(ACLView):
             return cols
         return None
 
+    # sort and filter on the indexed contact_balance table if it is kept, else on the aggregate
+    @property
+    def _balance_column(self):
+        if app.config.get('FF_HOUSING_BALANCE_TABLE'):
+            return 'contact_balance.balance'
+        return 'balance'
+
+    @property
+    def column_sortable_list(self):
+        if current_user and 'billing' in current_user.roles:
+            return list(self.scaffold_sortable_columns()) + [('balance', self._balance_column)]
+        return None
+
+    @property
+    def column_filters(self):
+        cols = list(self.model.column_filters)
+        if current_user and 'billing' in current_user.roles:
+            cols.append(self._balance_column)
+        return cols
+
+    def get_query(self):
+        query = super(AdminUserView, self).get_query()
+        if app.config.get('FF_HOUSING_BALANCE_TABLE'):
+            query = query.options(joinedload(model.User.contact_balance))
+        return query
+
     @property
     def column_extra_row_actions(self):
         if current_user and 'billing' in current_user.roles:
@@ -312,31 +362,46 @@ class AdminUserView(ACLView):
                 flash(gettext('User does not exist.'), 'error')
                 return redirect(return_url)
 
+            try:
+                start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if request.args.get('start') else None
+                end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') else None
+                page = max(int(request.args.get('page', 0)), 0)
+            except ValueError:
+                flash(gettext('Invalid date or page.'), 'error')
+                start, end, page = None, None, 0
+
+            from ff_housing.controller.accounting import ledger
+            rows, count, psum = ledger(user, start, end, offset=page * self.page_size, limit=self.page_size)
             plist = []
-            psum = 0
-            invoices = model.Invoice.query.filter(model.Invoice.contact_id == user.id, model.Invoice.sent_on != None).all()
-            for e in  sorted(invoices + user.payments, key=lambda el: el.sort_date):
-                if type(e) is model.Invoice:
-                    psum += -e.amount
+            for e in rows:
+                if e.kind == 0:
+                    name = "Invoice %s for %s" % (model.Invoice.format_number(e.date, e.id), user)
+                    if e.cancelled:
+                        name += " (cancelled)"
                     plist.append({
                         'class': 'warning',
-                        'date':  e.sort_date.date(),
-                        'amount': -e.amount,
-                        'sum': psum,
-                        'name': str(e),
+                        'date':  e.date.date(),
+                        'amount': e.amount,
+                        'sum': e.balance,
+                        'name': name,
                         })
                 else:
-                    psum += e.amount
                     plist.append({
                         'class': 'success' if e.amount > 0 else 'danger big',
-                        'date':  e.sort_date.date(),
+                        'date':  e.date.date(),
                         'amount': e.amount,
-                        'sum': psum,
-                        'name': str(e),
+                        'sum': e.balance,
+                        'name': 'Payment %s from %s %s' % (e.id, e.date.date(), '(failed) ' if e.amount < 0 else ''),
                         })
 
+            def page_url(p):
+                return self.get_url('.payments_view', id=user.id, page=p,
+                                    start=request.args.get('start'), end=request.args.get('end'))
+
             return self.render(template='admin/user_payments_list.html',
-                            list=plist[::-1], user=user, sum=psum)
+                            list=plist, user=user, sum=psum,
+                            page=page, pages=(count + self.page_size - 1) // self.page_size, page_url=page_url,
+                            start=request.args.get('start', ''), end=request.args.get('end', ''))
 
         return redirect(return_url)
 
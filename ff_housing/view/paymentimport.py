@@ -4,12 +4,20 @@ from flask_admin import BaseView, expose
 from flask_security import current_user
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired
-from wtforms.fields import BooleanField
+from wtforms.fields import BooleanField, SelectField
 from datetime import datetime
 
 from ff_housing.controller import PaymentsImporter
+from ff_housing.controller.sepa_returns import SepaReturnsImporter
+from ff_housing.controller.bankstatement import parsers
 
 class FileForm(FlaskForm):
+    file = FileField(validators=[FileRequired()])
+    format = SelectField(default='auto', label="Format",
+                         choices=[('auto', 'detect')] + [(name, p[0]) for name, p in sorted(parsers.items())])
+    checkbox = BooleanField(default=True, label="Dry Run")
+
+class ReturnsFileForm(FlaskForm):
     file = FileField(validators=[FileRequired()])
     checkbox = BooleanField(default=True, label="Dry Run")
 
@@ -35,7 +43,7 @@ class PaymentImportView(BaseView):
                     started = datetime.utcnow() )
                 db.session.add(job)
 
-            importer = PaymentsImporter(form.file.data, job)
+            importer = PaymentsImporter(form.file.data, job, form.format.data)
             resp = importer.importResponse(view=self, dryrun=dryrun)
 
             if job:
@@ -45,9 +53,49 @@ class PaymentImportView(BaseView):
 
         form.title = self.name
         form.submit_val = 'Import'
-        lead = "ErsteBank JSON Upload"
+        lead = "Bank Statement Upload: Erste Bank JSON, CAMT.053/054 XML or CSV"
         description = """Zahlungen können mit „ignore“ im Notizfeld des Bank-Interfaces
         ignoriert oder mit „k<UserID>“ direkt Personen zugewiesen werden."""
 
         return self.render('admin/file_import.html',
                            form=form, lead=lead, description=description)
+
+
+class SepaReturnsView(BaseView):
+    def is_accessible(self):
+        if not current_user.is_active or not current_user.is_authenticated:
+            return False
+        return bool(set(['billing']) & set(current_user.roles))
+
+    @expose('/', methods=('GET', 'POST'))
+    def index(self):
+        form = ReturnsFileForm()
+
+        if form.validate_on_submit():
+            dryrun = form.checkbox.data
+            job = None
+
+            if not dryrun:
+                job = model.Job(
+                    type = 'billing',
+                    note = 'sepa_returns',
+                    user = current_user,
+                    started = datetime.utcnow() )
+                db.session.add(job)
+
+            importer = SepaReturnsImporter(form.file.data.stream, job)
+            resp = importer.importResponse(view=self, dryrun=dryrun)
+
+            if job:
+                job.finished = datetime.utcnow()
+                db.session.commit()
+            return resp
+
+        form.title = self.name
+        form.submit_val = 'Reconcile'
+        lead = "SEPA-DD Returns Upload: pain.002 status reports or CAMT.053/054 XML"
+        description = """Rücklastschriften werden über die End-to-End-ID den exportierten
+        Rechnungen zugeordnet und als Gegenbuchung importiert."""
+
+        return self.render('admin/file_import.html',
+                           form=form, lead=lead, description=description)
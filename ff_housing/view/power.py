@@ -4,7 +4,8 @@ from flask_admin.form import SecureForm
 from flask_admin.actions import action
 from datetime import datetime
 
-from flask import flash, Response
+from flask import flash, Response, g
+from markupsafe import Markup, escape
 from flask_security import current_user
 from flask_admin.model.template import LinkRowAction
 from sqlalchemy.sql.expression import func
@@ -28,7 +29,24 @@ class PowerForm(SecureForm):
     status = HiddenField('', validators=[validators.DataRequired()])
     password = PasswordField('Password', validators=[validators.DataRequired()])
 
+def _status_formatter(view, context, outlet, name):
+    status = g.get('power_statuses', {}).get(outlet.id)
+    if status is None:
+        return Markup('<span class="label label-default">unknown</span>')
+    return Markup('<span class="label label-%s">%s</span>' % (
+        'success' if status['powered'] else 'danger', escape(status['state'])))
+
 class PowerOuletView():
+    column_formatters = {'status': _status_formatter}
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        count, outlets = super(PowerOuletView, self).get_list(page, sort_column, sort_desc, search, filters,
+                                                              execute=execute, page_size=page_size)
+        if execute:
+            # the states of the whole page at once, for the status column
+            g.power_statuses = power.get_statuses(outlets)
+        return count, outlets
+
     def _can_view(self, outlet):
         if outlet.server and outlet.server.admin_c == current_user:
             return True
@@ -69,9 +87,10 @@ class PowerOuletView():
         if not self._can_view(outlet):
             return redirect(return_url)
 
+        # None if the PDU did not answer in time
         status = power.get_status(outlet)
 
-        if self._can_switch(outlet):
+        if status is not None and self._can_switch(outlet):
             form = PowerForm(status = status['powered'] and 'OFF' or 'ON')
         else:
             form = None
@@ -91,14 +110,16 @@ class PowerOuletView():
         return Response(json.dumps(status), mimetype="application/json")
 
 
-class PowerOuletAdminView(ACLView, PowerOuletView):
+class PowerOuletAdminView(PowerOuletView, ACLView):
     page_size = 200
 
+    column_list = ('outlet', 'endpoint', 'active', 'switchable', 'status')
+
     column_extra_row_actions = [
         LinkRowAction('glyphicon glyphicon-eye-open', 'view/?id={row_id}')
         ]
 
-class PowerOuletUserView(UserView, PowerOuletView):
+class PowerOuletUserView(PowerOuletView, UserView):
     form_base_class = SecureForm
     can_delete = False
     can_create = False
@@ -109,7 +130,7 @@ class PowerOuletUserView(UserView, PowerOuletView):
         LinkRowAction('glyphicon glyphicon-eye-open', 'view/?id={row_id}')
         ]
 
-    column_list = ('server', 'outlet')
+    column_list = ('server', 'outlet', 'status')
     column_sortable_list = ()
 
     def create_view(self):
@@ -1,60 +1,56 @@
-from ff_housing import model, utils
+from ff_housing.controller.rdns import zone_cache, zone_file, export_json, changes
 from flask.views import View
-from flask import Response
+from flask import Response, request, json
 import ipaddress
-from datetime import datetime
 
 class rdnsView(View):
     def dispatch_request(self, ip, prefix):
-        entries = self.rdns("%s/%s" % (ip, prefix))
-        return Response('\n'.join(entries), 200, mimetype="text/plain")
-
-    def rdns(self, subnet):
-        entries = ["; generated %s UTC" % datetime.utcnow() ]
         try:
-            subnet = ipaddress.ip_network(subnet)
-        except:
-            entries.append('; error: requested subnet not valid, try 1.33.7.0/24 or c0ff:ee::/64')
-            return entries
+            subnet = ipaddress.ip_network("%s/%s" % (ip, prefix))
+        except ValueError:
+            return Response('; error: requested subnet not valid, try 1.33.7.0/24 or c0ff:ee::/64',
+                            200, mimetype="text/plain")
 
-        if subnet.version == 4:
-            splitlen = int((subnet.max_prefixlen-(subnet.prefixlen - (subnet.prefixlen%8)) )/8)
-        else:
-            splitlen = int((subnet.max_prefixlen-subnet.prefixlen)/4)
-
-        # get IPs
-        for addr in model.IP.query.filter(
-                model.IP.active == True,
-                model.IP.server_id != None,
-                model.IP.rdns != None,
-                model.IP.ip_address.like(self._subnet_sql_match(subnet))
-            ).order_by(model.IP.id):
-            if ipaddress.ip_interface(addr.ip_address) in subnet:
-                entries.append(self._ptr_line(addr, splitlen))
-
-        # get routed subnet rDNS entries
-        for addr in model.Subnet_rDNS.query.join(model.IP).filter(
-                model.IP.active == True,
-                model.IP.server_id != None,
-                model.Subnet_rDNS.ip_address.like(self._subnet_sql_match(subnet))
-            ).order_by(model.IP.id):
-            if ipaddress.ip_interface(addr.ip_address) in subnet:
-                entries.append(self._ptr_line(addr, splitlen))
-
-        return entries
-
-
-    def _ptr_line(self, addr, splitlen):
-        return "%s\tPTR\t%s." % \
-                ('.'.join(addr.ip.reverse_pointer.split('.')[:splitlen]),
-                    addr.rdns )
-
-    def _subnet_sql_match(self, subnet):
-        if subnet.version == 6:
-            return "%s:%%" % (':'.join(str(subnet[0]).rstrip(':').split(':')[:-1]))
-        else:
-            splitlen = int(subnet.prefixlen/8)
-            return "%s.%%" % ('.'.join(str(subnet[0]).split('.')[:splitlen]))
+        # the version is a hash of the records, pollers get a 304 as long as it does not change
+        zone = zone_cache.get(subnet)
+        response = Response(zone_file(zone), 200, mimetype="text/plain")
+        response.set_etag(zone.etag)
+        return response.make_conditional(request)
 
     def register_view(app, url="/api/rdns"):
         app.add_url_rule(url+'/<ip>/<prefix>', view_func=rdnsView.as_view('apps_api_rdns'), methods=['GET',])
+
+
+class rdnsExportView(View):
+    ''' all reverse zones in one JSON document '''
+    def dispatch_request(self):
+        export = zone_cache.get_all()
+        if request.if_none_match.contains(export.etag):
+            response = Response(status=304)
+        else:
+            response = Response(export_json(export), 200, mimetype="application/json")
+        response.set_etag(export.etag)
+        return response
+
+    def register_view(app, url="/api/rdns"):
+        app.add_url_rule(url+'/zones', view_func=rdnsExportView.as_view('apps_api_rdns_zones'), methods=['GET',])
+
+
+class rdnsChangesView(View):
+    ''' PTR records added and deleted since a serial, like IXFR '''
+    def dispatch_request(self):
+        try:
+            since = int(request.args.get('since', ''))
+        except ValueError:
+            return Response('since=<serial> required, the serial of /api/rdns/zones to start with', 400)
+
+        result = changes(since)
+        if result is None:
+            return Response(json.dumps({'error': 'serial %d is unknown or expired, fetch /api/rdns/zones' % since}),
+                            410, mimetype="application/json")
+        serial, entries, more = result
+        return Response(json.dumps({'serial': serial, 'more': more, 'changes': entries}),
+                        200, mimetype="application/json")
+
+    def register_view(app, url="/api/rdns"):
+        app.add_url_rule(url+'/changes', view_func=rdnsChangesView.as_view('apps_api_rdns_changes'), methods=['GET',])
@@ -2,9 +2,11 @@ import warnings
 warnings.filterwarnings("ignore", module="psycopg2")
 
 from .. import app, manager, model, utils
-from ..controller import accounting
+from ..controller import accounting, rdns, sepa_export, sepa_returns
 
 from sqlalchemy.sql.expression import func
+from datetime import datetime
+import os, sys
 
 @manager.command
 def build_uml(file='schema.png'):
@@ -64,6 +66,82 @@ def billing_send_all():
     accounting.send_unsent_invoices()
     model.db.session.commit()
 
+@manager.command
+def billing_rebuild_balances():
+    '''BILLING: recompute the balances of all contacts'''
+    print('%d balances rebuilt' % accounting.rebuild_balances())
+    model.db.session.commit()
+
+@manager.command
+def billing_outbox():
+    '''BILLING: deliver queued invoice mails that are due (again)'''
+    job = model.Job(
+        type = 'billing',
+        note = 'deliver_outbox' )
+    model.db.session.add(job)
+    accounting.deliver_outbox(job)
+    job.finished = datetime.utcnow()
+    model.db.session.commit()
+
+@manager.command
+def billing_sepa_export(output='.', max_transactions=None):
+    '''BILLING: export all eligible SEPA-DD invoices to pain.008 files in directory output'''
+    for invoice in sepa_export.export_queue(mandate=False):
+        print('skipped invoice %s: no SEPA mandate for %s' % (invoice.number, invoice.contact))
+    sepa = sepa_export.SepaExport(max_transactions)
+    sepa.add_invoices(sepa_export.export_queue(mandate=True))
+    if len(sepa) < 1:
+        print('no invoices to export')
+        return
+    for f in sepa.export(output):
+        print('%s: %d transactions' % (f.path, len(f)))
+
+@manager.command
+def billing_sepa_returns(file, dryrun=False):
+    '''BILLING: reconcile SEPA-DD returns of a pain.002 or camt file'''
+    job = None
+    if not dryrun:
+        job = model.Job(
+            type = 'billing',
+            note = 'sepa_returns' )
+        model.db.session.add(job)
+    with open(file, 'rb') as fp:
+        importer = sepa_returns.SepaReturnsImporter(fp, job)
+        importer.processReturns(sepa_returns.read_returns(fp), dryrun)
+    for table in importer.gen_view_tables():
+        print('%s %d' % (table['header'], len(table['rows'])))
+        for row in table['rows']:
+            print('    ' + ' | '.join(str(c) for c in row['columns']))
+    if job:
+        job.finished = datetime.utcnow()
+        model.db.session.commit()
+
+@manager.command
+def rdns_export(output='-', format='bind'):
+    '''write all reverse zones, BIND include files into directory output or JSON (- for stdout)'''
+    export = rdns.zone_cache.get_all()
+    if format == 'json':
+        if output == '-':
+            for part in rdns.export_json(export):
+                sys.stdout.write(part)
+        else:
+            with open(output + '.tmp', 'w') as fp:
+                fp.writelines(rdns.export_json(export))
+            os.replace(output + '.tmp', output)
+    elif format == 'bind':
+        if output == '-':
+            print('bind format needs an output directory')
+            return
+        written, removed = rdns.export_bind(export, output)
+        print('%d zones, %d written, %d removed' % (len(export.zones), written, removed))
+    else:
+        print('unknown format %s, use bind or json' % format)
+
+@manager.command
+def rdns_compact(days=None):
+    '''remove rDNS changes older than RDNS_CHANGES_DAYS'''
+    print('%d changes removed' % rdns.compact_changes(days))
+
 @manager.command
 def all_billing_users():
     '''all users (as CSV) with actively billed contract-packages (billing_active)'''
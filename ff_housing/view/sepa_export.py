@@ -3,6 +3,7 @@ from flask_admin.base import BaseView, expose
 from flask_admin.form import SecureForm
 from flask_admin.actions import action
 from datetime import datetime
+import io, os, tempfile, zipfile
 
 from flask import flash, Response
 from flask_security import current_user
@@ -10,6 +11,13 @@ from flask_admin.model.template import LinkRowAction
 from sqlalchemy.sql.expression import func
 
 from ff_housing.controller import SepaExport
+from ff_housing.controller.sepa_export import export_queue
+from ff_housing import model
+
+class ClauseEqualFilter(sqla.filters.BooleanEqualFilter):
+    ''' yes/no filter on a boolean SQL expression, like a hybrid property '''
+    def apply(self, query, value, alias=None):
+        return query.filter(self.column if value == '1' else ~self.column)
 
 class SepaExportView(sqla.ModelView):
 
@@ -25,31 +33,41 @@ class SepaExportView(sqla.ModelView):
     can_delete = False
     column_default_sort = ('id', True)
     column_list = ('number', 'job', 'created_at', 'contact', 'amount', 'sent', 'contact.has_sepa_mandate')
-    column_filters = ('job.id', 'contact.id', 'amount', 'created_at')
+    column_filters = ('job.id', 'contact.id', 'amount', 'created_at',
+                      ClauseEqualFilter(model.User.has_sepa_mandate, 'Contact / Has Sepa Mandate'))
     page_size = 200
 
     def get_query(self):
-        return super(SepaExportView, self).get_query().filter(self.model.sent_on != None,
-                                                                                                self.model.exported == False,
-                                                                                                self.model.cancelled == False,
-                                                                                                self.model.payment_type == 'SEPA-DD')
-	
+        # contacts are joined for the mandate filter and the contact columns
+        return export_queue().order_by(None)
+
     def get_count_query(self):
-        return self.session.query(func.count('*')).filter(self.model.sent_on != None,
-                                                                                    self.model.exported == False,
-                                                                                    self.model.cancelled == False,
-                                                                                    self.model.payment_type == 'SEPA-DD')
+        return self.session.query(func.count('*')).select_from(self.model).join(self.model.contact) \
+            .filter(self.model.sepa_queued)
 
 
     @action('export', 'Export', 'Are you sure you want export selected Invoices?')
     def action_export(self, ids):
         try:
             sepa = SepaExport()
-            invoices = self.model.query.filter(self.model.id.in_(ids))
+            invoices = export_queue().filter(self.model.id.in_(ids))
             sepa.add_invoices(invoices.all())
+            with tempfile.TemporaryDirectory() as output:
+                files = sepa.export(output, current_user)
+
+                if len(files) == 1:
+                    with open(files[0].path, 'rb') as fp:
+                        resp = Response(fp.read(), mimetype="application/xml")
+                    resp.headers['Content-Disposition'] = 'attachment;filename*=sepa_export_%s.xml' % sepa.msg_id
+                    return resp
 
-            resp = Response(sepa.export(), mimetype="application/xml")
-            resp.headers['Content-Disposition'] = 'attachment;filename*=sepa_export_%s.xml' % sepa.msg_id
+                # more transactions than the bank takes in one file
+                out = io.BytesIO()
+                with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive:
+                    for f in files:
+                        archive.write(f.path, os.path.basename(f.path))
+            resp = Response(out.getvalue(), mimetype="application/zip")
+            resp.headers['Content-Disposition'] = 'attachment;filename*=sepa_export_%s.zip' % sepa.msg_id
             return resp
 
         except Exception as ex:
@@ -12,8 +12,12 @@ from flask_admin.babel import gettext
 from sqlalchemy.sql.expression import func
 from flask_admin.model.helpers import get_mdict_item_or_list
 import ff_housing.model as model
+from .admin import InetModelConverter, InetFilterConverter
 
 class UserView(sqla.ModelView):
+    model_form_converter = InetModelConverter
+    filter_converter = InetFilterConverter()
+
     def is_accessible(self):
         if not current_user.is_active or not current_user.is_authenticated:
             return False
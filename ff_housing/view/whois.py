@@ -1,4 +1,5 @@
 from ff_housing import model, utils
+from ff_housing.controller.ip_index import ip_index
 from flask.views import View
 from flask import Response
 import ipaddress
@@ -29,13 +30,12 @@ class WhoisView(View):
         return Response(resp, mimetype="text/plain")
 
     def search_ip(self, ip):
-        return model.IP.query.filter(model.IP.ip_address.like(ip+"/_%")).first()
+        id = ip_index.find_host(ip)
+        return model.IP.query.get(id) if id else None
 
     def search_subnets(self, ip):
-        for subnet in model.IP.query.filter(model.IP.routed_subnet != None):
-            if ipaddress.ip_address(ip) in ipaddress.ip_network(subnet.routed_subnet):
-                return subnet
-        return None
+        id = ip_index.find_subnet(ip)
+        return model.IP.query.get(id) if id else None
 
     def register_view(app, url="/api/whois"):
         app.add_url_rule(url+'/<ip>', view_func=WhoisView.as_view('apps_api_whois'), methods=['GET',])
@@ -57,7 +57,7 @@ setup(
         "Flask-Script",
         "Flask-Mail",
         "flask-migrate",
-        "sqlalchemy",
+        "sqlalchemy>=1.4",
         "sqlalchemy_schemadisplay",
         "psycopg2-binary",
         "ipaddress",
@@ -65,6 +65,7 @@ setup(
         "jinja2",
         "latex",
         "sepaxml",
+        "text-unidecode",
         "python-stdnum",
         "requests"
         ]
@@ -0,0 +1,5 @@
+SECRET_KEY = 'test'
+SQLALCHEMY_DATABASE_URI = 'sqlite://'
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+MAIL_SUPPRESS_SEND = True
+WTF_CSRF_ENABLED = False
@@ -0,0 +1,27 @@
+import os
+os.environ.setdefault('CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.py'))
+
+import pytest
+
+from ff_housing import app, db
+
+
+@pytest.fixture
+def session(tmp_path):
+    ''' empty in-memory database '''
+    app.config['FF_HOUSING_FILES_DIR'] = str(tmp_path)
+    with app.test_request_context():
+        db.create_all()
+        yield db.session
+        db.session.remove()
+        db.drop_all()
+
+
+# benchmarks of the large installation cases, skipped unless FF_HOUSING_BENCH is set
+bench = pytest.mark.skipif(not os.environ.get('FF_HOUSING_BENCH'),
+                           reason='benchmark, set FF_HOUSING_BENCH=1 to run it')
+
+def login(client, user):
+    with client.session_transaction() as sess:
+        sess['user_id'] = sess['_user_id'] = str(user.id)
+        sess['_fresh'] = True
@@ -0,0 +1,53 @@
+''' the contact_balance table follows payments and sent invoices '''
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from ff_housing import app, model
+from ff_housing.controller.accounting import rebuild_balances
+
+
+@pytest.fixture
+def user(session, monkeypatch):
+    monkeypatch.setitem(app.config, 'FF_HOUSING_BALANCE_TABLE', True)
+    user = model.User(first_name='A', last_name='B', street='s', zip='1', town='t',
+                      email='a@example.org', active=True)
+    session.add(user)
+    session.commit()
+    return user
+
+def table_balance(session, user):
+    row = session.query(model.ContactBalance).get(user.id)
+    session.refresh(row)
+    return row.balance
+
+def test_balance_table(session, user):
+    session.add(model.Payment(contact=user, amount=Decimal('10.00'), reference='a'))
+    session.commit()
+    # the second change of the same contact adds to the existing row
+    session.add(model.Payment(contact=user, amount=Decimal('5.50'), reference='b'))
+    invoice = model.Invoice(contact=user, address='x', total=Decimal('7.00'))
+    session.add(invoice)
+    session.commit()
+    assert table_balance(session, user) == Decimal('15.50')
+
+    invoice.sent_on = datetime.utcnow()
+    session.commit()
+    assert table_balance(session, user) == Decimal('8.50')
+    assert user.balance == Decimal('8.50')
+
+    expected = session.query(model.User.balance_sum()).filter(model.User.id == user.id).scalar()
+    assert rebuild_balances() == 1
+    assert table_balance(session, user) == expected == Decimal('8.50')
+
+def test_balance_without_table(session, user, monkeypatch):
+    monkeypatch.setitem(app.config, 'FF_HOUSING_BALANCE_TABLE', False)
+    session.add_all([model.Payment(contact=user, amount=Decimal('10.00'), reference='a'),
+                     model.Invoice(contact=user, address='x', total=Decimal('3.00'), sent_on=datetime.utcnow()),
+                     model.Invoice(contact=user, address='y', total=Decimal('4.00'))])
+    session.commit()
+    # the unsent invoice does not count, on both sides of the hybrid
+    assert user.balance == Decimal('7.00')
+    assert session.query(model.User.balance).filter(model.User.id == user.id).scalar() == Decimal('7.00')
+    assert session.query(model.ContactBalance).count() == 0
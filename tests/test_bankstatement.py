@@ -0,0 +1,93 @@
+''' bank statements and SEPA returns, parsed from the sample documents in fixtures/ '''
+import io, os
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from ff_housing import app
+from ff_housing.controller.bankstatement import read_statement, read_returns, parse_camt, parse_pain002, parse_erste
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def fixture(name):
+    return open(os.path.join(FIXTURES, name), 'rb')
+
+CSV = '''Date;Partner;IBAN;Amount;Currency;Reference;Reference Number;Note
+01.02.2020;A;AT611904300234573201;1.234,56;;Housing-k1;R1;
+02.02.2020;B;AT611904300234573201;10,00;USD;Housing-k1;R2;
+03.02.2020;C;AT611904300234573201;5.00
+'''
+
+def test_csv_currency():
+    transactions = list(read_statement(io.BytesIO(CSV.encode()), 'csv'))
+    assert [(t.value, t.currency) for t in transactions] == [
+        (Decimal('1234.56'), 'EUR'), (Decimal('10.00'), 'USD'), (Decimal('5.00'), 'EUR')]
+    assert not any(t.error for t in transactions)
+
+def test_csv_reference_hash(monkeypatch):
+    config = dict(app.config['FF_HOUSING_IMPORT_CSV'])
+    config['columns'] = dict((k, v) for k, v in config['columns'].items() if k != 'reference_number')
+    monkeypatch.setitem(app.config, 'FF_HOUSING_IMPORT_CSV', config)
+    data = 'Date;Partner;Amount;Reference\n' + '01.02.2020;A;10,00;Housing-k1\n' * 2
+    references = [t.reference_number for t in read_statement(io.BytesIO(data.encode()), 'csv')]
+    # two equal transfers on one day are two payments, the same statement again gives the same ones
+    assert len(set(references)) == 2
+    assert references == [t.reference_number for t in read_statement(io.BytesIO(data.encode()), 'csv')]
+
+def test_erste():
+    with fixture('erste.json') as f:
+        transactions = list(read_statement(f))
+    assert [(t.date, t.partner, t.iban, t.value, t.currency, t.reference, t.reference_number, t.note)
+            for t in transactions[:2]] == [
+        (datetime(2020, 1, 2, 10), 'Alice', 'AT611904300234573201', 123.45, 'EUR', 'Housing-k7', 'R1', ''),
+        (datetime(2020, 1, 3, 10), 'Bob', 'DE89370400440532013000', -5, 'EUR', '10.0.0.1', 'R2', 'ignore')]
+    assert transactions[2].error == "ERROR: missing JSON data: 'partnerAccount'"
+    with fixture('erste.json') as f:
+        assert len(list(parse_erste(f))) == 3
+
+def test_camt053():
+    with fixture('camt053.xml') as f:
+        transactions = list(read_statement(f))
+    assert [(t.date, t.partner, t.iban, t.value, t.reference, t.reference_number) for t in transactions] == [
+        (datetime(2020, 3, 9), None, None, Decimal('120.00'), 'Housing-k7', 'BANK-1'),
+        # the batch entry gives one transaction per TxDtls with its own amount
+        (datetime(2020, 3, 10), 'Alice', 'DE89370400440532013000', Decimal('30.00'), 'Housing-k8 March', 'BANK-2/0'),
+        (datetime(2020, 3, 10), 'Bob', 'AT483200000012345864', Decimal('50.00'), 'RF18539007547034', 'BANK-2-B'),
+        # the pending entry is skipped
+        (datetime(2020, 3, 10), 'Carol', 'AT241904300000000125', Decimal('-73.86'),
+         'Funkfeuer Housing-k9 AR2600257', 'BANK-4')]
+    assert not any(t.error for t in transactions)
+    assert set(t.currency for t in transactions) == {'EUR'}
+    assert (transactions[3].end_to_end_id, transactions[3].return_reason) == ('AR2600257-Test-4c7a18dd1501', 'MD06')
+
+def test_camt054():
+    with fixture('camt054.xml') as f:
+        transactions = list(parse_camt(f))
+    assert [(t.date, t.value, t.end_to_end_id, t.return_reason, t.reference_number) for t in transactions] == [
+        (datetime(2020, 3, 11, 7, 30), Decimal('-183.05'), 'AR2600258-Test-00ffdda03bd0', 'RR04', 'RET-1'),
+        (datetime(2020, 3, 11), Decimal('50.00'), 'AR2600259-Test-9a1b2c3d4e5f', None, 'COL-1'),
+        (datetime(2020, 3, 11), Decimal('-12.00'), None, None, 'FEE-1')]
+
+def test_pain002():
+    with fixture('pain002.xml') as f:
+        transactions = list(parse_pain002(f))
+    assert [(t.end_to_end_id, t.return_reason, t.sequence_type, t.partner, t.iban, t.date, t.value, t.reference)
+            for t in transactions[:2]] == [
+        # rejected with the block status
+        ('AR2600301-Test-aaaaaaaaaaaa', 'AM04', 'FRST', 'Erin', 'AT483200000012345864',
+         datetime(2020, 3, 4), Decimal('-42.00'), 'Funkfeuer Housing-k11 AR2600301'),
+        ('AR2600302-Test-bbbbbbbbbbbb', 'NARR', 'RCUR', 'Frank', 'DE89370400440532013000',
+         datetime(2020, 3, 4), Decimal('-17.50'), None)]
+    # the accepted transaction is left out, the one without end-to-end ID is an error
+    assert len(transactions) == 3
+    assert transactions[2].error == "ERROR: no end-to-end ID"
+    assert not any(t.error for t in transactions[:2])
+
+@pytest.mark.parametrize('name, returns', [
+    ('pain002.xml', [('AR2600301-Test-aaaaaaaaaaaa', 'AM04'), ('AR2600302-Test-bbbbbbbbbbbb', 'NARR'), (None, 'MS03')]),
+    ('camt053.xml', [('AR2600257-Test-4c7a18dd1501', 'MD06')]),
+    ('camt054.xml', [('AR2600258-Test-00ffdda03bd0', 'RR04')])])
+def test_read_returns(name, returns):
+    with fixture(name) as f:
+        assert [(t.end_to_end_id, t.return_reason) for t in read_returns(f)] == returns
@@ -0,0 +1,91 @@
+''' bill_all against the old loop over all contacts.
+    FF_HOUSING_BENCH=1 python -m pytest -s tests/test_bench_billing.py
+    FF_HOUSING_BENCH_USERS sets the number of users, 3 contract packages each on average. '''
+import io, contextlib, os, random, time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import event
+
+from ff_housing import db, model
+from ff_housing.controller import accounting
+from conftest import bench
+
+USERS = int(os.environ.get('FF_HOUSING_BENCH_USERS', 10000))
+
+
+def build(users):
+    rnd = random.Random(1)
+    today = date.today()
+    servertype = model.ServerType(name='1U')
+    packages = [model.Package(name='p%d' % i, amount=amount, billing_period=period, type='x')
+                for i, (amount, period) in enumerate([(15, 1), (25, 1), (120, 12), (40, 3), ('7.33', 1)])]
+    db.session.add_all(packages + [servertype])
+    for u in range(users):
+        user = model.User(first_name='F%d' % u, last_name='L', street='s', zip='1', town='t',
+                          country='AT', email='u%d@example.org' % u, active=True)
+        for c in range(rnd.randint(1, 2)):
+            server = model.Server(billing_c=user, admin_c=user, servertype=servertype,
+                                  payment_type=rnd.choice(['SEPA-DD', 'money transfer', None]),
+                                  closed=rnd.random() < 0.1)
+            for k in range(rnd.randint(1, 3)):
+                opened = datetime.combine(today - timedelta(days=rnd.randint(-20, 400)), datetime.min.time())
+                package = model.ContractPackage(contract=server, package=rnd.choice(packages),
+                                                quantity=rnd.randint(1, 3), active=rnd.random() < 0.9,
+                                                opened_at=opened + timedelta(hours=3))
+                # copied from the package, as the admin form does
+                package.billing_period = None
+                if rnd.random() < 0.5:
+                    package.billed_until = today - timedelta(days=rnd.randint(-40, 25))
+                if rnd.random() < 0.2:
+                    package.closed_at = opened + timedelta(days=rnd.randint(0, 500))
+                db.session.add(package)
+        db.session.add(user)
+    db.session.commit()
+
+def billed():
+    invoices = [(i.contact_id, i.payment_type,
+                 sorted((t.title, t.detail, str(t.unit_price), t.quantity) for t in i.items))
+                for i in model.Invoice.query.order_by(model.Invoice.contact_id)]
+    packages = [(p.id, p.billed_until, p.last_billed)
+                for p in model.ContractPackage.query.order_by(model.ContractPackage.id)]
+    return invoices, packages
+
+def old_bill_all():
+    ''' bill_all before the due packages were selected in one query '''
+    job = model.Job(type='billing', note='bill_all', started=datetime.utcnow())
+    db.session.add(job)
+    for contact in db.session.query(model.User):
+        accounting.bill_contact(contact, job)
+    job.finished = datetime.utcnow()
+    db.session.commit()
+
+def run(bill):
+    ''' fresh database, returns the number of statements, seconds and the billed result '''
+    db.drop_all()
+    db.create_all()
+    build(USERS)
+    db.session.expunge_all()
+    statements = [0]
+    def count(*args):
+        statements[0] += 1
+    event.listen(db.engine, 'before_cursor_execute', count)
+    started = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            bill()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    seconds = time.perf_counter() - started
+    return statements[0], seconds, billed()
+
+@bench
+def test_bill_all(session, capsys):
+    new = run(accounting.bill_all)
+    old = run(old_bill_all)
+    with capsys.disabled():
+        print('\nbill_all, %d users, %d contract packages, %d invoices' % (
+            USERS, len(new[2][1]), len(new[2][0])))
+        print('  old: %d queries, %.1fs' % old[:2])
+        print('  new: %d queries, %.1fs' % new[:2])
+    assert new[2] == old[2]
+    assert new[0] < old[0]
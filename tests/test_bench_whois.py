@@ -0,0 +1,78 @@
+''' whois lookups from the prefix index against the old scan over all routed subnets.
+    FF_HOUSING_BENCH=1 python -m pytest -s tests/test_bench_whois.py
+    FF_HOUSING_BENCH_PREFIXES sets the number of IPs with a routed subnet, half of them IPv6. '''
+import ipaddress, os, random, time
+
+from ff_housing import db, model
+from ff_housing.controller.ip_index import ip_index
+from ff_housing.view.whois import WhoisView
+from conftest import bench
+
+PREFIXES = int(os.environ.get('FF_HOUSING_BENCH_PREFIXES', 100000))
+# the old path reads every routed subnet per request
+OLD_REQUESTS = 5
+
+
+def build(n):
+    ''' IPs with disjoint routed subnets, one per random /24 or /48 '''
+    rnd = random.Random(3)
+    rows = []
+    used = set()
+    while len(rows) < n:
+        if rnd.random() < 0.5:
+            prefixlen, bits, outer = rnd.choice([24, 26, 28, 29, 30]), 32, 24
+        else:
+            prefixlen, bits, outer = rnd.choice([48, 56, 64]), 128, 48
+        address = rnd.getrandbits(bits)
+        if (bits, address >> (bits - outer)) in used:
+            continue
+        used.add((bits, address >> (bits - outer)))
+        subnet = ipaddress.ip_network((address >> (bits - prefixlen) << (bits - prefixlen), prefixlen))
+        host = ipaddress.ip_interface((rnd.getrandbits(bits), bits - 8))
+        rows.append({'type_id': 1, 'active': True, 'monitoring': False,
+                     'ip_address': str(host), 'routed_subnet': str(subnet)})
+    db.session.add(model.IPType(id=1, name='v4'))
+    db.session.flush()
+    db.session.execute(model.IP.__table__.insert(), rows)
+    db.session.commit()
+    return rows
+
+def old_search_subnets(ip):
+    ''' WhoisView.search_subnets before the prefix index '''
+    for subnet in model.IP.query.filter(model.IP.routed_subnet != None):
+        if ipaddress.ip_address(ip) in ipaddress.ip_network(subnet.routed_subnet):
+            return subnet
+    return None
+
+@bench
+def test_whois(session, monkeypatch, capsys):
+    monkeypatch.setattr(ip_index, 'hosts', None)
+    monkeypatch.setattr(ip_index, 'subnets', None)
+    rows = build(PREFIXES)
+    rnd = random.Random(4)
+    subnets = [str(ipaddress.ip_network(r['routed_subnet'])[rnd.randint(0, 3)]) for r in rnd.sample(rows, 500)]
+    hosts = [r['ip_address'].split('/')[0] for r in rnd.sample(rows, 500)]
+    view = WhoisView()
+
+    started = time.perf_counter()
+    ip_index.build()
+    built = time.perf_counter() - started
+
+    started = time.perf_counter()
+    found_subnets = [view.search_subnets(ip) for ip in subnets]
+    found_hosts = [view.search_ip(ip) for ip in hosts]
+    lookup = (time.perf_counter() - started) / (len(subnets) + len(hosts))
+
+    started = time.perf_counter()
+    old = [old_search_subnets(ip) for ip in subnets[:OLD_REQUESTS]]
+    old_lookup = (time.perf_counter() - started) / OLD_REQUESTS
+
+    with capsys.disabled():
+        print('\nwhois, %d IPs with routed subnets' % PREFIXES)
+        print('  index build: %.2fs' % built)
+        print('  old: %.1fms per subnet request' % (old_lookup * 1000))
+        print('  new: %.2fms per request' % (lookup * 1000))
+    assert found_subnets[:OLD_REQUESTS] == old
+    assert all(ip in ipaddress.ip_network(ip_address.routed_subnet) for ip, ip_address in
+               zip(map(ipaddress.ip_address, subnets), found_subnets))
+    assert [str(ipaddress.ip_interface(ip_address.ip_address).ip) for ip_address in found_hosts] == hosts
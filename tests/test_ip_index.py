@@ -0,0 +1,64 @@
+''' the whois index follows committed IP changes only '''
+import time
+
+import pytest
+
+from ff_housing import app, model
+from ff_housing.controller.ip_index import ip_index
+
+
+@pytest.fixture
+def ips(session, monkeypatch):
+    monkeypatch.setattr(ip_index, 'hosts', None)
+    monkeypatch.setattr(ip_index, 'subnets', None)
+    session.add(model.IPType(id=1, name='v4'))
+    session.add(model.IP(type_id=1, ip_address='192.0.2.1/24', routed_subnet='198.51.100.0/24'))
+    session.commit()
+    # built from the database
+    assert ip_index.find_host('192.0.2.1')
+    return session
+
+
+def test_rollback(ips):
+    ip = model.IP(type_id=1, ip_address='192.0.2.2/24', routed_subnet='203.0.113.0/25')
+    ips.add(ip)
+    ips.flush()
+    assert ip_index.find_host('192.0.2.2') is None
+    ips.rollback()
+    assert ip_index.find_host('192.0.2.2') is None
+    assert ip_index.find_subnet('203.0.113.7') is None
+
+    ips.add(model.IP(type_id=1, ip_address='192.0.2.2/24', routed_subnet='203.0.113.0/25'))
+    ips.commit()
+    assert ip_index.find_host('192.0.2.2')
+    assert ip_index.find_subnet('203.0.113.7')
+
+def test_rolled_back_delete(ips):
+    ips.delete(model.IP.query.one())
+    ips.flush()
+    ips.rollback()
+    assert ip_index.find_host('192.0.2.1')
+    assert ip_index.find_subnet('198.51.100.9')
+
+def test_update(ips):
+    model.IP.query.one().ip_address = '192.0.2.3/24'
+    ips.commit()
+    assert ip_index.find_host('192.0.2.1') is None
+    assert ip_index.find_host('192.0.2.3')
+
+def test_expired_index_is_rebuilt_in_the_background(ips, monkeypatch):
+    # added by another process, no events here
+    table = model.IP.__table__
+    ips.execute(table.insert().values(type_id=1, active=True, ip_address='192.0.2.4/24'))
+    ips.commit()
+    monkeypatch.setitem(app.config, 'WHOIS_INDEX_TTL', 0)
+    monkeypatch.setattr(ip_index, 'built', 0)
+
+    # answered from the old index
+    assert ip_index.find_host('192.0.2.4') is None
+    for n in range(100):
+        if not ip_index.rebuilding:
+            break
+        time.sleep(0.01)
+    monkeypatch.setitem(app.config, 'WHOIS_INDEX_TTL', 300)
+    assert ip_index.find_host('192.0.2.4')
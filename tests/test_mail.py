@@ -0,0 +1,83 @@
+''' invoice mail delivery in batches and over a dropped SMTP connection '''
+import re, smtplib
+
+import flask_mail
+import pytest
+
+from ff_housing import app, model
+from ff_housing.controller import accounting
+from conftest import login
+
+
+class SMTPHost():
+    ''' accepts mails until it has delivered hang_up of them, then the connection is gone '''
+    def __init__(self, delivered, hang_up=None):
+        self.delivered = delivered
+        self.hang_up = hang_up
+
+    def sendmail(self, sender, recipients, msg, *args):
+        if self.hang_up is not None and len(self.delivered) >= self.hang_up:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        self.delivered += [r for r in recipients if r != app.config['FF_HOUSING_INVOICES_BCC']]
+
+    def quit(self):
+        pass
+
+@pytest.fixture
+def mails(tmp_path, monkeypatch):
+    monkeypatch.setattr(app.extensions['mail'], 'suppress', False)
+    attachment = tmp_path / 'invoice.pdf'
+    attachment.write_bytes(b'%PDF')
+    return [('u%d@example.org' % n, 'subject', 'body', str(attachment)) for n in range(5)]
+
+def smtp_server(monkeypatch, *hosts):
+    ''' connections in the order they are made, an exception is a failing connect '''
+    hosts = list(hosts)
+    def configure_host(conn):
+        host = hosts.pop(0)
+        if isinstance(host, Exception):
+            raise host
+        return host
+    monkeypatch.setattr(flask_mail.Connection, 'configure_host', configure_host)
+
+
+def test_reconnect(mails, monkeypatch):
+    delivered = []
+    smtp_server(monkeypatch, SMTPHost(delivered, hang_up=2), SMTPHost(delivered))
+    assert accounting._deliver(mails) == [None] * 5
+    assert delivered == [m[0] for m in mails]
+
+def test_failed_reconnect_fails_the_rest_of_the_batch(mails, monkeypatch):
+    delivered = []
+    smtp_server(monkeypatch, SMTPHost(delivered, hang_up=2), ConnectionRefusedError('refused'))
+    errors = accounting._deliver(mails)
+    assert errors[:2] == [None, None]
+    assert all(e and 'reconnect failed' in e for e in errors[2:])
+    assert delivered == [m[0] for m in mails[:2]]
+
+def test_no_connection(mails, monkeypatch):
+    smtp_server(monkeypatch, ConnectionRefusedError('refused'))
+    assert all(accounting._deliver(mails))
+
+def test_send_action_is_not_capped(session, mails, monkeypatch):
+    monkeypatch.setitem(app.config, 'FF_HOUSING_MAIL_BATCH', 2)
+    user = model.User(first_name='A', last_name='B', street='s', zip='1', town='t', email='a@example.org',
+                      active=True, roles=[model.Role(name='billing')])
+    session.add_all([user] + [model.Invoice(contact=user) for n in range(5)])
+    session.commit()
+    # no LaTeX here, every invoice gets the same pdf
+    monkeypatch.setattr(model.Invoice, 'path', mails[0][3])
+    monkeypatch.setattr(accounting, 'generate_invoices', lambda invoices, job=None: invoices)
+    delivered = []
+    smtp_server(monkeypatch, *[SMTPHost(delivered) for n in range(3)])
+
+    client = app.test_client()
+    login(client, user)
+    ids = [str(i.id) for i in model.Invoice.query]
+    token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"',
+                      client.get('/admin/invoices/').get_data(as_text=True)).group(1)
+    page = client.post('/admin/invoices/action/', data={'action': 'send', 'rowid': ids, 'csrf_token': token},
+                       follow_redirects=True).get_data(as_text=True)
+    assert '5 invoices sent.' in page
+    assert delivered == ['a@example.org'] * 5
+    assert model.Invoice.query.filter(model.Invoice.sent_on == None).count() == 0
@@ -0,0 +1,92 @@
+''' the payment import queries the database a constant number of times per chunk '''
+import io, json, random
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event
+
+from ff_housing import app, db, model
+from ff_housing.controller import PaymentsImporter
+from ff_housing.controller.paymentimport import insert_payments
+
+IBANS = ['AT611904300234573201', 'DE89370400440532013000', 'AT483200000012345864']
+
+
+@pytest.fixture
+def users(session):
+    session.add(model.IPType(id=1, name='v4'))
+    servertype = model.ServerType(name='1U')
+    users = []
+    for i, iban in enumerate(IBANS + [None, None]):
+        user = model.User(first_name='U%d' % i, last_name='L', street='s', zip='1', town='t',
+                          email='u%d@example.org' % i, active=True, sepa_iban=iban)
+        server = model.Server(billing_c=user, admin_c=user, servertype=servertype, active=True)
+        session.add_all([user, model.Contract(billing_c=user), server,
+                         model.IP(type_id=1, active=True, server=server, ip_address='10.0.0.%d/24' % (i + 1))])
+        users.append(user)
+    session.commit()
+    return users
+
+def statement(users, n):
+    ''' Erste JSON export of n transactions matching by IBAN, IP, user ID or nothing '''
+    rnd = random.Random(n)
+    transactions = []
+    for i in range(n):
+        transactions.append({
+            'booking': '2020-01-%02dT10:00:00' % (i % 28 + 1),
+            'partnerName': 'P%d' % i,
+            'partnerAccount': {'iban': rnd.choice(IBANS + ['AT000000000000000000'])},
+            'amount': {'value': rnd.randint(-5000, 20000), 'precision': 2, 'currency': 'EUR'},
+            'reference': rnd.choice(['Housing-k%d' % rnd.choice(users).id,
+                                     '10.0.0.%d' % rnd.randint(1, 9), 'misc %d' % i]),
+            'referenceNumber': 'R%d' % i,
+            'note': rnd.choice(['', '', 'ignore'])})
+    return json.dumps(transactions).encode()
+
+def run(data, dryrun):
+    ''' number of SELECT statements and of all statements of an import '''
+    class File:
+        stream = io.BytesIO(data)
+    statements = []
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        importer = PaymentsImporter(File)
+        importer.processPayments(importer.readfile(), dryrun)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    assert importer.count == len(json.loads(data))
+    return sum(1 for s in statements if s.lstrip().upper().startswith('SELECT')), len(statements)
+
+def test_dryrun_queries(users):
+    assert run(statement(users, 10), True) == run(statement(users, 400), True)
+
+def test_import_selects(users):
+    small = run(statement(users, 10), False)
+    model.Payment.query.delete()
+    db.session.commit()
+    large = run(statement(users, 400), False)
+    assert small[0] == large[0]
+    assert model.Payment.query.count() > 10
+
+def test_insert_payments(users, monkeypatch):
+    monkeypatch.setitem(app.config, 'FF_HOUSING_BALANCE_TABLE', True)
+    def row(reference, amount):
+        return {'contact_id': users[0].id, 'amount': amount, 'date': datetime(2020, 1, 1),
+                'reference': reference, 'job_id': None, 'detail': None, 'payment_type': None,
+                'created_at': datetime(2020, 1, 1)}
+    assert insert_payments([row('a', 1)]) == {'a'}
+    db.session.commit()
+    # existing and repeated references are skipped, rows without one are all inserted
+    assert insert_payments([row('a', 2), row('b', 3), row('b', 4), row(None, 5), row(None, 6)]) == {'b', None}
+    db.session.commit()
+    assert sorted(p.amount for p in model.Payment.query) == [1, 3, 5, 6]
+    assert db.session.query(model.ContactBalance.balance).filter_by(contact_id=users[0].id).scalar() == 15
+
+def test_empty_reference(users):
+    class Payment:
+        payment_referenceNum = ''
+        user = users[0]
+        payment_value = payment_date = job = payment_reference = payment_type = None
+    assert PaymentsImporter.PaymentImport.payment_row(Payment())['reference'] is None
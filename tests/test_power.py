@@ -0,0 +1,111 @@
+''' power outlet states from a stub PDU '''
+import json, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from types import SimpleNamespace
+
+import pytest
+
+from ff_housing import app, model
+from ff_housing.controller import power
+from conftest import login
+
+DELAY = 0.2
+
+
+class PDU(BaseHTTPRequestHandler):
+    ''' /ON/<n> and /OFF/<n> outlets answer after DELAY seconds, anything else fails '''
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        time.sleep(DELAY)
+        state = self.path.split('/')[1]
+        if state not in ('ON', 'OFF'):
+            self.send_error(500)
+            return
+        body = json.dumps({'state': state, 'current': 0.4}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def pdu(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PDU)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setitem(app.config, 'POWER_API', 'http://127.0.0.1:%d/' % server.server_address[1])
+    monkeypatch.setattr(power, '_session', None)
+    monkeypatch.setattr(power, '_states', {})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def outlets(n):
+    return [SimpleNamespace(id=i, endpoint='%s/%d' % ('ON' if i % 3 else 'OFF', i)) for i in range(n)]
+
+
+def test_get_statuses_concurrently(pdu):
+    started = time.monotonic()
+    statuses = power.get_statuses(outlets(32))
+    # 16 connections at a time, sequential would take 32 * DELAY
+    assert time.monotonic() - started < 8 * DELAY
+    assert sorted(pdu.requests) == sorted('/' + o.endpoint for o in outlets(32))
+    assert [statuses[i]['powered'] for i in range(32)] == [bool(i % 3) for i in range(32)]
+
+def test_cached_states(pdu):
+    power.get_statuses(outlets(4))
+    assert power.get_status(outlets(4)[1])['state'] == 'ON'
+    assert len(pdu.requests) == 4
+
+def test_failing_outlet(pdu):
+    statuses = power.get_statuses([SimpleNamespace(id=99, endpoint='BROKEN/99')] + outlets(2))
+    assert statuses[99] is None
+    assert statuses[0]['state'] == 'OFF'
+
+def test_admin_list(session, pdu):
+    admin = model.Role(name='admin')
+    user = model.User(first_name='A', last_name='B', street='s', zip='1', town='t', email='a@example.org',
+                      active=True, roles=[admin])
+    session.add(user)
+    session.add_all(model.PowerOutlet(outlet='o%d' % o.id, endpoint=o.endpoint) for o in outlets(10))
+    session.commit()
+
+    client = app.test_client()
+    login(client, user)
+    started = time.monotonic()
+    page = client.get('/admin/power/').get_data(as_text=True)
+    assert time.monotonic() - started < 5 * DELAY
+    assert len(pdu.requests) == 10
+    assert page.count('label-success">ON<') == 6
+    assert page.count('label-danger">OFF<') == 4
+
+def test_user_list(session, pdu):
+    user = model.User(first_name='A', last_name='B', street='s', zip='1', town='t', email='a@example.org', active=True)
+    server = model.Server(billing_c=user, admin_c=user, servertype=model.ServerType(name='1U'), active=True)
+    session.add_all(model.PowerOutlet(outlet='o%d' % o.id, endpoint=o.endpoint, server=server) for o in outlets(3))
+    session.add(model.PowerOutlet(outlet='other', endpoint='ON/99'))
+    session.commit()
+
+    client = app.test_client()
+    login(client, user)
+    page = client.get('/power/').get_data(as_text=True)
+    assert sorted(pdu.requests) == ['/OFF/0', '/ON/1', '/ON/2']
+    assert page.count('label-success">ON<') == 2
+
+def test_status_view_unknown(session, pdu):
+    user = model.User(first_name='A', last_name='B', street='s', zip='1', town='t', email='a@example.org', active=True)
+    server = model.Server(billing_c=user, admin_c=user, servertype=model.ServerType(name='1U'), active=True)
+    outlet = model.PowerOutlet(outlet='broken', endpoint='BROKEN/1', server=server, switchable=True)
+    session.add(outlet)
+    session.commit()
+
+    client = app.test_client()
+    login(client, user)
+    response = client.get('/power/view/?id=%d' % outlet.id)
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert 'label-default">unknown<' in page
+    assert 'id="powerform"' not in page
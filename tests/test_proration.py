@@ -0,0 +1,111 @@
+''' controller.proration against the rrule loop bill_package used before it '''
+import random
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+from dateutil.relativedelta import relativedelta
+from dateutil.rrule import rrule, MONTHLY
+
+from ff_housing import app
+from ff_housing.controller import proration
+from ff_housing.controller.accounting import proration_row
+from ff_housing.utils import daysofmonth
+
+
+def rrule_amount(package):
+    ''' (amount, start, end) as bill_package calculated them before, without the ORM '''
+    amount = 0
+    if package.billed_until is not None:
+        billed_until = package.billed_until
+        billingmonthday = billed_until.day
+        next_billed = billed_until + relativedelta(months=+package.billing_period)
+    else:
+        billed_until = package.opened_at.date()
+        billingmonthday = app.config.get('FF_HOUSING_BILLING_DAY_DEFAULT', 25)
+        next_billed = billed_until.replace(day=billingmonthday) + relativedelta(months=+package.billing_period)
+
+    if package.closed_at and next_billed > package.closed_at.date():
+        next_billed = package.closed_at.date()
+
+    last_date = billed_until
+    billing_dates = list(rrule(MONTHLY, dtstart=billed_until, until=next_billed, bymonthday=billingmonthday))
+    billing_dates.append(next_billed)
+    for next_date in billing_dates:
+        if type(next_date) is datetime:
+            next_date = next_date.date()
+
+        if last_date == next_date:
+            continue
+
+        if (last_date.day == next_date.day):
+            amount += package.amount
+        elif (int(next_date.month) != int(last_date.month)):
+            fraction_of_month = Decimal(
+                ( daysofmonth(last_date) - (last_date.day-1) ) / daysofmonth(last_date) \
+                + ( (next_date.day-1) / daysofmonth(next_date) )
+            )
+            amount += package.amount * fraction_of_month
+        else:
+            fraction_of_month = Decimal((next_date.day - last_date.day) / daysofmonth(next_date))
+            amount += package.amount * fraction_of_month
+        last_date = next_date
+        amount = amount.quantize(Decimal('.01'))
+    return amount, billed_until, next_billed
+
+
+def package(opened_at, billed_until=None, billing_period=1, closed_at=None, amount='15.00'):
+    return SimpleNamespace(opened_at=opened_at, billed_until=billed_until, billing_period=billing_period,
+                           closed_at=closed_at, amount=Decimal(amount))
+
+def random_package(rnd):
+    # 2019 to 2025, including the leap years 2020 and 2024
+    opened_at = datetime(2019, 1, 1, 3) + timedelta(days=rnd.randint(0, 7 * 365))
+    billed_until = None
+    if rnd.random() < 0.7:
+        billed_until = opened_at.date() + timedelta(days=rnd.randint(0, 400))
+    start = billed_until or opened_at.date()
+    closed_at = None
+    if rnd.random() < 0.3:
+        # closed before, in the middle of or after the span
+        closed_at = datetime.combine(start + timedelta(days=rnd.randint(1, 500)), datetime.min.time())
+    return package(opened_at, billed_until, rnd.choice([1, 1, 3, 6, 12]), closed_at,
+                   '%d.%02d' % (rnd.randint(0, 500), rnd.randint(0, 99)))
+
+def check(packages):
+    expected = [rrule_amount(p) for p in packages]
+    prorated = proration.prorate_all([proration_row(p) for p in packages])
+    # the same values and the same decimal places
+    assert [(str(a), s, e) for a, s, e in prorated] == [(str(a), s, e) for a, s, e in expected]
+
+
+@pytest.mark.parametrize('p', [
+    # February of a leap year and of a common year
+    package(datetime(2024, 1, 10)),
+    package(datetime(2023, 1, 10)),
+    package(datetime(2024, 2, 1), billed_until=date(2024, 2, 29)),
+    package(datetime(2024, 1, 1), billed_until=date(2024, 1, 29), billing_period=12),
+    # billing days that do not exist in every month
+    package(datetime(2021, 1, 1), billed_until=date(2021, 1, 31), billing_period=3),
+    package(datetime(2021, 1, 1), billed_until=date(2021, 8, 30), billing_period=6),
+    # closed in the middle of the period, on the billing day and after it
+    package(datetime(2022, 3, 5), billing_period=12, closed_at=datetime(2022, 9, 17)),
+    package(datetime(2022, 3, 5), billed_until=date(2022, 4, 25), closed_at=datetime(2022, 5, 25)),
+    package(datetime(2022, 3, 5), billed_until=date(2022, 4, 25), closed_at=datetime(2023, 1, 1)),
+    package(datetime(2020, 2, 28), billed_until=date(2020, 2, 28), closed_at=datetime(2020, 3, 1), amount='7.33'),
+])
+def test_edge_cases(p):
+    check([p])
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_packages(seed):
+    rnd = random.Random(seed)
+    check([random_package(rnd) for n in range(2000)])
+
+def test_batch_matches_single_rows():
+    rnd = random.Random(42)
+    rows = [proration_row(random_package(rnd)) for n in range(500)]
+    # a few packages billed over the same span
+    rows += rows[:100]
+    assert proration.prorate_all(rows) == [proration.prorate_all([row])[0] for row in rows]
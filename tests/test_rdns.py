@@ -0,0 +1,76 @@
+''' reverse zone export and the rDNS change log '''
+import ipaddress
+
+import pytest
+from flask_login import login_user
+from sqlalchemy.dialects import postgresql
+
+from ff_housing import model
+from ff_housing.controller import rdns
+from ff_housing.model import server
+
+
+def zone(subnet):
+    return ipaddress.ip_network(subnet)
+
+def test_zone_name():
+    assert rdns.zone_name(zone('10.0.0.0/24')) == '0.0.10.in-addr.arpa'
+    assert rdns.zone_name(zone('10.0.0.0/25')) == '0/25.0.0.10.in-addr.arpa'
+    assert rdns.zone_name(zone('10.0.0.128/25')) == '128/25.0.0.10.in-addr.arpa'
+    assert rdns.zone_name(zone('10.0.0.192/26')) == '192/26.0.0.10.in-addr.arpa'
+    assert rdns.zone_name(zone('2001:db8::/48')) == '0.0.0.0.8.b.d.0.1.0.0.2.ip6.arpa'
+
+@pytest.mark.parametrize('subnet', ['10.0.0.0/20', '10.0.0.0/23', '2001:db8::/50'])
+def test_zone_off_boundary(subnet):
+    with pytest.raises(ValueError):
+        rdns.check_zone(zone(subnet))
+
+def test_export_bind(tmp_path):
+    export = rdns.Export(1, [
+        (zone('10.0.0.0/25'), ['5\tPTR\ta.example.']),
+        (zone('10.0.0.128/25'), ['133\tPTR\tb.example.']),
+        (zone('10.0.1.0/24'), ['7\tPTR\tc.example.'])])
+    assert rdns.export_bind(export, str(tmp_path)) == (3, 0)
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        '0-25.0.0.10.in-addr.arpa.inc', '1.0.10.in-addr.arpa.inc', '128-25.0.0.10.in-addr.arpa.inc']
+    assert (tmp_path / '128-25.0.0.10.in-addr.arpa.inc').read_text().endswith('133\tPTR\tb.example.\n')
+
+    export = rdns.Export(2, [(zone('10.0.0.0/25'), ['5\tPTR\ta.example.'])])
+    assert rdns.export_bind(export, str(tmp_path)) == (0, 2)
+
+
+class Connection:
+    dialect = postgresql.dialect()
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement, *args):
+        self.statements.append(str(statement.compile(dialect=self.dialect)))
+
+def test_change_log_is_locked_on_postgresql():
+    conn = Connection()
+    server._log_rdns_changes(conn, {'10.0.0.1': 'a.example'}, {'10.0.0.1': 'a.example'})
+    assert conn.statements == []
+    server._log_rdns_changes(conn, {}, {'10.0.0.1': 'a.example'})
+    assert conn.statements[0].startswith('SELECT pg_advisory_xact_lock(')
+    assert conn.statements[1].startswith('INSERT INTO rdns_change')
+
+def test_records_match_the_change_log(session):
+    user = model.User(first_name='A', last_name='B', street='s', zip='1', town='t', email='a@example.org',
+                      active=True, roles=[model.Role(name='system')])
+    server = model.Server(billing_c=user, admin_c=user, servertype=model.ServerType(name='1U'), active=True)
+    session.add(model.IPType(id=1, name='v4'))
+    ip = model.IP(type_id=1, ip_address='10.0.0.1/24', routed_subnet='10.0.1.0/24', rdns='a.example', server=server)
+    session.add(ip)
+    session.commit()
+    login_user(user)
+    session.add_all([model.Subnet_rDNS(subnet=ip, ip_address='10.0.1.5', rdns='b.example'),
+                     model.Subnet_rDNS(subnet=ip, ip_address='10.0.1.6', rdns=None)])
+    session.commit()
+
+    logged = sorted('%s %s' % (c.ip_address, c.rdns) for c in model.RDNSChange.query)
+    assert logged == ['10.0.0.1 a.example', '10.0.1.5 b.example']
+    assert rdns.zone_records(zone('10.0.1.0/24')) == ['5\tPTR\tb.example.']
+    assert [(str(z), records) for z, records in rdns.all_zone_records()] == [
+        ('10.0.0.0/24', ['1\tPTR\ta.example.']), ('10.0.1.0/24', ['5\tPTR\tb.example.'])]
@@ -0,0 +1,53 @@
+''' the SEPA export commits the invoices only once their files are written '''
+import os
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
+from ff_housing import model
+from ff_housing.controller import SepaExport, sepa_export
+from ff_housing.controller.sepa_export import export_queue
+
+
+@pytest.fixture
+def invoices(session):
+    user = model.User(first_name='A', last_name='B', street='s', zip='1', town='t', email='a@example.org',
+                      active=True, sepa_iban='AT611904300234573201', sepa_mandate_id='M1',
+                      sepa_mandate_date=date(2020, 1, 1))
+    invoices = [model.Invoice(contact=user, address='x', total=Decimal('10.00'), sent_on=datetime.utcnow(),
+                              payment_type='SEPA-DD') for n in range(3)]
+    session.add_all(invoices)
+    session.commit()
+    return invoices
+
+def export(output, max_transactions=None):
+    sepa = SepaExport(max_transactions)
+    sepa.add_invoices(export_queue(mandate=True).all())
+    return sepa.export(str(output))
+
+def test_export(session, invoices, tmp_path):
+    files = export(tmp_path, 2)
+    assert [len(f) for f in files] == [2, 1]
+    assert sorted(os.listdir(str(tmp_path))) == sorted('sepa_export_%s.xml' % f.msg_id for f in files)
+    for f in files:
+        with open(f.path, 'rb') as fp:
+            assert b'<NbOfTxs>%d</NbOfTxs>' % len(f) in fp.read()
+    session.expire_all()
+    assert all(i.exported and i.exported_id for i in invoices)
+    assert not invoices[0].contact.sepa_mandate_first
+    assert export_queue().count() == 0
+
+def test_export_invalid(session, invoices, tmp_path, monkeypatch):
+    def invalid(xml, schema):
+        if b'<NbOfTxs>1</NbOfTxs>' in xml:
+            raise ValueError('invalid')
+    monkeypatch.setattr(sepa_export, 'try_valid_xml', invalid)
+    with pytest.raises(ValueError):
+        export(tmp_path, 2)
+    # the first file was saved already, it is removed with the temporary file of the second
+    assert os.listdir(str(tmp_path)) == []
+    session.expire_all()
+    assert not any(i.exported or i.exported_id for i in invoices)
+    assert invoices[0].contact.sepa_mandate_first
+    assert export_queue().count() == 3
@@ -0,0 +1,65 @@
+''' Inet columns: containment, text search and clause adaptation '''
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.util import ClauseAdapter
+
+from ff_housing import app, model
+from conftest import login
+
+
+def ips(session):
+    session.add(model.IPType(id=1, name='v4'))
+    for address, subnet in [('192.0.2.1/24', '198.51.100.0/24'), ('192.0.2.2/24', None), ('2001:db8::1/64', None)]:
+        session.add(model.IP(type_id=1, ip_address=address, routed_subnet=subnet))
+    session.commit()
+
+def addresses(query):
+    return sorted(ip.ip_address for ip in query)
+
+def test_containment(session):
+    ips(session)
+    IP = model.IP
+    assert addresses(IP.query.filter(IP.ip_address.contained_by('192.0.2.0/31'))) == ['192.0.2.1/24']
+    assert addresses(IP.query.filter(IP.ip_address.contained_by('192.0.2.0/24'))) == ['192.0.2.1/24', '192.0.2.2/24']
+    assert addresses(IP.query.filter(IP.ip_address.contained_by('2001:db8::/32'))) == ['2001:db8::1/64']
+    assert addresses(IP.query.filter(IP.routed_subnet.contains_address('198.51.100.7'))) == ['192.0.2.1/24']
+    assert addresses(IP.query.filter(IP.ip_address.like('192.0.2.%'))) == ['192.0.2.1/24', '192.0.2.2/24']
+
+    other = aliased(IP)
+    assert addresses(session.query(other).filter(other.ip_address.contained_by('192.0.2.2/32'))) == ['192.0.2.2/24']
+
+def test_adaptation():
+    table = model.IP.__table__
+    alias = table.alias('other')
+    for expr in [table.c.ip_address.contained_by('10.0.0.0/8'), table.c.routed_subnet.contains_address('10.0.0.1'),
+                 table.c.ip_address.like('10.%')]:
+        sql = str(select([alias.c.id]).where(ClauseAdapter(alias).traverse(expr)))
+        assert 'other.ip_address' in sql or 'other.routed_subnet' in sql
+        assert '"IP".' not in sql
+
+def test_postgresql():
+    IP = model.IP.__table__.c
+    compile = lambda e: str(e.compile(dialect=postgresql.dialect()))
+    assert compile(IP.ip_address.contained_by('10.0.0.0/8')).startswith(
+        'CAST(host("IP".ip_address) AS INET) <<= CAST(')
+    assert compile(IP.routed_subnet.contains_address('10.0.0.1')).startswith('"IP".routed_subnet >>= CAST(')
+    assert compile(IP.ip_address.like('10.%')).startswith('CAST("IP".ip_address AS VARCHAR) LIKE')
+
+def test_admin_search(session):
+    ips(session)
+    user = model.User(first_name='A', last_name='B', street='s', zip='1', town='t', email='a@example.org',
+                      active=True, roles=[model.Role(name='admin'), model.Role(name='system')])
+    server = model.Server(billing_c=user, admin_c=user, servertype=model.ServerType(name='1U'), location='rack-42')
+    server.ips = [model.IP.query.filter_by(ip_address='192.0.2.2/24').one()]
+    session.add(user)
+    session.commit()
+
+    client = app.test_client()
+    login(client, user)
+    page = client.get('/admin/ips/?search=192.0.2.2').get_data(as_text=True)
+    assert '192.0.2.2' in page and '192.0.2.1' not in page
+    response = client.get('/admin/servers/?search=192.0.2.2')
+    assert response.status_code == 200
+    assert 'rack-42' in response.get_data(as_text=True)
+    assert 'rack-42' not in client.get('/admin/servers/?search=192.0.2.1').get_data(as_text=True)